@@ -0,0 +1,53 @@
+# Отдача статического файла заранее сжатым (gzip и brotli, если установлен).
+#
+# Файл читается и сжимается один раз; ETag - хеш содержимого плюс кодировка,
+# так что повторный заход с If-None-Match получает 304 без тела. Если файл
+# поменялся на диске (правка в режиме разработки), варианты пересобираются
+# при следующем запросе.
+import gzip
+import hashlib
+import os
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class StaticAsset:
+    def __init__(self, path, mimetype, cache_control='no-cache'):
+        self.path = path
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self._loaded = (None, None, {})  # (mtime, хеш содержимого, {кодировка: тело})
+    
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        loaded = self._loaded
+        if loaded[0] != mtime:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            bodies = {'identity': raw, 'gzip': gzip.compress(raw, 9, mtime=0)}
+            if brotli is not None:
+                bodies['br'] = brotli.compress(raw, quality=11)
+            # Заменяем кортеж целиком: параллельный запрос видит старую или новую версию
+            loaded = self._loaded = (mtime, hashlib.sha256(raw).hexdigest()[:20], bodies)
+        return loaded
+    
+    def serve(self, request):
+        _, digest, bodies = self._load()
+        encoding = next((name for name in ('br', 'gzip')
+                         if name in bodies and request.accept_encodings[name]), 'identity')
+        etag = f'{digest}-{encoding}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(bodies[encoding], mimetype=self.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = self.cache_control
+        return response
@@ -0,0 +1,272 @@
+# Медленные клиенты и флуд: ограниченные исходящие очереди и лимиты частоты.
+#
+#   python bench/backpressure.py --slow 10 --messages 20000
+#
+# Медленные клиенты: в группе отправитель, быстрый читатель и --slow сокетов,
+# которые вошли в чат и перестали читать (сырой WebSocket с маленьким
+# приемным буфером). Отправитель шлет --messages сообщений по ~1 КБ, каждое с
+# подтверждением. Меряются задержка доставки быстрому читателю, прирост
+# памяти сервера, наибольшая глубина исходящих очередей из /metrics и
+# отключения по переполнению - без предела очереди (DEEPLINK_OUTBOUND_QUEUE=0)
+# и с пределом по умолчанию. Лимиты частоты здесь выключены.
+#
+# Флуд: один клиент без пауз шлет сообщения в свой чат, а соседняя пара
+# раз в PROBE_INTERVAL (в пределах лимита) отправляет сообщение и меряет его
+# доставку - без лимитов частоты и с ними.
+import argparse
+import base64
+import os
+import signal
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client import Client, post, wait_ready  # noqa: E402
+
+PADDING = 'x' * 1000
+PROBES = 100  # Сообщений соседней пары во время флуда
+PROBE_INTERVAL = 0.15
+
+
+def start(port, env):
+    env = dict(os.environ, DEEPLINK_DATA_DIR='', DEEPLINK_PORT=str(port), **env)
+    process = subprocess.Popen([sys.executable, 'workers.py', '--workers', '1'], cwd=ROOT, env=env,
+                               start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_ready(port)
+    return process
+
+
+def stop(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def rss(pid):
+    # RSS процесса и его потомков (воркер - дочерний процесс workers.py), МиБ
+    total = 0
+    for entry in [str(pid)] + os.listdir('/proc'):
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            if entry != str(pid) and int(fields[1]) != pid:
+                continue
+            with open(f'/proc/{entry}/status') as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+        except (OSError, ValueError):
+            continue
+    return total / 1024
+
+
+def scrape(port):
+    # {имя с метками: значение} из /metrics
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+        text = response.read().decode('utf-8')
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            values[name] = float(value)
+    return values
+
+
+def total(values, prefix, needle=''):
+    return sum(value for name, value in values.items() if name.startswith(prefix) and needle in name)
+
+
+def client_frame(text):
+    # Текстовый кадр клиента; маска обязательна по RFC 6455
+    payload = text.encode('utf-8')
+    mask = os.urandom(4)
+    size = len(payload)
+    if size < 126:
+        header = struct.pack('!BB', 0x81, 0x80 | size)
+    elif size < 65536:
+        header = struct.pack('!BBH', 0x81, 0x80 | 126, size)
+    else:
+        header = struct.pack('!BBQ', 0x81, 0x80 | 127, size)
+    return header + mask + bytes(byte ^ mask[n % 4] for n, byte in enumerate(payload))
+
+
+def server_frame(reader):
+    first, second = reader.read(2)
+    size = second & 0x7f
+    if size == 126:
+        size = struct.unpack('!H', reader.read(2))[0]
+    elif size == 127:
+        size = struct.unpack('!Q', reader.read(8))[0]
+    return reader.read(size).decode('utf-8')
+
+
+def stalled_socket(port, username, chat_id):
+    # Сокет, который вошел в чат и больше ничего не читает
+    import socket
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(('127.0.0.1', port))
+    key = base64.b64encode(os.urandom(16)).decode()
+    sock.sendall((f'GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n'
+                  f'Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n'
+                  'Sec-WebSocket-Version: 13\r\n\r\n').encode())
+    reader = sock.makefile('rb')
+    while reader.readline() not in (b'\r\n', b''):
+        pass
+    server_frame(reader)  # 0{...} - открытие сессии Engine.IO
+    sock.sendall(client_frame('40'))
+    while not server_frame(reader).startswith('40'):
+        pass
+    sock.sendall(client_frame(f'42["user_online",{{"username":"{username}"}}]'))
+    sock.sendall(client_frame(f'421["join_chat",{{"chat_id":"{chat_id}"}}]'))
+    while not server_frame(reader).startswith('431'):
+        pass
+    return sock
+
+
+def percentiles(values):
+    values = sorted(values)
+    return statistics.median(values), values[int(len(values) * 0.99) - 1]
+
+
+def slow_consumers(port, options):
+    members = [f'slow{n}' for n in range(options.slow)]
+    for username in ['alice', 'bob'] + members:
+        post(port, '/api/register', {'username': username, 'password': 'password123'})
+    chat_id = post(port, '/api/group/create', {'creator': 'alice', 'name': 'backpressure',
+                                               'members': ['bob'] + members})['chat_id']
+    # Отправитель в комнату не входит: ему нужны только подтверждения
+    alice, bob = Client(port), Client(port)
+    alice.emit('user_online', {'username': 'alice'})
+    bob.emit('user_online', {'username': 'bob'})
+    bob.call('join_chat', {'chat_id': chat_id})
+    stalled = [stalled_socket(port, username, chat_id) for username in members]
+    
+    peak = {'depth': 0, 'rss': 0}
+    done = threading.Event()
+    
+    def watch():
+        while not done.is_set():
+            values = scrape(port)
+            peak['depth'] = max(peak['depth'], values.get('deeplink_outbound_queue{stat="total"}', 0))
+            peak['rss'] = max(peak['rss'], rss(options.pid))
+            time.sleep(0.2)
+    
+    before = rss(options.pid)
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    sent = {}
+    started = time.perf_counter()
+    for n in range(options.messages):
+        sent[str(n)] = time.perf_counter()
+        alice.call('send_message', {'chat_id': chat_id, 'sender': 'alice', 'content': f'{n} {PADDING}'})
+    latencies = []
+    while len(latencies) < options.messages:
+        received, data = bob.wait('new_message', lambda data: data['sender'] == 'alice', timeout=60)
+        latencies.append((received - sent[data['content'].split(' ', 1)[0]]) * 1000)
+    elapsed = time.perf_counter() - started
+    time.sleep(0.5)
+    done.set()
+    watcher.join()
+    values = scrape(port)
+    result = {
+        'rate': options.messages / elapsed,
+        'latency': percentiles(latencies),
+        'rss': (before, peak['rss'], rss(options.pid)),
+        'depth': peak['depth'],
+        'overflow': total(values, 'deeplink_outbound_events_total', 'result="overflow"'),
+        'connections': values.get('deeplink_connections', 0)
+    }
+    for sock in stalled:
+        sock.close()
+    alice.close()
+    bob.close()
+    return result
+
+
+def flood(port, options):
+    for username in ('mallory', 'carol', 'dave'):
+        post(port, '/api/register', {'username': username, 'password': 'password123'})
+    flood_chat = post(port, '/api/chat/create', {'user1': 'mallory', 'user2': 'carol'})['chat_id']
+    probe_chat = post(port, '/api/chat/create', {'user1': 'carol', 'user2': 'dave'})['chat_id']
+    mallory, carol, dave = Client(port), Client(port), Client(port)
+    for client, username in ((mallory, 'mallory'), (carol, 'carol'), (dave, 'dave')):
+        client.emit('user_online', {'username': username})
+    mallory.call('join_chat', {'chat_id': flood_chat})
+    dave.call('join_chat', {'chat_id': probe_chat})
+    
+    done = threading.Event()
+    flooded = [0]
+    
+    def flooder():
+        while not done.is_set():
+            mallory.emit('send_message', {'chat_id': flood_chat, 'sender': 'mallory',
+                                          'content': f'{flooded[0]} {PADDING}'})
+            flooded[0] += 1
+    
+    thread = threading.Thread(target=flooder)
+    started = time.perf_counter()
+    thread.start()
+    latencies = []
+    for n in range(PROBES):
+        sent = time.perf_counter()
+        carol.emit('send_message', {'chat_id': probe_chat, 'sender': 'carol', 'content': f'probe {n}'})
+        received, _ = dave.wait('new_message', lambda data, n=n: data['content'] == f'probe {n}', timeout=120)
+        latencies.append((received - sent) * 1000)
+        time.sleep(PROBE_INTERVAL)
+    done.set()
+    thread.join()
+    elapsed = time.perf_counter() - started
+    values = scrape(port)
+    for client in (mallory, carol, dave):
+        client.close()
+    return {
+        'latency': percentiles(latencies),
+        'rate': flooded[0] / elapsed,
+        'throttled': total(values, 'deeplink_rate_limited_total', 'event="send_message"')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=10400)
+    parser.add_argument('--slow', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=20000)
+    options = parser.parse_args()
+    
+    print(f'{options.slow} stalled sockets, {options.messages:,} messages of ~1 KB')
+    for n, (name, queue) in enumerate((('unbounded', '0'), ('bounded', '1000'))):
+        process = start(options.port + n, {'DEEPLINK_OUTBOUND_QUEUE': queue, 'DEEPLINK_RATE_LIMIT_SCALE': '0'})
+        options.pid = process.pid
+        try:
+            row = slow_consumers(options.port + n, options)
+        finally:
+            stop(process)
+        before, peak, after = row['rss']
+        print(f"{name:>10} | {row['rate']:6,.0f} msg/s | fast reader p50 {row['latency'][0]:5.1f} ms "
+              f"p99 {row['latency'][1]:6.1f} ms | RSS {before:4.0f} -> peak {peak:4.0f} -> {after:4.0f} MiB | "
+              f"queued packets peak {row['depth']:7,.0f} | overflow disconnects {row['overflow']:.0f}, "
+              f"sockets left {row['connections']:.0f}")
+    
+    print(f'\nflood from one client, {PROBES} probe messages in a neighbouring chat')
+    for n, (name, scale) in enumerate((('no limits', '0'), ('rate limits', '1'))):
+        port = options.port + 2 + n
+        process = start(port, {'DEEPLINK_RATE_LIMIT_SCALE': scale})
+        try:
+            row = flood(port, options)
+        finally:
+            stop(process)
+        print(f"{name:>11} | probe p50 {row['latency'][0]:6.1f} ms p99 {row['latency'][1]:7.1f} ms | "
+              f"flood {row['rate']:6,.0f} msg/s, throttled {row['throttled']:,.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# Минимальный клиент Socket.IO и HTTP для бенчмарков, поверх simple-websocket.
+# Пакеты Socket.IO - JSON в текстовых кадрах или MessagePack в бинарных
+# (сервер с DEEPLINK_SOCKETIO_SERIALIZER=msgpack).
+import json
+import queue
+import threading
+import time
+import urllib.request
+
+import simple_websocket
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CONNECT, EVENT, ACK, CONNECT_ERROR = 0, 2, 3, 4
+
+
+class Refused(Exception):
+    pass
+
+
+class Client:
+    # Engine.IO 4 / Socket.IO 5 по WebSocket, пространство имен по умолчанию
+    def __init__(self, port, host='127.0.0.1', serializer='json'):
+        self.msgpack = serializer == 'msgpack'
+        self.events = queue.Queue()
+        self._acks = {}  # id подтверждения -> очередь для ответа
+        self._ack_id = 0
+        self.ws = simple_websocket.Client.connect(f'ws://{host}:{port}/socket.io/?EIO=4&transport=websocket')
+        self.ws.receive(timeout=5)  # 0{...} - открытие сессии Engine.IO
+        self._send(CONNECT)
+        while True:
+            frame = self.ws.receive(timeout=5)
+            if frame is None:
+                raise TimeoutError('нет ответа на подключение')
+            packet = self._parse(frame)
+            if packet and packet[0] == CONNECT_ERROR:
+                self.ws.close()
+                raise Refused(packet[1])
+            if packet and packet[0] == CONNECT:
+                break
+        threading.Thread(target=self._reader, daemon=True).start()
+    
+    def _send(self, packet_type, data=None, ack_id=None):
+        if self.msgpack:
+            packet = {'type': packet_type, 'nsp': '/'}
+            if data is not None:
+                packet['data'] = data
+            if ack_id is not None:
+                packet['id'] = ack_id
+            self.ws.send(msgpack.packb(packet))
+        else:
+            self.ws.send(f'4{packet_type}{"" if ack_id is None else ack_id}'
+                         f'{"" if data is None else json.dumps(data)}')
+    
+    def _parse(self, frame):
+        # (тип, данные, id подтверждения) пакета Socket.IO или None
+        if isinstance(frame, bytes):
+            packet = msgpack.unpackb(frame)
+            return packet['type'], packet.get('data'), packet.get('id')
+        if not frame.startswith('4'):
+            return None
+        body = frame[2:]
+        digits = len(body) - len(body.lstrip('0123456789'))
+        ack_id = int(body[:digits]) if digits else None
+        data = json.loads(body[digits:]) if body[digits:] else None
+        return int(frame[1]), data, ack_id
+    
+    def _reader(self):
+        while True:
+            try:
+                frame = self.ws.receive()
+            except simple_websocket.ConnectionClosed:
+                return
+            if frame == '2':
+                self.ws.send('3')
+                continue
+            packet = self._parse(frame) if frame else None
+            if packet is None:
+                continue
+            packet_type, data, ack_id = packet
+            if packet_type == EVENT:
+                self.events.put((time.perf_counter(), data[0], data[1]))
+            elif packet_type == ACK:
+                waiter = self._acks.pop(ack_id, None)
+                if waiter:
+                    waiter.put(data)
+    
+    def emit(self, event, data):
+        self._send(EVENT, [event, data])
+    
+    def call(self, event, data, timeout=30):
+        # emit с подтверждением: ждет, пока сервер обработает событие
+        self._ack_id += 1
+        waiter = self._acks[self._ack_id] = queue.Queue()
+        self._send(EVENT, [event, data], self._ack_id)
+        return waiter.get(timeout=timeout)
+    
+    def wait(self, event, match=lambda data: True, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise AssertionError(f'не дождались {event}')
+            try:
+                received, name, data = self.events.get(timeout=left)
+            except queue.Empty:
+                continue
+            if name == event and match(data):
+                return received, data
+    
+    def close(self):
+        # Повторное закрытие ничего не делает: тесты закрывают клиентов и в finally
+        if self.ws.connected:
+            self.ws.close()
+
+
+def get(port, path):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}') as response:
+        return json.loads(response.read())
+
+
+def post(port, path, payload):
+    request = urllib.request.Request(f'http://127.0.0.1:{port}{path}', json.dumps(payload).encode('utf-8'),
+                                     {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/api/stats'):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
@@ -0,0 +1,118 @@
+# Бенчмарк рассылки в группах: задержка handle_send_message при 10, 1000 и
+# 10000 участников.
+#
+#   python bench/groups.py --sizes 10 1000 10000 --messages 200 --storage memory
+#
+# Все в одном процессе: участники группы - поддельные сокеты в комнате чата
+# (в менеджере Socket.IO), отправка в сеть подменена счетчиком. Так видно
+# саму цену отправки на сервере: запись сообщения, непрочитанные, ленту
+# изменений и обход комнаты. Отдельно меряется сторона участника: версия
+# списка чатов и сам список с непрочитанными.
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(srver, size, messages):
+    store = srver.store
+    chat_id = str(uuid.uuid4())
+    roles = {f'member{n:05d}': 'member' for n in range(size)}
+    roles['member00000'] = 'owner'
+    store.create_chat({
+        'id': chat_id,
+        'type': 'group',
+        'name': f'Группа {size}',
+        'owner': 'member00000',
+        'created_at': datetime.now().isoformat(),
+        'last_message': None,
+        'unread': 0
+    }, None, roles)
+    
+    # Участники в комнате чата, как после join_chat
+    manager = srver.socketio.server.manager
+    for n in range(size):
+        sid = manager.connect(f'{chat_id}-{n}', '/')
+        manager.enter_room(sid, '/', chat_id)
+    
+    delivered = [0]
+    
+    def send_packet(eio_sid, pkt):
+        delivered[0] += 1
+    
+    srver.socketio.server._send_eio_packet = send_packet
+    
+    timings = []
+    total = time.perf_counter()
+    for n in range(messages):
+        started = time.perf_counter()
+        srver.handle_send_message({'chat_id': chat_id, 'sender': f'member{n % size:05d}',
+                                   'content': f'Сообщение {n} в группе'})
+        timings.append((time.perf_counter() - started) * 1e6)
+    # SQLite пишет пачками в фоне: пропускная способность - вместе с записью
+    if hasattr(store, 'flush'):
+        store.flush()
+    total = time.perf_counter() - total
+    del srver.socketio.server._send_eio_packet
+    
+    reader = f'member{size - 1:05d}'
+    version_timings = []
+    list_timings = []
+    for _ in range(50):
+        started = time.perf_counter()
+        store.get_version('chats', reader)
+        version_timings.append((time.perf_counter() - started) * 1e6)
+        started = time.perf_counter()
+        chats = store.chat_list(reader)
+        list_timings.append((time.perf_counter() - started) * 1e6)
+    unread = next(count for chat, _, count in chats if chat['id'] == chat_id)
+    
+    assert delivered[0] == size * messages, delivered
+    median = statistics.median(timings)
+    print(f'{size:>7} | {median:9.1f} {percentile(timings, 0.99):9.1f} {messages / total:8,.0f} | '
+          f'{median / size:8.2f} | '
+          f'{statistics.median(version_timings):8.1f} {statistics.median(list_timings):8.1f} | {unread:>6}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--storage', choices=('memory', 'sqlite'), default='memory')
+    args = parser.parse_args()
+    
+    os.environ['DEEPLINK_DATA_DIR'] = ''
+    os.environ['DEEPLINK_STORAGE'] = args.storage
+    if args.storage == 'sqlite':
+        path = f'/tmp/deeplink-groups-{os.getpid()}.db'
+        os.environ['DEEPLINK_SQLITE_PATH'] = path
+    import logging
+    import srver
+    logging.disable(logging.INFO)
+    
+    print(f"{'members':>7} | {'send us':>9} {'p99 us':>9} {'msg/s':>8} | {'us/memb':>8} | "
+          f"{'ver us':>8} {'list us':>8} | {'unread':>6}")
+    try:
+        for size in args.sizes:
+            run(srver, size, args.messages)
+    finally:
+        if args.storage == 'sqlite':
+            srver.store.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
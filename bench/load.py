@@ -0,0 +1,361 @@
+# Нагрузочный бенчмарк REST и WebSocket путей на синтетическом наборе данных.
+#
+#   python bench/load.py --users 1000 --chats 2000 --messages 50 --json run.json
+#   python bench/load.py --storage sqlite --compare run.json
+#
+# Набор (пользователи, приватные чаты, сообщения, реакции) пишется прямо
+# в хранилище: для памяти - снимком в каталог данных, для SQLite - в файл
+# базы. Затем запускается workers.py, и имитированные клиенты гоняют
+# настоящие эндпоинты и события Socket.IO по замкнутому циклу (следующий
+# запрос после ответа на предыдущий). Для send_message меряется доставка
+# new_message второму участнику чата, для остальных событий - подтверждение
+# обработки сервером. sync догоняет с курсора, взятого до всех сценариев
+# сокетов, - как клиент, переподключившийся после их трафика. Результат -
+# таблица и JSON для сравнения версий.
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client import Client, wait_ready  # noqa: E402
+from persistence import save_snapshot  # noqa: E402
+from storage import MemoryStorage  # noqa: E402
+
+REACTIONS = ('👍', '❤️', '😂', '🔥')
+
+
+def seed(store, options, rng):
+    # Возвращает [(chat_id, участник a, участник b, id последнего сообщения a, ... b)]
+    now = datetime.now().isoformat()
+    usernames = [f'user{i:05d}' for i in range(options.users)]
+    for username in usernames:
+        store.add_user({
+            'id': str(uuid.uuid4()),
+            'username': username,
+            'password': 'password123',
+            'nickname': f'Пользователь {username[4:]}',
+            'avatar': '',
+            'bio': '',
+            'status': 'offline',
+            'last_seen': now,
+            'created_at': now,
+            'privacy': 'public',
+            'theme': 'dark'
+        }, {})
+    
+    chats = []
+    pairs = set()
+    while len(chats) < options.chats:
+        a, b = rng.sample(usernames, 2)
+        if frozenset((a, b)) in pairs:
+            continue
+        pairs.add(frozenset((a, b)))
+        chat_id = str(uuid.uuid4())
+        store.create_chat({
+            'id': chat_id,
+            'type': 'private',
+            'name': f'{a} и {b}',
+            'members': [a, b],
+            'created_at': now,
+            'last_message': None,
+            'unread': 0
+        })
+        last = {}
+        for n in range(options.messages):
+            sender = (a, b)[n % 2]
+            message = {
+                'id': str(uuid.uuid4()),
+                'chat_id': chat_id,
+                'sender': sender,
+                'content': f'сообщение {n} в чате {len(chats)}',
+                'timestamp': now,
+                'edited': False
+            }
+            store.store_message(chat_id, message)
+            last[sender] = message['id']
+            if rng.random() < options.reactions:
+                store.toggle_reaction(message['id'], (b, a)[n % 2], rng.choice(REACTIONS))
+        # Последние пять сообщений остаются непрочитанными
+        for member in (a, b):
+            store.read_up_to(chat_id, member, max(options.messages - 5, 0))
+        chats.append((chat_id, a, b, last.get(a), last.get(b)))
+    return chats
+
+
+def prepare(options, workdir, rng):
+    started = time.perf_counter()
+    # Клиенты гоняют события без пауз - ограничения частоты выключены
+    env = dict(os.environ, DEEPLINK_STORAGE=options.storage, DEEPLINK_RATE_LIMIT_SCALE='0')
+    if options.storage == 'sqlite':
+        from storage_sqlite import SQLiteStorage
+        path = os.path.join(workdir, 'deeplink.db')
+        store = SQLiteStorage(path)
+        chats = seed(store, options, rng)
+        store.close()
+        env.update(DEEPLINK_SQLITE_PATH=path, DEEPLINK_DATA_DIR='')
+    else:
+        store = MemoryStorage()
+        chats = seed(store, options, rng)
+        data_dir = os.path.join(workdir, 'data')
+        os.makedirs(data_dir)
+        save_snapshot(data_dir, 0, store.snapshot_state())
+        env.update(DEEPLINK_DATA_DIR=data_dir)
+    print(f'seeded {options.users} users, {len(chats)} chats, {len(chats) * options.messages:,} messages '
+          f'in {time.perf_counter() - started:.1f} s', file=sys.stderr)
+    return chats, env
+
+
+def start_server(options, env):
+    command = [sys.executable, 'workers.py', '--workers', str(options.workers), '--port', str(options.port),
+               '--host', '127.0.0.1', '--async-mode', options.async_mode]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, start_new_session=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_ready(options.port, timeout=120)
+    return process
+
+
+def stop_server(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def percentile(values, q):
+    # Ближайший ранг по отсортированному списку
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / elapsed, 1),
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0
+    }
+
+
+def closed_loop(concurrency, duration, request):
+    # request(worker, n) выполняет одну операцию и возвращает задержку в мс
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    
+    def run(worker):
+        local, failed, n = [], 0, 0
+        while time.monotonic() < deadline:
+            try:
+                local.append(request(worker, n))
+            except Exception:
+                failed += 1
+            n += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+    
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def timed_get(url):
+    started = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=30) as response:
+        response.read()
+    return (time.perf_counter() - started) * 1000
+
+
+def rest_scenarios(options, chats, rng):
+    base = f'http://127.0.0.1:{options.port}'
+    
+    def chat_list(worker, n):
+        chat_id, a, b, _, _ = rng.choice(chats)
+        return timed_get(f'{base}/api/chats?username={a}')
+    
+    def history(worker, n):
+        chat_id, a, b, _, _ = rng.choice(chats)
+        return timed_get(f'{base}/api/chat/{chat_id}/messages?username={b}')
+    
+    def search(worker, n):
+        query = urllib.request.quote(rng.choice(('user0', 'user00', 'польз', 'пользователь 01')))
+        return timed_get(f'{base}/api/search?q={query}&current_user=user00000')
+    
+    return {'GET /api/chats': chat_list, 'GET /api/chat/<id>/messages': history, 'GET /api/search': search}
+
+
+def connect_pairs(options, chats):
+    # Оба участника каждого чата подключены к серверу и сидят в его комнате
+    pairs = chats[:options.sockets // 2]
+    
+    def join(chat):
+        chat_id, a, b, _, _ = chat
+        clients = []
+        for username in (a, b):
+            client = Client(options.port)
+            client.call('user_online', {'username': username})
+            client.call('join_chat', {'chat_id': chat_id})
+            clients.append(client)
+        return clients
+    
+    with ThreadPoolExecutor(16) as pool:
+        return [(chat, *clients) for chat, clients in zip(pairs, pool.map(join, pairs))]
+
+
+def drain(connected):
+    for _, sender, receiver in connected:
+        for client in (sender, receiver):
+            while not client.events.empty():
+                client.events.get_nowait()
+
+
+def socket_scenarios(connected):
+    # Курсоры ленты до трафика сценариев
+    cursors = [sender.call('sync', {'username': chat[1]})[0]['cursor'] for chat, sender, _ in connected]
+    
+    def send_message(worker, n):
+        (chat_id, a, b, _, _), sender, receiver = connected[worker]
+        content = f'load {worker}:{n}'
+        sent = time.perf_counter()
+        sender.emit('send_message', {'chat_id': chat_id, 'sender': a, 'content': content})
+        received, _ = receiver.wait('new_message', lambda data: data['content'] == content, timeout=30)
+        return (received - sent) * 1000
+    
+    def acked(event, payload):
+        def request(worker, n):
+            chat, sender, _ = connected[worker]
+            started = time.perf_counter()
+            sender.call(event, payload(chat, n))
+            return (time.perf_counter() - started) * 1000
+        return request
+    
+    def sync(worker, n):
+        chat, sender, _ = connected[worker]
+        started = time.perf_counter()
+        sender.call('sync', {'username': chat[1], 'since': cursors[worker]})
+        return (time.perf_counter() - started) * 1000
+    
+    return {
+        'ws send_message -> new_message': send_message,
+        'ws typing': acked('typing', lambda chat, n: {
+            'chat_id': chat[0], 'username': chat[1], 'is_typing': n % 4 != 3}),
+        'ws read_up_to': acked('read_up_to', lambda chat, n: {
+            'chat_id': chat[0], 'username': chat[1], 'seq': n}),
+        'ws edit_message': acked('edit_message', lambda chat, n: {
+            'chat_id': chat[0], 'username': chat[1], 'message_id': chat[3], 'content': f'правка {n}'}),
+        'ws sync': sync
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    print(f'{"scenario":<32} {"ops/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>6}')
+    for name, result in results.items():
+        line = (f'{name:<32} {result["throughput"]:>9,.0f} {result["p50_ms"]:>8.2f} '
+                f'{result["p95_ms"]:>8.2f} {result["p99_ms"]:>8.2f} {result["errors"]:>6}')
+        old = (baseline or {}).get(name)
+        if old and old['throughput'] and old['p99_ms']:
+            line += (f'   vs base: ops/s {result["throughput"] / old["throughput"] - 1:+.0%}, '
+                     f'p99 {result["p99_ms"] / old["p99_ms"] - 1:+.0%}')
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storage', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=50, help='сообщений в чате')
+    parser.add_argument('--reactions', type=float, default=0.1, help='доля сообщений с реакцией')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--async-mode', default='threading')
+    parser.add_argument('--port', type=int, default=10400)
+    parser.add_argument('--concurrency', type=int, default=8, help='клиентов REST в замкнутом цикле')
+    parser.add_argument('--sockets', type=int, default=100, help='подключенных сокетов (пары участников)')
+    parser.add_argument('--duration', type=float, default=5.0, help='секунд на сценарий')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='записать результат в файл')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    options = parser.parse_args()
+    if options.workers > 1 and options.storage != 'sqlite':
+        parser.error('для нескольких воркеров нужно --storage sqlite')
+    
+    rng = random.Random(options.seed)
+    workdir = tempfile.mkdtemp(prefix='deeplink-load-')
+    process = None
+    try:
+        chats, env = prepare(options, workdir, rng)
+        process = start_server(options, env)
+        results = {}
+        for name, request in rest_scenarios(options, chats, rng).items():
+            results[name] = closed_loop(options.concurrency, options.duration, request)
+        
+        connected = connect_pairs(options, chats)
+        for name, request in socket_scenarios(connected).items():
+            drain(connected)
+            results[name] = closed_loop(len(connected), options.duration, request)
+        for _, sender, receiver in connected:
+            sender.close()
+            receiver.close()
+    finally:
+        if process:
+            stop_server(process)
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    run = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'options': {key: value for key, value in vars(options).items() if key not in ('json', 'compare')}
+        },
+        'results': results
+    }
+    baseline = None
+    if options.compare:
+        with open(options.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as f:
+            json.dump(run, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
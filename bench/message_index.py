@@ -0,0 +1,122 @@
+# Бенчмарк индекса сообщений: задержка delete/react/read/edit при росте истории.
+#
+#   python bench/message_index.py --sizes 10000 100000 1000000
+#
+# Задержка должна оставаться примерно постоянной при любом объёме истории.
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import srver  # noqa: E402
+from storage import MemoryStorage  # noqa: E402
+
+CHATS = 1000
+
+
+def reset_state():
+    srver.store = MemoryStorage()
+
+
+def seed(total):
+    reset_state()
+    chat_ids = []
+    for i in range(CHATS):
+        chat_id = str(uuid.uuid4())
+        members = [f'user{i}a', f'user{i}b']
+        srver.store.create_chat({
+            'id': chat_id,
+            'type': 'private',
+            'name': f'chat {i}',
+            'members': members,
+            'created_at': datetime.now().isoformat(),
+            'last_message': None,
+            'unread': 0
+        })
+        chat_ids.append(chat_id)
+    
+    now = datetime.now().isoformat()
+    ids = []
+    for n in range(total):
+        chat_id = chat_ids[n % CHATS]
+        message = {
+            'id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'sender': f'user{n % CHATS}{"ab"[n % 2]}',
+            'content': f'сообщение {n}',
+            'timestamp': now,
+            'edited': False
+        }
+        srver.store.store_message(chat_id, message)
+        ids.append(message['id'])
+    return ids
+
+
+def measure(fn, samples):
+    timings = []
+    for arg in samples:
+        start = time.perf_counter()
+        fn(arg)
+        timings.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(timings), statistics.mean(timings)
+
+
+def run(total, ops):
+    ids = seed(total)
+    http = srver.app.test_client()
+    ws = srver.socketio.test_client(srver.app)
+    
+    def target(message_id):
+        chat_id, msg = srver.store.find_message(message_id)
+        return chat_id, msg['sender']
+    
+    def react(message_id):
+        _, sender = target(message_id)
+        http.post('/api/message/react', json={
+            'message_id': message_id, 'username': sender, 'reaction': '👍'})
+    
+    def edit(message_id):
+        chat_id, sender = target(message_id)
+        ws.emit('edit_message', {
+            'message_id': message_id, 'chat_id': chat_id,
+            'username': sender, 'content': 'правка'})
+    
+    def read(message_id):
+        chat_id, sender = target(message_id)
+        reader = sender[:-1] + ('b' if sender.endswith('a') else 'a')
+        ws.emit('read_message', {
+            'message_id': message_id, 'chat_id': chat_id, 'username': reader})
+    
+    def delete(message_id):
+        _, sender = target(message_id)
+        http.post('/api/message/delete', json={
+            'message_id': message_id, 'username': sender})
+    
+    rng = random.Random(total)
+    results = {}
+    for name, fn in (('react', react), ('edit', edit), ('read', read), ('delete', delete)):
+        results[name] = measure(fn, rng.sample(ids, ops))
+    ws.disconnect()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--ops', type=int, default=500)
+    args = parser.parse_args()
+    
+    print(f"{'messages':>10} {'op':>7} {'p50 us':>9} {'mean us':>9}")
+    for total in args.sizes:
+        for name, (p50, mean) in run(total, args.ops).items():
+            print(f'{total:>10} {name:>7} {p50:>9.1f} {mean:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# Бенчмарк памяти на сообщение: компактные записи MemoryStorage против
+# прежних словарей в формате API.
+#
+#   python bench/message_memory.py --sizes 1000000 10000000
+#
+# Каждый прогон - отдельный процесс, память - прирост RSS после заполнения.
+# Сообщения приходят как из разбора JSON (свои строки chat_id, sender и
+# времени у каждого), словари хранятся как раньше: в списке чата и в индексе
+# по id кортежем (chat_id, сообщение). Отдельно меряется чтение страницы
+# истории - цена сборки словарей API на выходе.
+import argparse
+import gc
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MemoryStorage  # noqa: E402
+
+CHATS = 1000
+PAGE = 50
+
+
+class DictLayout:
+    # Прежнее представление сообщений в MemoryStorage
+    def __init__(self):
+        self.messages = defaultdict(list)
+        self.message_index = {}
+        self.chat_seq = defaultdict(int)
+    
+    def store_message(self, chat_id, message):
+        self.chat_seq[chat_id] += 1
+        message['seq'] = self.chat_seq[chat_id]
+        self.messages[chat_id].append(message)
+        self.message_index[message['id']] = (chat_id, message)
+    
+    def message_page(self, chat_id, limit=PAGE):
+        return [msg for msg in self.messages[chat_id][-limit:] if 'deleted' not in msg]
+
+
+def rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def fill(store, total):
+    chat_ids = [str(uuid.uuid4()) for _ in range(CHATS)]
+    if isinstance(store, MemoryStorage):
+        for n, chat_id in enumerate(chat_ids):
+            store.create_chat({'id': chat_id, 'type': 'private', 'name': f'chat {n}',
+                               'members': [f'user{n}a', f'user{n}b'], 'created_at': datetime.now().isoformat(),
+                               'last_message': None, 'unread': 0})
+    started = datetime.now()
+    for n in range(total):
+        chat_id = chat_ids[n % CHATS]
+        payload = json.dumps({
+            'id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'sender': f'user{n % CHATS}{"ab"[n // CHATS % 2]}',
+            'content': f'сообщение {n}',
+            'timestamp': (started + timedelta(milliseconds=n)).isoformat(),
+            'edited': False
+        })
+        store.store_message(chat_id, json.loads(payload))
+    return chat_ids
+
+
+def run_one(layout, total):
+    gc.collect()
+    before = rss()
+    store = MemoryStorage() if layout == 'record' else DictLayout()
+    started = time.perf_counter()
+    chat_ids = fill(store, total)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    used = rss() - before
+    timings = []
+    for chat_id in chat_ids[:200]:
+        page_started = time.perf_counter()
+        store.message_page(chat_id, limit=PAGE)
+        timings.append((time.perf_counter() - page_started) * 1e6)
+    print(json.dumps({'bytes': used / total, 'rss': used, 'fill': elapsed, 'page_us': statistics.median(timings)}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--layouts', default='dict,record')
+    parser.add_argument('--one', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.one:
+        run_one(args.one[0], int(args.one[1]))
+        return
+    
+    print(f"{'messages':>10} {'layout':>7} {'B/msg':>7} {'RSS MiB':>8} {'fill s':>7} {'page us':>8}")
+    for total in args.sizes:
+        for layout in args.layouts.split(','):
+            result = subprocess.run([sys.executable, __file__, '--one', layout, str(total)],
+                                    capture_output=True, text=True)
+            if result.returncode:
+                # Например, не хватило памяти
+                print(f'{total:>10} {layout:>7} failed: {result.stderr.strip().splitlines()[-1:]}')
+                continue
+            row = json.loads(result.stdout)
+            print(f"{total:>10} {layout:>7} {row['bytes']:>7.0f} {row['rss'] / 2 ** 20:>8.0f} "
+                  f"{row['fill']:>7.1f} {row['page_us']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# Бенчмарк поиска по сообщениям: обратный индекс против прохода по всем
+# сообщениям чатов пользователя.
+#
+#   python bench/message_search.py --sizes 1000000 10000000
+#
+# Каждый размер - отдельный процесс, размер индекса - прирост RSS после
+# построения и байты массивов индекса. Текст - русские слова с окончаниями,
+# частоты по закону Ципфа. Пользователь видит CHATS_PER_USER чатов, запросы:
+# частое слово, редкое слово, два слова, слово в другой форме (по основе).
+# Проход без индекса держит тексты только чатов проверяемых пользователей.
+# --backend sqlite меряет то же на SQLiteStorage (FTS5); сообщения идут через
+# store_message, поэтому построение заметно дольше.
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import matches, MessageSearchIndex, query_terms  # noqa: E402
+from storage_sqlite import SQLiteStorage  # noqa: E402
+
+MESSAGES_PER_CHAT = 1000
+CHATS_PER_USER = 20
+USERS = 10  # Пользователей, для которых меряются запросы
+LIMIT = 50
+SYLLABLES = ['ра', 'бо', 'та', 'про', 'ект', 'ве', 'сна', 'до', 'ма', 'ли', 'ст', 'ко', 'ни', 'га', 'мир',
+             'пла', 'но', 'ве', 'ре', 'зу', 'ль', 'тат', 'сло', 'во', 'де', 'ло']
+ENDINGS = ['', 'а', 'у', 'ом', 'ы', 'ов', 'ами', 'е', 'и']
+
+
+def vocabulary(rng, size):
+    stems = []
+    seen = set()
+    while len(stems) < size:
+        stem = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if stem not in seen:
+            seen.add(stem)
+            stems.append(stem)
+    return stems
+
+
+def texts(rng, stems, weights, count):
+    for _ in range(count):
+        yield ' '.join(stem + rng.choice(ENDINGS)
+                       for stem in rng.choices(stems, cum_weights=weights, k=rng.randint(4, 12)))
+
+
+def rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def scan_search(chat_texts, query, chat_ids):
+    # Без индекса: все сообщения чатов пользователя от новых к старым
+    terms = query_terms(query)
+    found = []
+    for doc, chat_id, seq, text in sorted(((doc, chat_id, seq, text) for chat_id in chat_ids
+                                           for seq, (doc, text) in enumerate(chat_texts[chat_id], 1)),
+                                          reverse=True):
+        if matches(text, terms):
+            found.append((chat_id, seq))
+            if len(found) == LIMIT:
+                break
+    return found
+
+
+def timed(fn, runs):
+    timings = []
+    for args in runs:
+        started = time.perf_counter()
+        fn(*args)
+        timings.append((time.perf_counter() - started) * 1e3)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+class SQLiteIndex:
+    # Тот же интерфейс, что у MessageSearchIndex, поверх SQLiteStorage
+    def __init__(self, path, chats, users):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        self.path = path
+        self.store = SQLiteStorage(path)
+        self.chat_ids = [str(uuid.uuid4()) for _ in range(chats)]
+        self.numbers = {chat_id: number for number, chat_id in enumerate(self.chat_ids)}
+        # Проверяемые пользователи - участники своих чатов
+        roles = {}
+        for user, chat_list in enumerate(users):
+            for chat in chat_list:
+                roles.setdefault(chat, {})[f'user{user}'] = 'member'
+        for number, chat_id in enumerate(self.chat_ids):
+            self.store.create_chat({'id': chat_id, 'type': 'group', 'name': f'chat {number}',
+                                    'created_at': datetime.now().isoformat(), 'last_message': None, 'unread': 0},
+                                   None, roles.get(number, {'owner': 'owner'}))
+        self.users = {tuple(chat_list): f'user{user}' for user, chat_list in enumerate(users)}
+    
+    def add_many(self, items):
+        now = datetime.now().isoformat()
+        for chat, _, text in items:
+            self.store.store_message(self.chat_ids[chat], {'id': str(uuid.uuid4()), 'chat_id': self.chat_ids[chat],
+                                                           'sender': 'owner', 'content': text, 'timestamp': now})
+        self.store.flush()
+    
+    def search(self, query, chat_list, limit):
+        found, cursor = self.store.search_messages(self.users[tuple(chat_list)], query, limit=limit)
+        return [(self.numbers[msg['chat_id']], msg['seq']) for msg in found], cursor
+    
+    def stats(self):
+        self.store.close()
+        return {'array_bytes': os.path.getsize(self.path), 'terms': 0, 'postings': 0}
+
+
+def run_one(total, backend):
+    rng = random.Random(total)
+    stems = vocabulary(rng, 50_000)
+    weights = list(accumulate(1 / (rank + 1) for rank in range(len(stems))))
+    chats = max(1, total // MESSAGES_PER_CHAT)
+    users = [rng.sample(range(chats), CHATS_PER_USER) for _ in range(USERS)]
+    watched = {chat for chat_list in users for chat in chat_list}
+    chat_texts = {chat: [] for chat in watched}
+    
+    def messages():
+        # Сообщения по очереди во все чаты, как при живой переписке
+        for doc, text in enumerate(texts(rng, stems, weights, total)):
+            chat = doc % chats
+            if chat in chat_texts:
+                chat_texts[chat].append((doc, text))
+            yield chat, doc // chats + 1, text
+    
+    gc.collect()
+    before = rss()
+    if backend == 'sqlite':
+        index = SQLiteIndex(f'/tmp/deeplink-search-{os.getpid()}.db', chats, users)
+    else:
+        index = MessageSearchIndex()
+    started = time.perf_counter()
+    index.add_many(messages())
+    build = time.perf_counter() - started
+    gc.collect()
+    used = rss() - before
+    # Тексты просмотренных чатов в индекс не входят
+    used -= sum(sys.getsizeof(text) + 100 for texts_ in chat_texts.values() for _, text in texts_)
+    
+    queries = {
+        'common word': stems[0],
+        'rare word': stems[5000] + 'ами',
+        'two words': f'{stems[3]}ы {stems[200]}',
+        'other form': stems[40] + 'ов'
+    }
+    results = {'bytes': used, 'build': build, 'queries': {}}
+    for name, query in queries.items():
+        runs = [(query, chat_list) for chat_list in users] * 5
+        for query_, chat_list in runs[:USERS]:
+            hits, _ = index.search(query_, chat_list, limit=LIMIT)
+            assert hits == scan_search(chat_texts, query_, chat_list), query_
+        results['queries'][name] = {
+            'index': timed(lambda q, c: index.search(q, c, limit=LIMIT), runs),
+            'scan': timed(lambda q, c: scan_search(chat_texts, q, c), runs[:USERS])
+        }
+    # Для SQLite - размер файла базы вместе с сообщениями
+    results['stats'] = index.stats()
+    print(json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--backend', choices=('index', 'sqlite'), default='index')
+    parser.add_argument('--one', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.one:
+        run_one(args.one, args.backend)
+        return
+    
+    for total in args.sizes:
+        result = subprocess.run([sys.executable, __file__, '--one', str(total), '--backend', args.backend],
+                                capture_output=True, text=True)
+        if result.returncode:
+            print(f'{total:>10} failed: {result.stderr.strip().splitlines()[-1:]}')
+            continue
+        row = json.loads(result.stdout)
+        stats = row['stats']
+        if args.backend == 'sqlite':
+            print(f"{total:>10} messages: build {row['build']:.0f} s, "
+                  f"database {stats['array_bytes'] / 2 ** 20:.0f} MiB with messages")
+        else:
+            print(f"{total:>10} messages: build {row['build']:.0f} s, RSS {row['bytes'] / 2 ** 20:.0f} MiB "
+                  f"({row['bytes'] / total:.0f} B/msg), arrays {stats['array_bytes'] / 2 ** 20:.0f} MiB, "
+                  f"{stats['terms']:,} terms, {stats['postings']:,} postings")
+        print(f"{'query':>14} {'index p50':>10} {'index p99':>10} {'scan p50':>9} {'scan p99':>9}  (ms)")
+        for name, timing in row['queries'].items():
+            print(f"{name:>14} {timing['index'][0]:>10.3f} {timing['index'][1]:>10.3f} "
+                  f"{timing['scan'][0]:>9.1f} {timing['scan'][1]:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# Бенчмарк уровней хранения сообщений: все в памяти против бюджета с
+# вытеснением на диск.
+#
+#   python bench/message_tiers.py --messages 1000000 --chats 10000 --budget-mb 64
+#
+# Каждый режим - отдельный процесс с MemoryStorage и журналом во временном
+# каталоге (снимки выключены). Сообщения расходятся по чатам по закону Ципфа:
+# немного активных чатов и длинный хвост редко тронутых. Уборка (compact)
+# идет через каждые COMPACT_EVERY сообщений, как фоновая задача сервера.
+# Меряются прирост анонимной памяти (страницы сегментов через mmap - это
+# кэш файлов, их ядро может отдать), скорость отправки и задержки: последняя страница активного
+# чата, первое открытие выгруженного чата (подкачка), страница глубоко в
+# истории и find_message по старому сообщению.
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MemoryStorage  # noqa: E402
+
+WORDS = ['привет', 'проект', 'встреча', 'завтра', 'отчет', 'готов', 'посмотри', 'пожалуйста', 'сервер',
+         'релиз', 'задача', 'спасибо', 'вечером', 'созвон', 'документ', 'исправил']
+SAMPLES = 200
+COMPACT_EVERY = 50_000
+
+
+def rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) * 1024
+
+
+def timed(fn, args):
+    timings = []
+    for arg in args:
+        started = time.perf_counter()
+        fn(arg)
+        timings.append((time.perf_counter() - started) * 1e6)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+def run_one(options, budget):
+    rng = random.Random(42)
+    directory = tempfile.mkdtemp(prefix='deeplink-tiers-')
+    try:
+        gc.collect()
+        before = rss()
+        store = MemoryStorage()
+        store.open(directory, hot_bytes=budget, snapshot_every=0)
+        chats = [str(uuid.uuid4()) for _ in range(options.chats)]
+        for number, chat_id in enumerate(chats):
+            members = [f'user{number:05d}', f'user{number + 1:05d}']
+            store.create_chat({'id': chat_id, 'type': 'private', 'name': '', 'members': members,
+                               'created_at': datetime.now().isoformat(), 'last_message': None, 'unread': 0})
+        weights = list(accumulate(1 / (rank + 1) for rank in range(len(chats))))
+        started_at = datetime(2026, 1, 1)
+        first_ids = {}
+        sends = []
+        compacting = 0
+        started = time.perf_counter()
+        for n, chat_id in enumerate(rng.choices(chats, cum_weights=weights, k=options.messages)):
+            message_id = str(uuid.uuid4())
+            first_ids.setdefault(chat_id, message_id)
+            message = {
+                'id': message_id, 'chat_id': chat_id, 'sender': store.chats[chat_id]['members'][n % 2],
+                'content': ' '.join(rng.choices(WORDS, k=rng.randint(3, 10))),
+                'timestamp': (started_at + timedelta(milliseconds=n)).isoformat()
+            }
+            sent = time.perf_counter()
+            store.store_message(chat_id, message)
+            sends.append((time.perf_counter() - sent) * 1e6)
+            if n % COMPACT_EVERY == COMPACT_EVERY - 1:
+                sent = time.perf_counter()
+                store.compact(time.time())
+                compacting += time.perf_counter() - sent
+        build = time.perf_counter() - started
+        sends.sort()
+        store.journal.log.wait(store.journal.log.last_lsn)
+        gc.collect()
+        used = rss() - before
+        
+        tiers = store.tiers
+        # Активные чаты - первые по закону Ципфа; выгруженные - те, что есть только
+        # на диске (без бюджета - самые редкие); самые длинные - для страниц из начала истории
+        deep = chats[:20]
+        hot = chats[20:20 + SAMPLES]
+        cold = [chat_id for chat_id in chats if chat_id in tiers.blocks and chat_id not in tiers.hot]
+        cold = rng.sample(cold, min(SAMPLES, len(cold))) or chats[-SAMPLES:]
+        old_ids = [first_ids[chat_id] for chat_id in rng.sample(list(first_ids), SAMPLES)]
+        results = {
+            'bytes': used,
+            'build': build,
+            'compact': compacting,
+            'stats': tiers.stats()['size'],
+            'latency': {
+                'send': (statistics.median(sends), sends[int(len(sends) * 0.99) - 1]),
+                'hot page': timed(lambda chat_id: store.message_page(chat_id), hot),
+                'cold chat open': timed(lambda chat_id: store.message_page(chat_id), cold),
+                'deep history page': timed(lambda chat_id: store.message_page(chat_id, before=100), deep * 10),
+                'find old message': timed(store.find_message, old_ids)
+            },
+            'events': tiers.stats()['events']
+        }
+        store.close()
+        print(json.dumps(results))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--chats', type=int, default=10_000)
+    parser.add_argument('--budget-mb', type=int, default=64)
+    parser.add_argument('--one', type=int, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    
+    if options.one is not None:
+        run_one(options, options.one)
+        return
+    
+    print(f'{options.messages:,} messages in {options.chats:,} chats')
+    for name, budget in (('all in memory', 0), (f'budget {options.budget_mb} MiB', options.budget_mb * 2 ** 20)):
+        result = subprocess.run([sys.executable, __file__, '--messages', str(options.messages),
+                                 '--chats', str(options.chats), '--one', str(budget)],
+                                capture_output=True, text=True)
+        if result.returncode:
+            print(f'{name}: failed: {result.stderr.strip().splitlines()[-1:]}')
+            continue
+        row = json.loads(result.stdout)
+        stats = row['stats']
+        print(f"\n{name}: RSS +{row['bytes'] / 2 ** 20:.0f} MiB, {options.messages / row['build']:,.0f} msg/s "
+              f"(compact {row['compact']:.1f} s), "
+              f"hot {stats['hot_bytes'] / 2 ** 20:.0f} MiB in {stats['hot_chats']:,} chats, "
+              f"cold {stats['cold_messages']:,} messages ({stats['cold_bytes'] / 2 ** 20:.0f} MiB on disk, "
+              f"id table {stats['id_table_bytes'] / 2 ** 20:.0f} MiB)")
+        print(f"{'':>18} {'p50 us':>9} {'p99 us':>9}")
+        for label, (p50, p99) in row['latency'].items():
+            print(f'{label:>18} {p50:9.1f} {p99:9.1f}')
+        print('  ' + ', '.join(f'{event} {count:,}' for event, count in row['events'].items()))
+
+
+if __name__ == '__main__':
+    main()
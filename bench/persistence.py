@@ -0,0 +1,127 @@
+# Бенчмарк журнала и снимков: пропускная способность записи и время рестарта.
+#
+#   python bench/persistence.py --messages 10000000 --dir /var/tmp/deeplink-bench
+#
+# Для 10M сообщений процессу нужно порядка 10+ ГБ памяти (само состояние плюс
+# копия страниц при снимке), поэтому по умолчанию размер меньше.
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import srver  # noqa: E402
+
+CHATS = 10_000
+
+RESTART = """
+import sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+import srver
+srver.open_persistence({directory!r}, snapshot_every=0)
+print(time.perf_counter() - started, sum(len(v) for v in srver.store.messages.values()))
+"""
+
+
+def make_chats():
+    chat_ids = []
+    for i in range(CHATS):
+        chat_id = str(uuid.uuid4())
+        srver.store.create_chat({
+            'id': chat_id,
+            'type': 'private',
+            'name': f'chat {i}',
+            'members': [f'user{i}a', f'user{i}b'],
+            'created_at': datetime.now().isoformat(),
+            'last_message': None,
+            'unread': 0
+        })
+        chat_ids.append(chat_id)
+    return chat_ids
+
+
+def send(chat_ids, n):
+    chat_id = chat_ids[n % CHATS]
+    srver.store.store_message(chat_id, {
+        'id': str(uuid.uuid4()),
+        'chat_id': chat_id,
+        'sender': f'user{n % CHATS}a',
+        'content': f'Тестовое сообщение номер {n}',
+        'timestamp': datetime.now().isoformat(),
+        'edited': False
+    })
+
+
+def restart(directory):
+    out = subprocess.run([sys.executable, '-c', RESTART.format(root=ROOT, directory=directory)],
+                         capture_output=True, text=True, check=True).stdout.split()
+    return float(out[0]), int(out[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--tail', type=int, default=100_000, help='записей журнала после снимка')
+    parser.add_argument('--sync-writers', type=int, default=8)
+    parser.add_argument('--dir', default=os.path.join(ROOT, 'bench-data'))
+    args = parser.parse_args()
+    
+    shutil.rmtree(args.dir, ignore_errors=True)
+    store = srver.open_persistence(args.dir, snapshot_every=0)
+    chat_ids = make_chats()
+    
+    # 1. Асинхронный group commit: обработчик не ждет fsync
+    total = args.messages - args.tail
+    started = time.perf_counter()
+    for n in range(total):
+        send(chat_ids, n)
+    store.log.wait(store.log.last_lsn)
+    elapsed = time.perf_counter() - started
+    print(f'write (group commit):  {total / elapsed:>10,.0f} msg/s, {store.log.fsyncs} fsync, '
+          f'{total / max(store.log.fsyncs, 1):.0f} msg/fsync')
+    
+    # 2. Синхронный commit: каждый писатель ждет fsync, группы общие
+    store.sync_commit = True
+    fsyncs = store.log.fsyncs
+    per_writer = 2000
+    
+    def writer(k):
+        for n in range(per_writer):
+            send(chat_ids, k * per_writer + n)
+    
+    threads = [threading.Thread(target=writer, args=(k,)) for k in range(args.sync_writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    synced = per_writer * args.sync_writers
+    print(f'write (sync, {args.sync_writers} writers): {synced / elapsed:>8,.0f} msg/s, '
+          f'{synced / max(store.log.fsyncs - fsyncs, 1):.1f} msg/fsync')
+    store.sync_commit = False
+    
+    # 3. Снимок и хвост журнала после него
+    started = time.perf_counter()
+    store.snapshot(wait=True)
+    print(f'snapshot:              {time.perf_counter() - started:.1f} s, '
+          f'{sum(os.path.getsize(os.path.join(args.dir, f)) for f in os.listdir(args.dir) if f.startswith("snapshot")) / 2**20:.0f} MiB')
+    for n in range(args.tail):
+        send(chat_ids, total + n)
+    store.close()
+    
+    # 4. Рестарт: снимок (mmap) + воспроизведение хвоста в отдельном процессе
+    seconds, loaded = restart(args.dir)
+    print(f'restart (snapshot + {args.tail:,} tail): {seconds:.1f} s, {loaded:,} messages')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# Бенчмарк сериализации: стандартный json против orjson и MessagePack.
+#
+#   python bench/serialization.py --connections 200 --messages 50
+#
+# Сначала в процессе: цена кодирования типичных данных (событие new_message,
+# страница истории, список чатов) и пакета Socket.IO, размер результата.
+# Затем на живом сервере (workers.py): в чате сидят N сокетов, отправитель
+# шлет M сообщений, меряется процессорное время сервера (все процессы,
+# utime + stime) на одну доставку и на одно отправленное сообщение.
+# Режимы задаются переменными DEEPLINK_JSON и DEEPLINK_SOCKETIO_SERIALIZER.
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import timeit
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import msgpack  # noqa: E402
+import orjson  # noqa: E402
+from socketio import packet  # noqa: E402
+
+from client import Client, post, wait_ready  # noqa: E402
+from serialization import FastJSON  # noqa: E402
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def message(n):
+    return {
+        'id': str(uuid.uuid4()),
+        'chat_id': str(uuid.uuid4()),
+        'seq': n,
+        'sender': 'user00042',
+        'content': f'Привет! Как дела с проектом? Сообщение номер {n}',
+        'timestamp': datetime.now().isoformat(),
+        'edited': False,
+        'cursor': f'123456789:{n}'
+    }
+
+
+def payloads():
+    chats = [{
+        'id': str(uuid.uuid4()),
+        'type': 'private',
+        'name': f'Чат {n}',
+        'members': ['user00042', f'user{n:05d}'],
+        'created_at': datetime.now().isoformat(),
+        'last_message': message(n),
+        'unread': n % 3,
+        'other_user': {'username': f'user{n:05d}', 'nickname': f'Пользователь {n}', 'avatar': '',
+                       'status': 'online', 'last_seen': datetime.now().isoformat()}
+    } for n in range(20)]
+    return {
+        'new_message': message(1),
+        'history page (50)': {'success': True, 'messages': [message(n) for n in range(50)], 'has_more': True},
+        'chat list (20)': {'success': True, 'chats': chats}
+    }
+
+
+CODECS = {
+    'json': (lambda obj: json.dumps(obj).encode('utf-8'), json.loads),
+    'orjson': (orjson.dumps, orjson.loads),
+    'msgpack': (msgpack.packb, msgpack.unpackb)
+}
+
+
+def best_us(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def micro():
+    print(f"{'payload':<18} {'codec':<8} {'bytes':>7} {'encode us':>10} {'decode us':>10}")
+    for name, obj in payloads().items():
+        number = 20000 if name == 'new_message' else 500
+        for codec, (encode, decode) in CODECS.items():
+            encoded = encode(obj)
+            print(f'{name:<18} {codec:<8} {len(encoded):>7} {best_us(lambda: encode(obj), number):>10.2f} '
+                  f'{best_us(lambda: decode(encoded), number):>10.2f}')
+    
+    # Пакет события так, как его кодирует сервер перед рассылкой
+    data = ['new_message', message(1)]
+    print(f"\n{'socket.io packet':<18} {'bytes':>7} {'encode us':>10}")
+    default_json = packet.Packet.json
+    for name, module in (('json', default_json), ('orjson', FastJSON)):
+        packet.Packet.json = module
+        encoded = packet.Packet(packet.EVENT, data=data).encode()
+        print(f'{name:<18} {len(encoded.encode("utf-8")):>7} '
+              f'{best_us(lambda: packet.Packet(packet.EVENT, data=data).encode(), 20000):>10.2f}')
+    packet.Packet.json = default_json
+    from socketio.msgpack_packet import MsgPackPacket
+    encoded = MsgPackPacket(packet.EVENT, data=data).encode()
+    print(f'{"msgpack":<18} {len(encoded):>7} '
+          f'{best_us(lambda: MsgPackPacket(packet.EVENT, data=data).encode(), 20000):>10.2f}')
+
+
+def tree_cpu(pid):
+    # Процессорное время процесса и всех его потомков, с
+    children = {}
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            children.setdefault(int(fields[1]), []).append(int(entry))
+            stats[int(entry)] = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    total, stack = 0.0, [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, ()))
+        total += stats.get(current, 0.0)
+    return total
+
+
+def fanout(options, json_mode, serializer, workers, port):
+    env = dict(os.environ, DEEPLINK_DATA_DIR='', DEEPLINK_JSON=json_mode, DEEPLINK_SOCKETIO_SERIALIZER=serializer,
+               DEEPLINK_RATE_LIMIT_SCALE='0')
+    if workers > 1:
+        path = f'/tmp/deeplink-serialization-{port}.db'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        env.update(DEEPLINK_STORAGE='sqlite', DEEPLINK_SQLITE_PATH=path)
+    process = subprocess.Popen([sys.executable, 'workers.py', '--workers', str(workers), '--port', str(port),
+                                '--host', '127.0.0.1'], cwd=ROOT, env=env, start_new_session=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port)
+        for username in ('alice', 'bob'):
+            post(port, '/api/register', {'username': username, 'password': 'password123'})
+        chat_id = post(port, '/api/chat/create', {'user1': 'alice', 'user2': 'bob'})['chat_id']
+        with ThreadPoolExecutor(32) as pool:
+            clients = list(pool.map(lambda _: Client(port, serializer=serializer), range(options.connections)))
+            list(pool.map(lambda client: client.call('join_chat', {'chat_id': chat_id}), clients))
+        time.sleep(1)
+        cpu = tree_cpu(process.pid)
+        started = time.perf_counter()
+        for n in range(options.messages):
+            clients[0].emit('send_message', {'chat_id': chat_id, 'sender': 'alice', 'content': message(n)['content']})
+        for client in clients:
+            for _ in range(options.messages):
+                client.wait('new_message', timeout=120)
+        elapsed = time.perf_counter() - started
+        cpu = tree_cpu(process.pid) - cpu
+        for client in clients:
+            client.close()
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+    deliveries = options.connections * options.messages
+    print(f'{json_mode:<7} {serializer:<8} {workers:>7} | {cpu * 1e6 / deliveries:8.1f} us/delivery | '
+          f'{cpu * 1e3 / options.messages:8.2f} ms/message | {deliveries / elapsed:8,.0f} deliveries/s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=10400)
+    parser.add_argument('--connections', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--workers', default='1,2')
+    parser.add_argument('--modes', default='stdlib:json,orjson:json,orjson:msgpack')
+    parser.add_argument('--skip-micro', action='store_true')
+    options = parser.parse_args()
+    
+    if not options.skip_micro:
+        micro()
+        print()
+    print(f"{'json':<7} {'socket':<8} {'workers':>7} | server CPU")
+    port = options.port
+    for workers in map(int, options.workers.split(',')):
+        for mode in options.modes.split(','):
+            json_mode, serializer = mode.split(':')
+            fanout(options, json_mode, serializer, workers, port)
+            port += 1
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# Сравнение режимов запуска: сервер разработки (python srver.py, отладчик
+# и перезагрузка) против боевого (workers.py).
+#
+#   python bench/serving.py --connections 500 --http-clients 16
+#
+# Для каждого режима: пропускная способность HTTP (список чатов), открытие
+# N одновременных сокетов, память процессов сервера на сокет и рассылка
+# сообщений в чат, где сидят все N сокетов.
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client import Client, Refused, get, post, wait_ready  # noqa: E402
+
+
+def start(mode, port, options):
+    env = dict(os.environ, DEEPLINK_DATA_DIR='', DEEPLINK_PORT=str(port))
+    if mode == 'dev':
+        command = [sys.executable, 'srver.py']
+    else:
+        command = [sys.executable, 'workers.py', '--workers', str(options.workers),
+                   '--async-mode', options.async_mode, '--max-connections', str(options.max_connections)]
+        if options.workers > 1:
+            env['DEEPLINK_STORAGE'] = 'sqlite'
+            env['DEEPLINK_SQLITE_PATH'] = os.path.join('/tmp', f'deeplink-serving-{port}.db')
+    process = subprocess.Popen(command, cwd=ROOT, env=env, start_new_session=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_ready(port)
+    return process
+
+
+def stop(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def tree_rss(pid):
+    # RSS процесса и всех его потомков, МиБ
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except OSError:
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, ()))
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def http_load(port, clients, duration):
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    
+    def worker():
+        local = []
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/api/chats?username=alice') as response:
+                response.read()
+            local.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(local)
+    
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return len(latencies) / duration, statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def open_sockets(port, count):
+    def connect(_):
+        try:
+            return Client(port)
+        except Refused:
+            return None
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(32) as pool:
+        results = list(pool.map(connect, range(count)))
+    elapsed = time.perf_counter() - started
+    clients = [client for client in results if client]
+    return clients, count - len(clients), elapsed
+
+
+def fanout(port, clients, messages):
+    chat_id = post(port, '/api/chat/create', {'user1': 'alice', 'user2': 'bob'})['chat_id']
+    with ThreadPoolExecutor(32) as pool:
+        list(pool.map(lambda client: client.call('join_chat', {'chat_id': chat_id}), clients))
+    started = time.perf_counter()
+    for n in range(messages):
+        clients[0].emit('send_message', {'chat_id': chat_id, 'sender': 'alice', 'content': f'fanout {n}'})
+    for client in clients:
+        for _ in range(messages):
+            client.wait('new_message', timeout=60)
+    elapsed = time.perf_counter() - started
+    return len(clients) * messages / elapsed
+
+
+def run(mode, port, options):
+    process = start(mode, port, options)
+    try:
+        idle = tree_rss(process.pid)
+        rps, p50, p99 = http_load(port, options.http_clients, options.duration)
+        clients, refused, elapsed = open_sockets(port, options.connections)
+        connected = tree_rss(process.pid)
+        per_socket = (connected - idle) * 1024 / max(len(clients), 1)
+        deliveries = fanout(port, clients, options.messages) if clients else 0
+        stats = get(port, '/api/stats')
+        for client in clients:
+            client.close()
+    finally:
+        stop(process)
+    print(f'{mode:>5} | {rps:8,.0f} req/s | p50 {p50:6.1f} ms | p99 {p99:6.1f} ms | '
+          f'{len(clients):5} sockets in {elapsed:5.1f} s, {refused} refused | '
+          f'{idle:4.0f} -> {connected:4.0f} MiB ({per_socket:5.0f} KiB/socket) | '
+          f'{deliveries:8,.0f} deliveries/s | server sockets {stats.get("connections", "-")}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', default='dev,prod')
+    parser.add_argument('--port', type=int, default=10300)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--async-mode', default='threading')
+    parser.add_argument('--max-connections', type=int, default=10000)
+    parser.add_argument('--http-clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--connections', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=20)
+    options = parser.parse_args()
+    
+    for n, mode in enumerate(options.modes.split(',')):
+        run(mode, options.port + n, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# Бенчмарк хранилищ: одна и та же нагрузка на MemoryStorage и SQLiteStorage.
+#
+#   python bench/storage.py --messages 1000000 --backends memory sqlite
+#
+# Отправка меряется как пропускная способность (для SQLite - вместе с
+# дожиданием записи всех пачек), остальные операции - как задержка одного вызова.
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from storage import create_storage  # noqa: E402
+
+
+def seed_users(store, users):
+    now = datetime.now().isoformat()
+    for i in range(users):
+        username = f'user{i}'
+        store.add_user({
+            'id': str(uuid.uuid4()),
+            'username': username,
+            'password': 'password123',
+            'nickname': f'Пользователь {i}',
+            'avatar': '',
+            'bio': '',
+            'status': 'offline',
+            'last_seen': now,
+            'created_at': now,
+            'privacy': 'public',
+            'theme': 'dark'
+        }, {'notifications': True, 'sound': True})
+
+
+def seed_chats(store, users, chats):
+    rng = random.Random(chats)
+    chat_ids = []
+    while len(chat_ids) < chats:
+        user1, user2 = rng.sample(range(users), 2)
+        chat_id = str(uuid.uuid4())
+        created = store.create_chat({
+            'id': chat_id,
+            'type': 'private',
+            'name': f'user{user1} и user{user2}',
+            'members': [f'user{user1}', f'user{user2}'],
+            'created_at': datetime.now().isoformat(),
+            'last_message': None,
+            'unread': 0
+        })
+        if created == chat_id:
+            chat_ids.append(chat_id)
+    return chat_ids
+
+
+def send(store, members, total):
+    now = datetime.now().isoformat()
+    chat_ids = list(members)
+    ids = []
+    for n in range(total):
+        chat_id = chat_ids[n % len(chat_ids)]
+        message = {
+            'id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'sender': members[chat_id][n // len(chat_ids) % 2],
+            'content': f'Тестовое сообщение номер {n}',
+            'timestamp': now,
+            'edited': False
+        }
+        store.store_message(chat_id, message)
+        ids.append((chat_id, message['id'], message['seq']))
+    return ids
+
+
+def measure(fn, samples):
+    timings = []
+    for arg in samples:
+        started = time.perf_counter()
+        fn(arg)
+        timings.append((time.perf_counter() - started) * 1e6)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+def run(kind, args):
+    path = os.path.join(args.dir, 'bench.db')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.makedirs(args.dir, exist_ok=True)
+    store = create_storage(kind, path=path)
+    results = {}
+    
+    started = time.perf_counter()
+    seed_users(store, args.users)
+    results['register'] = args.users / (time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    chat_ids = seed_chats(store, args.users, args.chats)
+    results['create_chat'] = args.chats / (time.perf_counter() - started)
+    members = {chat_id: store.get_chat(chat_id)['members'] for chat_id in chat_ids}
+    
+    started = time.perf_counter()
+    ids = send(store, members, args.messages)
+    if hasattr(store, 'flush'):
+        store.flush()
+    results['send'] = args.messages / (time.perf_counter() - started)
+    
+    rng = random.Random(args.messages)
+    usernames = [f'user{i}' for i in rng.sample(range(args.users), min(args.ops, args.users))]
+    sample_chats = [rng.choice(chat_ids) for _ in range(args.ops)]
+    sample_ids = rng.sample(ids, args.ops * 3)
+    
+    results['page latest'] = measure(lambda chat_id: store.message_page(chat_id, limit=50), sample_chats)
+    results['page before'] = measure(lambda chat_id: store.message_page(chat_id, before=10, limit=50), sample_chats)
+    results['chat list'] = measure(store.chat_list, usernames)
+    results['find'] = measure(lambda item: store.find_message(item[1]), sample_ids[:args.ops])
+    results['react'] = measure(lambda item: store.toggle_reaction(item[1], 'user0', '👍'),
+                               sample_ids[:args.ops])
+    results['read'] = measure(lambda item: store.read_up_to(item[0], members[item[0]][1], item[2]),
+                              sample_ids[args.ops:args.ops * 2])
+    results['delete'] = measure(lambda item: store.delete_message(item[1], time.time()), sample_ids[args.ops * 2:])
+    
+    if hasattr(store, 'batches'):
+        results['writer'] = f'{store.writes / max(store.batches, 1):.0f} ops/batch'
+    store.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', nargs='+', default=['memory', 'sqlite'])
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--chats', type=int, default=10_000)
+    parser.add_argument('--messages', type=int, default=200_000)
+    parser.add_argument('--ops', type=int, default=1000)
+    parser.add_argument('--dir', default=os.path.join(ROOT, 'bench-data'))
+    args = parser.parse_args()
+    
+    for kind in args.backends:
+        print(f'== {kind}')
+        for name, value in run(kind, args).items():
+            if isinstance(value, tuple):
+                print(f'{name:>12}: p50 {value[0]:>8.1f} us, p99 {value[1]:>8.1f} us')
+            elif isinstance(value, float):
+                print(f'{name:>12}: {value:>10,.0f} ops/s')
+            else:
+                print(f'{name:>12}: {value}')
+
+
+if __name__ == '__main__':
+    main()
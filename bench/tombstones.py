@@ -0,0 +1,117 @@
+# Бенчмарк уборки удаленных сообщений: память и скорость чтения истории
+# до и после compact() на нагрузке с большим числом удалений.
+#
+#   python bench/tombstones.py --messages 1000000 --delete 0.5
+#
+# Память меряется tracemalloc (только объекты Python), поэтому сам прогон
+# в несколько раз медленнее обычного.
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MemoryStorage  # noqa: E402
+
+CHATS = 1000
+
+
+def seed(store, total):
+    chat_ids = []
+    for i in range(CHATS):
+        chat_id = str(uuid.uuid4())
+        store.create_chat({
+            'id': chat_id,
+            'type': 'private',
+            'name': f'chat {i}',
+            'members': [f'user{i}a', f'user{i}b'],
+            'created_at': datetime.now().isoformat(),
+            'last_message': None,
+            'unread': 0
+        })
+        chat_ids.append(chat_id)
+    
+    now = datetime.now().isoformat()
+    ids = []
+    for n in range(total):
+        chat_id = chat_ids[n % CHATS]
+        message = {
+            'id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'sender': f'user{n % CHATS}{"ab"[n // CHATS % 2]}',
+            'content': f'сообщение {n}',
+            'timestamp': now,
+            'edited': False
+        }
+        store.store_message(chat_id, message)
+        ids.append(message['id'])
+    return chat_ids, ids
+
+
+def page_walk(store, chat_ids):
+    # Полный проход истории каждого чата страницами по 50 (как при прокрутке вверх)
+    timings = []
+    seen = 0
+    for chat_id in chat_ids:
+        before = None
+        while True:
+            started = time.perf_counter()
+            page = store.message_page(chat_id, before=before, limit=50)
+            timings.append((time.perf_counter() - started) * 1e6)
+            if not page:
+                break
+            seen += len(page)
+            before = page[0]['seq']
+    return statistics.median(timings), seen
+
+
+def mib():
+    return tracemalloc.get_traced_memory()[0] / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200_000)
+    parser.add_argument('--delete', type=float, default=0.5, help='доля удаляемых по одному сообщений')
+    parser.add_argument('--clear', type=float, default=0.1, help='доля очищаемых чатов')
+    parser.add_argument('--walk', type=int, default=100, help='чатов для прохода истории')
+    args = parser.parse_args()
+    
+    tracemalloc.start()
+    store = MemoryStorage()
+    chat_ids, ids = seed(store, args.messages)
+    seeded = mib()
+    
+    rng = random.Random(args.messages)
+    for message_id in rng.sample(ids, int(len(ids) * args.delete)):
+        chat_id, msg = store.find_message(message_id)
+        if msg:
+            store.toggle_reaction(message_id, 'user', '👍')
+            store.delete_message(message_id, time.time())
+    for chat_id in rng.sample(chat_ids, int(CHATS * args.clear)):
+        store.clear_chat(chat_id, store.get_chat(chat_id)['members'][0], time.time())
+    deleted = mib()
+    walk = rng.sample(chat_ids, args.walk)
+    p50_before, seen_before = page_walk(store, walk)
+    
+    started = time.perf_counter()
+    removed = store.compact(time.time())
+    elapsed = time.perf_counter() - started
+    compacted = mib()
+    p50_after, seen_after = page_walk(store, walk)
+    assert seen_before == seen_after, (seen_before, seen_after)
+    
+    print(f'messages {args.messages:,}, removed by compact {removed:,} in {elapsed:.2f} s')
+    print(f'memory: seeded {seeded:.0f} MiB, after deletes {deleted:.0f} MiB, '
+          f'after compact {compacted:.0f} MiB (reclaimed {deleted - compacted:.0f} MiB)')
+    print(f'history page p50: {p50_before:.1f} us with tombstones, {p50_after:.1f} us after compact')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Бенчмарк /api/search: индекс (префиксы + триграммы) против прежнего
+# линейного прохода по всем пользователям.
+#
+#   python bench/user_search.py --sizes 10000 100000 1000000
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import UserSearchIndex  # noqa: E402
+
+SYLLABLES = ['ан', 'на', 'ма', 'ри', 'ко', 'ва', 'ле', 'на', 'ив', 'ол', 'га', 'ди', 'ми', 'тр', 'ий']
+LATIN = ['an', 'na', 'ma', 'ri', 'ko', 'va', 'le', 'iv', 'ol', 'ga', 'di', 'mi', 'tr', 'ij', 'se']
+LIMIT = 50
+
+
+def make_users(count, rng):
+    users = {}
+    for i in range(count):
+        username = ''.join(rng.choice(LATIN) for _ in range(rng.randint(2, 4))) + str(i)
+        nickname = ' '.join(
+            ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).title()
+            for _ in range(2))
+        users[username] = {
+            'username': username,
+            'nickname': nickname,
+            'avatar': '',
+            'status': 'offline',
+            'last_seen': '',
+            'bio': 'bio'
+        }
+    return users
+
+
+def result_row(user):
+    return {
+        'username': user['username'],
+        'nickname': user['nickname'],
+        'avatar': user['avatar'],
+        'status': user['status'],
+        'last_seen': user['last_seen'],
+        'bio': user['bio'][:100] + '...' if len(user['bio']) > 100 else user['bio']
+    }
+
+
+def scan_search(users, query, current_user):
+    # Прежняя реализация api_search
+    results = []
+    for username, user in users.items():
+        if username == current_user:
+            continue
+        if query in username.lower() or query in user.get('nickname', '').lower():
+            results.append(result_row(user))
+    return results[:LIMIT]
+
+
+def index_search(index, users, query, current_user):
+    return [result_row(users[u]) for u in index.search(query, limit=LIMIT, exclude=current_user)]
+
+
+def make_queries(users, rng, count):
+    names = list(users)
+    queries = []
+    for _ in range(count):
+        user = users[rng.choice(names)]
+        kind = rng.randrange(4)
+        if kind == 0:
+            queries.append(user['username'][:rng.randint(1, 4)])
+        elif kind == 1:
+            queries.append(user['nickname'].lower()[:rng.randint(2, 5)])
+        elif kind == 2:
+            nick = user['nickname'].lower()
+            start = rng.randrange(max(1, len(nick) - 4))
+            queries.append(nick[start:start + 4])
+        else:
+            queries.append(user['username'][-4:])
+    return queries
+
+
+def timed(fn, queries):
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query)
+        timings.append((time.perf_counter() - start) * 1e3)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+    
+    print(f"{'users':>9} {'build s':>8} {'scan p50':>9} {'scan p95':>9} {'index p50':>10} {'index p95':>10}  (ms)")
+    for count in args.sizes:
+        rng = random.Random(count)
+        users = make_users(count, rng)
+        start = time.perf_counter()
+        index = UserSearchIndex()
+        index.add_many((username, user['nickname']) for username, user in users.items())
+        build = time.perf_counter() - start
+        
+        queries = make_queries(users, rng, args.queries)
+        for query in queries[:20]:
+            # Оба пути должны находить одинаковое число совпадений (порядок разный)
+            assert len(scan_search(users, query, None)) == len(index_search(index, users, query, None))
+        scan = timed(lambda q: scan_search(users, q, None), queries)
+        indexed = timed(lambda q: index_search(index, users, q, None), queries)
+        print(f'{count:>9} {build:>8.1f} {scan[0]:>9.2f} {scan[1]:>9.2f} {indexed[0]:>10.3f} {indexed[1]:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Бенчмарк режима нескольких воркеров: пропускная способность и задержка
+# доставки сообщения между процессами через шину.
+#
+#   python bench/workers.py --workers 3 --messages 2000
+#
+# Каждый воркер слушает свой порт, чтобы клиентов можно было разложить
+# по процессам явно (в workers.py порт общий и распределяет ядро).
+# Доставку событий между воркерами проверяет tests/test_workers.py.
+import argparse
+import os
+import signal
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bus import Broker  # noqa: E402
+from workers import listen, spawn  # noqa: E402
+from client import Client, post, wait_ready  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--port', type=int, default=10100)
+    parser.add_argument('--messages', type=int, default=1000)
+    args = parser.parse_args()
+    if args.workers < 2:
+        parser.error('нужно минимум два воркера')
+    
+    workdir = tempfile.mkdtemp(prefix='deeplink-workers-')
+    os.environ['DEEPLINK_STORAGE'] = 'sqlite'
+    os.environ['DEEPLINK_SQLITE_PATH'] = os.path.join(workdir, 'deeplink.db')
+    os.environ['DEEPLINK_RATE_LIMIT_SCALE'] = '0'  # Сообщения идут пачкой без пауз
+    bus_path = os.path.join(workdir, 'bus.sock')
+    broker = Broker(bus_path).start()
+    ports = [args.port + i for i in range(args.workers)]
+    pids = [spawn(i, bus_path, listen('127.0.0.1', port), '127.0.0.1', port) for i, port in enumerate(ports)]
+    try:
+        for port in ports:
+            wait_ready(port)
+        
+        for name in ('ann', 'ben'):
+            post(ports[0], '/api/register', {'username': name, 'password': 'secret'})
+        chat_id = post(ports[0], '/api/chat/create', {'user1': 'ann', 'user2': 'ben'})['chat_id']
+        ann = Client(ports[0])
+        ann.emit('user_online', {'username': 'ann'})
+        
+        # Задержка доставки сообщения из первого воркера в последний
+        reader = Client(ports[-1])
+        reader.emit('join_chat', {'chat_id': chat_id})
+        time.sleep(0.5)
+        sent = {}
+        started = time.perf_counter()
+        for n in range(args.messages):
+            sent[str(n)] = time.perf_counter()
+            ann.emit('send_message', {'chat_id': chat_id, 'sender': 'ann', 'content': str(n)})
+        latencies = []
+        for _ in range(args.messages):
+            received, data = reader.wait('new_message', timeout=60)
+            latencies.append((received - sent[data['content']]) * 1000)
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        print(f'{args.workers} workers, {args.messages} messages across workers: {args.messages / elapsed:,.0f} msg/s, '
+              f'latency p50 {statistics.median(latencies):.1f} ms, '
+              f'p99 {latencies[int(len(latencies) * 0.99) - 1]:.1f} ms')
+        ann.close()
+        reader.close()
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        broker.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+# Шина pub/sub между рабочими процессами.
+#
+# Рабочие процессы подключаются к брокеру через Unix-сокет и публикуют
+# сообщения [канал, данные]; брокер пересылает каждое сообщение всем остальным
+# подключениям. Внешние сервисы (Redis, RabbitMQ) не нужны. LocalBus - та же
+# шина внутри одного процесса, для режима с одним воркером.
+#
+# Формат кадра: длина:u32 + JSON [канал, данные].
+#
+# События Socket.IO кодируются в пакет один раз в воркере-отправителе: по
+# шине идет готовая строка пакета, и остальные воркеры рассылают ее своим
+# сокетам, не разбирая данные и не кодируя их заново. Имя события и ключ
+# слияния идут рядом с пакетом: по ним каждый воркер применяет к своим
+# сокетам ограничения исходящих очередей (outbound.py).
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+from collections import defaultdict
+
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+
+from outbound import coalesce_key, OutboundMixin
+from serialization import dumps_bytes, loads
+
+FRAME = struct.Struct('<I')
+
+log = logging.getLogger(__name__)
+
+
+def _encode(channel, data):
+    payload = dumps_bytes([channel, data])
+    return FRAME.pack(len(payload)) + payload
+
+
+def _read_frames(sock):
+    # Генератор сырых кадров (с заголовком) до закрытия соединения
+    buffer = bytearray()
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return
+        buffer += chunk
+        pos = 0
+        while len(buffer) - pos >= FRAME.size:
+            length, = FRAME.unpack_from(buffer, pos)
+            end = pos + FRAME.size + length
+            if len(buffer) < end:
+                break
+            yield bytes(buffer[pos:end])
+            pos = end
+        del buffer[:pos]
+
+
+class Broker:
+    def __init__(self, path):
+        self.path = path
+        self.published = 0
+        self._lock = threading.Lock()
+        self._clients = {}  # сокет -> блокировка записи
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen()
+    
+    def start(self):
+        threading.Thread(target=self._accept, name='bus-broker', daemon=True).start()
+        return self
+    
+    def close(self):
+        self._server.close()
+        with self._lock:
+            for client in self._clients:
+                client.close()
+            self._clients.clear()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._clients[client] = threading.Lock()
+            threading.Thread(target=self._serve, args=(client,), name='bus-client', daemon=True).start()
+    
+    def _serve(self, client):
+        try:
+            for frame in _read_frames(client):
+                self.published += 1
+                with self._lock:
+                    targets = [(other, lock) for other, lock in self._clients.items() if other is not client]
+                for other, lock in targets:
+                    try:
+                        with lock:
+                            other.sendall(frame)
+                    except OSError:
+                        pass  # Отключившегося уберет его собственный поток
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._clients.pop(client, None)
+            client.close()
+
+
+class LocalBus:
+    # Шина одного процесса: публикация никому не доставляется, подписчики
+    # локальные события получают напрямую от вызывающего кода
+    def publish(self, channel, data):
+        pass
+    
+    def subscribe(self, channel, handler):
+        pass
+    
+    def close(self):
+        pass
+
+
+class UnixSocketBus:
+    def __init__(self, path):
+        self.path = path
+        self._handlers = defaultdict(list)
+        self._send_lock = threading.Lock()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        threading.Thread(target=self._reader, name='bus-reader', daemon=True).start()
+    
+    def publish(self, channel, data):
+        frame = _encode(channel, data)
+        with self._send_lock:
+            self._sock.sendall(frame)
+    
+    def subscribe(self, channel, handler):
+        self._handlers[channel].append(handler)
+    
+    def close(self):
+        self._sock.close()
+    
+    def _reader(self):
+        try:
+            for frame in _read_frames(self._sock):
+                channel, data = loads(frame[FRAME.size:])
+                for handler in self._handlers.get(channel, ()):
+                    try:
+                        handler(data)
+                    except Exception:
+                        log.exception('Шина: ошибка обработчика канала %s', channel)
+        except OSError:
+            pass
+        log.warning('Шина: соединение с брокером %s закрыто', self.path)
+
+
+class BusManager(OutboundMixin, socketio.PubSubManager):
+    # Менеджер клиентов Socket.IO поверх шины: emit в комнату уходит во все
+    # рабочие процессы, и каждый доставляет его своим сокетам
+    name = 'deeplink-bus'
+    
+    def __init__(self, bus, channel='socketio', outbound=None):
+        super().__init__(channel=channel)
+        self.bus = bus
+        self.outbound = outbound
+        self._inbox = queue.Queue()
+        bus.subscribe(channel, self._inbox.put)
+    
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if kwargs.get('ignore_queue') or callback is not None or self.server.packet_class is not packet.Packet:
+            # Подтверждения и MessagePack - обычным путем библиотеки
+            return super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid,
+                                callback=callback, **kwargs)
+        if isinstance(data, tuple):
+            data = list(data)
+        elif data is not None:
+            data = [data]
+        else:
+            data = []
+        if packet.Packet.data_is_binary(data):
+            return super().emit(event, tuple(data), namespace=namespace, room=room, skip_sid=skip_sid)
+        namespace = namespace or '/'
+        encoded = self.server.packet_class(packet.EVENT, namespace=namespace, data=[event] + data).encode()
+        message = {'method': 'emit', 'packet': encoded, 'event': event, 'key': coalesce_key(event, data[0] if data else None),
+                   'namespace': namespace, 'room': room, 'skip_sid': skip_sid, 'host_id': self.host_id}
+        self._send_encoded(message)  # Свои сокеты
+        self._publish(message)  # Остальные воркеры
+    
+    def _handle_emit(self, message):
+        if 'packet' in message:
+            return self._send_encoded(message)
+        if message.get('callback') or message.get('binary') or message.get('namespace') not in self.rooms:
+            return super()._handle_emit(message)
+        # MessagePack: пакет кодирует воркер получателя, доставка та же
+        data = message['data']
+        encoded = self.server.packet_class(packet.EVENT, namespace=message['namespace'],
+                                           data=[message['event']] + data).encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        self._deliver(message['namespace'], message.get('room'), message.get('skip_sid'), message['event'],
+                      coalesce_key(message['event'], data[0] if len(data) == 1 else None),
+                      [eio_packet.Packet(eio_packet.MESSAGE, part) for part in encoded])
+    
+    def _send_encoded(self, message):
+        namespace = message['namespace']
+        if namespace not in self.rooms:
+            return
+        self._deliver(namespace, message.get('room'), message.get('skip_sid'), message.get('event'),
+                      message.get('key'), [eio_packet.Packet(eio_packet.MESSAGE, message['packet'])])
+    
+    def _publish(self, data):
+        self.bus.publish(self.channel, data)
+    
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
+
+
+def create_bus(path=None):
+    return UnixSocketBus(path) if path else LocalBus()
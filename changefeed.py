@@ -0,0 +1,56 @@
+# Лента изменений для дешевой синхронизации после переподключения.
+#
+# Каждое событие чата (новое сообщение, правка, удаление, реакция, создание
+# чата) получает номер в общей монотонной последовательности и ложится в
+# кольцевой буфер фиксированного размера. Клиент помнит курсор - номер
+# последнего увиденного события - и после переподключения получает только
+# события своих чатов после курсора. Если курсор уже вытеснен из буфера или
+# относится к другой эпохе (сервер перезапущен, нумерация началась заново),
+# клиенту нужна полная перезагрузка.
+#
+# Буфер живет только в памяти процесса и в снимок не попадает: после
+# перезапуска начинается новая эпоха. SQLiteStorage держит такой же буфер
+# в таблице changes, общей для всех воркеров.
+import os
+import random
+import threading
+
+FEED_SIZE = int(os.environ.get('DEEPLINK_CHANGEFEED_SIZE', '10000'))  # Событий в буфере
+
+
+def new_epoch():
+    return random.randrange(1, 1 << 31)
+
+
+class ChangeFeed:
+    def __init__(self, size=FEED_SIZE):
+        self.size = size
+        self.epoch = new_epoch()
+        self.seq = 0  # Номер последнего события
+        self._slots = [None] * size  # seq % size -> (seq, chat_id, event, data)
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return min(self.seq, self.size)
+    
+    def record(self, chat_id, event, data):
+        with self._lock:
+            self.seq += 1
+            self._slots[self.seq % self.size] = (self.seq, chat_id, event, data)
+            return self.seq
+    
+    def since(self, seq, chat_ids, limit):
+        # (до какого seq просмотрено, [(seq, chat_id, event, data)]);
+        # вместо списка None, если seq вытеснен из буфера или из будущего
+        with self._lock:
+            head = self.seq
+            if seq is None or seq > head or seq < head - self.size:
+                return head, None
+            entries = [self._slots[n % self.size] for n in range(seq + 1, head + 1)]
+        events = []
+        for entry in entries:
+            if entry[1] in chat_ids:
+                events.append(entry)
+                if len(events) == limit:
+                    return entry[0], events
+        return head, events
@@ -0,0 +1,108 @@
+# Компактная запись сообщения для MemoryStorage.
+#
+# Словарь в формате API стоит несколько сотен байт на сообщение еще до текста:
+# сама таблица словаря, свои строки chat_id и sender у каждого сообщения
+# (их заново создает разбор JSON) и строка времени ISO. Запись со __slots__
+# хранит те же данные полями: chat_id и sender интернированы и общие для
+# всех сообщений чата и отправителя, время - целые миллисекунды эпохи,
+# флаги edited/deleted - время правки и удаления (0 - не было). В словарь
+# API запись превращается только на выходе из хранилища.
+#
+# Реакции сообщения - тоже запись: счетчики по эмодзи для отдачи клиентам и
+# карта пользователь -> эмодзи, чтобы знать, чью реакцию снимать. Строки
+# интернированы и общие для всех сообщений.
+import functools
+import sys
+from datetime import datetime
+
+# Хвосты ISO-строки: секунды и миллисекунды берутся из таблиц, а не форматируются
+SECONDS = [f'{second:02d}.' for second in range(60)]
+MILLIS = [f'{milli:03d}' for milli in range(1000)]
+
+
+@functools.lru_cache(maxsize=4096)
+def _minute_prefix(minute):
+    # Локальные дата и минута; смещение часового пояса кратно минуте
+    return datetime.fromtimestamp(minute * 60).strftime('%Y-%m-%dT%H:%M:')
+
+
+def to_millis(timestamp):
+    # ISO-строка (локальное время, как datetime.now().isoformat()) -> мс эпохи
+    return round(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+def from_millis(millis):
+    # Обратно в ISO-строку с точностью до миллисекунд; дата и минута из кэша
+    minute, rest = divmod(millis, 60_000)
+    second, milli = divmod(rest, 1000)
+    return _minute_prefix(minute) + SECONDS[second] + MILLIS[milli]
+
+
+class Message:
+    __slots__ = ('chat_id', 'seq', 'id', 'sender', 'content', 'timestamp', 'edited_at', 'deleted')
+    
+    def __init__(self, chat_id, seq, id, sender, content, timestamp, edited_at=0, deleted=0):
+        self.chat_id = chat_id
+        self.seq = seq
+        self.id = id
+        self.sender = sender
+        self.content = content
+        self.timestamp = timestamp
+        self.edited_at = edited_at
+        self.deleted = deleted
+    
+    @classmethod
+    def from_dict(cls, chat_id, message):
+        timestamp = to_millis(message['timestamp'])
+        edited_at = message.get('edited_at')
+        if edited_at:
+            edited_at = to_millis(edited_at)
+        elif message.get('edited'):
+            edited_at = timestamp  # Время правки неизвестно
+        return cls(sys.intern(chat_id), message['seq'], message['id'], sys.intern(message['sender']),
+                   message['content'], timestamp, edited_at or 0)
+    
+    def to_dict(self):
+        msg = {
+            'id': self.id,
+            'chat_id': self.chat_id,
+            'seq': self.seq,
+            'sender': self.sender,
+            'content': self.content,
+            'timestamp': from_millis(self.timestamp),
+            'edited': bool(self.edited_at)
+        }
+        if self.edited_at:
+            msg['edited_at'] = from_millis(self.edited_at)
+        return msg
+
+
+class Reactions:
+    __slots__ = ('counts', 'users')
+    
+    def __init__(self):
+        self.counts = {}  # эмодзи -> сколько пользователей поставили
+        self.users = {}  # username -> эмодзи, не больше одной реакции на пользователя
+    
+    @classmethod
+    def from_users(cls, users):
+        reactions = cls()
+        for username, reaction in users.items():
+            reactions.toggle(username, reaction)
+        return reactions
+    
+    def toggle(self, username, reaction):
+        # Снимает реакцию пользователя, если она есть, иначе ставит новую.
+        # Возвращает (эмодзи, +1 или -1, новое число таких реакций)
+        current = self.users.pop(username, None)
+        if current is not None:
+            count = self.counts[current] - 1
+            if count:
+                self.counts[current] = count
+            else:
+                del self.counts[current]
+            return current, -1, count
+        reaction = sys.intern(reaction)
+        self.users[sys.intern(username)] = reaction
+        count = self.counts[reaction] = self.counts.get(reaction, 0) + 1
+        return reaction, 1, count
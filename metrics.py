@@ -0,0 +1,242 @@
+# Метрики в текстовом формате Prometheus и сэмплирующий профилировщик.
+#
+# Каждый маршрут Flask и обработчик события Socket.IO оборачивается замером:
+# гистограмма задержек и счетчик исключений по типу. Замер - perf_counter,
+# bisect по границам корзин и инкремент под блокировкой гистограммы.
+# Размеры хранилища и реестров считаются функциями-датчиками в момент
+# запроса /metrics, а не на горячем пути.
+#
+# Профилировщик по запросу раз в interval снимает стеки всех потоков
+# (sys._current_frames) и копит их в свернутом виде "a;b;c N" - формат,
+# который понимают flamegraph.pl и speedscope.
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter, defaultdict
+from functools import wraps
+
+# Границы корзин задержек, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+PROFILE_INTERVAL = 0.005  # Секунд между снимками стеков
+PROFILE_DEPTH = 64  # Кадров стека в одном образце
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # значения меток -> [счетчики корзин..., +Inf, сумма]
+    
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                bucket_labels = _labels(self.labels + ('le',), labels + (_number(bound),))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {values[-1]!r}')
+            lines.append(f'{self.name}_count{_labels(self.labels, labels)} {cumulative}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = defaultdict(int)
+    
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] += amount
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.labels, labels)} {value}')
+        return lines
+
+
+class Gauge:
+    # Значение берется из функции при каждом запросе; функция возвращает
+    # число или {значения меток: число}
+    def __init__(self, name, help, read, labels=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = labels
+        self.kind = kind
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        value = self.read()
+        if isinstance(value, dict):
+            for labels, item in sorted(value.items()):
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                lines.append(f'{self.name}{_labels(self.labels, labels)} {_number(item)}')
+        else:
+            lines.append(f'{self.name} {_number(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+    
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+    
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+    
+    def gauge(self, name, help, read, labels=(), kind='gauge'):
+        return self._add(Gauge(name, help, read, labels, kind))
+    
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as error:
+                # Сломанный датчик не должен ронять весь ответ
+                lines.append(f'# {metric.name} failed: {_escape(error)}')
+        return '\n'.join(lines) + '\n'
+
+
+def timed(fn, label, latency, errors):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except BaseException as error:
+            errors.inc(label, type(error).__name__)
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started, label)
+    return wrapper
+
+
+def instrument_app(app, registry):
+    # Оборачивает все уже зарегистрированные маршруты Flask
+    latency = registry.histogram('deeplink_http_request_duration_seconds',
+                                 'Время обработки HTTP-запроса', ('endpoint',))
+    errors = registry.counter('deeplink_http_errors_total',
+                              'Исключения в обработчиках HTTP', ('endpoint', 'error'))
+    for endpoint, view in list(app.view_functions.items()):
+        app.view_functions[endpoint] = timed(view, endpoint, latency, errors)
+
+
+def instrument_socketio(socketio, registry):
+    # Оборачивает все уже зарегистрированные обработчики событий Socket.IO
+    latency = registry.histogram('deeplink_socketio_event_duration_seconds',
+                                 'Время обработки события Socket.IO', ('event',))
+    errors = registry.counter('deeplink_socketio_errors_total',
+                              'Исключения в обработчиках Socket.IO', ('event', 'error'))
+    for handlers in socketio.server.handlers.values():
+        for event, handler in list(handlers.items()):
+            handlers[event] = timed(handler, event, latency, errors)
+
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL, depth=PROFILE_DEPTH):
+        self.interval = interval
+        self.depth = depth
+        self.samples = 0
+        self._stacks = StackCounter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+    
+    @property
+    def running(self):
+        return self._thread is not None
+    
+    def start(self, interval=None):
+        # Новый запуск начинает накопление заново
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self.interval = interval or self.interval
+            self._stacks.clear()
+            self.samples = 0
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+            return True
+    
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return False
+        self._stop.set()
+        thread.join()
+        return True
+    
+    def collapsed(self, limit=None):
+        # Стеки в свернутом формате, самые частые первыми
+        with self._lock:
+            stacks = self._stacks.most_common(limit)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+    
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            sampled = []
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                sampled.append(';'.join(reversed(stack)))
+            del frames
+            with self._lock:
+                self._stacks.update(sampled)
+                self.samples += 1
@@ -0,0 +1,170 @@
+# Ограниченные исходящие очереди сокетов.
+#
+# Engine.IO складывает пакеты каждого сокета в неограниченную очередь, ее
+# разбирает писатель сокета. Медленный клиент (мобильная сеть) не успевает
+# за рассылками в комнаты, и очередь растет без предела. Поэтому перед
+# отправкой смотрим глубину очереди получателя:
+# - малоценные события (набор, онлайн/офлайн) при глубине от COALESCE_DEPTH
+#   откладываются. На ключ (чат и пользователь для набора, пользователь для
+#   статуса) хранится только последнее, более раннее выбрасывается. Отложенные
+#   уходят, когда очередь разобрана (flush);
+# - при глубине limit на любом другом событии сокет отключается: после
+#   переподключения клиент догонит пропущенное по курсору ленты изменений,
+#   а память процесса не растет.
+# Менеджеры клиентов Socket.IO (BoundedManager, BusManager) отдают каждый
+# пакет сокету через deliver; ответы на подтверждения идут мимо.
+import threading
+from collections import Counter
+
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+
+OUTBOUND_QUEUE = 1000  # Пакетов в очереди сокета, после которых он отключается
+COALESCE_DEPTH = 50  # Глубина очереди, с которой малоценные события откладываются
+
+# Малоценные события -> вид ключа слияния
+COALESCED = {'user_typing': 'typing', 'user_online': 'presence', 'user_offline': 'presence'}
+
+
+def coalesce_key(event, data):
+    # Ключ слияния события или None, если событие терять нельзя
+    kind = COALESCED.get(event)
+    if kind is None or not isinstance(data, dict):
+        return None
+    return f"{kind}:{data.get('chat_id', '')}:{data.get('username', '')}"
+
+
+class OutboundQueues:
+    def __init__(self, limit=OUTBOUND_QUEUE, depth=COALESCE_DEPTH):
+        # limit=0 - очередь без предела, слияние все равно работает
+        self.limit = limit
+        self.depth = min(depth, limit) if limit else depth
+        self._lock = threading.Lock()
+        self._pending = {}  # eio_sid -> {ключ: (событие, пакеты)}
+        self.events = Counter()  # (событие, исход) -> число
+    
+    def send(self, server, eio_sid, event, key, packets):
+        # False - очередь сокета переполнена, его нужно отключить (disconnect)
+        socket = server.eio.sockets.get(eio_sid)
+        depth = socket.queue.qsize() if socket is not None else 0
+        if key is not None and (depth >= self.depth or eio_sid in self._pending):
+            # Отложенное уже есть - новое встает за ним, иначе обгонит
+            self._defer(eio_sid, event, key, packets)
+            return True
+        if self.limit and depth >= self.limit:
+            with self._lock:
+                self.events[(event, 'overflow')] += 1
+            return False
+        for pkt in packets:
+            server._send_eio_packet(eio_sid, pkt)
+        return True
+    
+    def _defer(self, eio_sid, event, key, packets):
+        with self._lock:
+            pending = self._pending.setdefault(eio_sid, {})
+            replaced = pending.get(key)
+            if replaced is not None:
+                self.events[(replaced[0], 'coalesced')] += 1
+            elif len(pending) >= max(self.limit, self.depth):
+                self.events[(event, 'dropped')] += 1
+                return
+            pending[key] = (event, packets)
+            self.events[(event, 'deferred')] += 1
+    
+    def flush(self, server):
+        # Отложенные события сокетам, которые разобрали свою очередь
+        with self._lock:
+            waiting = list(self._pending)
+        for eio_sid in waiting:
+            socket = server.eio.sockets.get(eio_sid)
+            if socket is not None and not socket.closed and socket.queue.qsize() >= self.depth:
+                continue
+            with self._lock:
+                pending = self._pending.pop(eio_sid, {})
+                if socket is None or socket.closed:
+                    for event, _ in pending.values():
+                        self.events[(event, 'dropped')] += 1
+                    continue
+            for event, packets in pending.values():
+                for pkt in packets:
+                    server._send_eio_packet(eio_sid, pkt)
+    
+    def disconnect(self, server, eio_sids):
+        # Отключает переполненные сокеты. Накопленное им уже не уйдет: очередь
+        # очищается сразу, не дожидаясь писателя, который ждет клиента
+        empty = server.eio.get_queue_empty_exception()
+        for eio_sid in eio_sids:
+            socket = server.eio.sockets.get(eio_sid)
+            if socket is None or socket.closed:
+                continue
+            socket.close(wait=False, abort=True)
+            try:
+                while True:
+                    socket.queue.get(block=False)
+                    socket.queue.task_done()
+            except empty:
+                pass
+            socket.queue.put(None)  # Писатель выходит и закрывает соединение
+        with self._lock:
+            for eio_sid in eio_sids:
+                self._pending.pop(eio_sid, None)
+    
+    def depths(self, server):
+        # Глубины очередей сокетов: наибольшая и суммарная
+        sizes = [socket.queue.qsize() for socket in list(server.eio.sockets.values())]
+        return {'max': max(sizes, default=0), 'total': sum(sizes)}
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': sum(len(pending) for pending in self._pending.values()),
+                'events': dict(self.events)
+            }
+
+
+class OutboundMixin:
+    # Доставка пакетов события участникам комнаты через ограниченные очереди
+    outbound = None
+    
+    def _deliver(self, namespace, room, skip_sid, event, key, packets):
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+        server = self.server
+        if self.outbound is None:
+            for sid, eio_sid in self.get_participants(namespace, room):
+                if sid not in skip_sid:
+                    for pkt in packets:
+                        server._send_eio_packet(eio_sid, pkt)
+            return
+        # Отключение трогает комнаты - только после обхода участников
+        overflow = [eio_sid for sid, eio_sid in self.get_participants(namespace, room)
+                    if sid not in skip_sid and not self.outbound.send(server, eio_sid, event, key, packets)]
+        if overflow:
+            self.outbound.disconnect(server, overflow)
+
+
+class BoundedManager(OutboundMixin, socketio.Manager):
+    # Менеджер клиентов одного процесса: пакет кодируется один раз, как в
+    # библиотеке, и уходит каждому сокету через ограниченную очередь
+    def __init__(self, outbound=None):
+        super().__init__()
+        self.outbound = outbound
+    
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if callback is not None:
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+        if namespace not in self.rooms:
+            return
+        if isinstance(data, tuple):
+            args = list(data)
+        elif data is not None:
+            args = [data]
+        else:
+            args = []
+        encoded = self.server.packet_class(packet.EVENT, namespace=namespace, data=[event] + args).encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        packets = [eio_packet.Packet(eio_packet.MESSAGE, part) for part in encoded]
+        self._deliver(namespace, room, skip_sid, event, coalesce_key(event, data), packets)
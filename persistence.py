@@ -0,0 +1,269 @@
+# Хранение состояния на диске: сегментированный журнал (WAL) + снимки.
+#
+# Каждая мутация пишется в журнал как [имя, аргументы]. Записи копятся в
+# буфере и сбрасываются фоновым потоком пачками - один fsync на группу
+# (group commit). Периодически делается снимок всего состояния, после чего
+# покрытые им сегменты удаляются, так что при старте воспроизводится только
+# хвост журнала после последнего снимка.
+#
+# Формат записи: заголовок <lsn:u64, длина:u32, crc32:u32> + JSON.
+import glob
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+HEADER = struct.Struct('<QII')
+SEGMENT_SIZE = 64 * 1024 * 1024
+COMMIT_INTERVAL = 0.005  # Окно сбора группы перед fsync, секунды
+SNAPSHOT_EVERY = 500_000  # Записей журнала между снимками
+
+log = logging.getLogger(__name__)
+
+
+def _fsync_dir(directory):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _numbered(directory, prefix, suffix):
+    # [(номер, путь)] по возрастанию номера из имени файла
+    files = []
+    for path in glob.glob(os.path.join(directory, f'{prefix}*{suffix}')):
+        name = os.path.basename(path)[len(prefix):-len(suffix)]
+        if name.isdigit():
+            files.append((int(name), path))
+    return sorted(files)
+
+
+class EventLog:
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, commit_interval=COMMIT_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.last_lsn = 0
+        self.durable_lsn = 0
+        self.fsyncs = 0
+        self._cond = threading.Condition()
+        self._pending = bytearray()
+        self._pending_lsn = 0
+        self._closing = False
+        self._file = None
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+    
+    def segments(self):
+        return _numbered(self.directory, 'wal-', '.log')
+    
+    def replay(self, after_lsn=0):
+        # Читает все целые записи с lsn > after_lsn. Оборванная запись в конце
+        # сегмента (падение посреди write) означает конец этого сегмента
+        segments = self.segments()
+        for i, (first_lsn, path) in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1][0] <= after_lsn + 1:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            pos = 0
+            while pos + HEADER.size <= len(data):
+                lsn, length, crc = HEADER.unpack_from(data, pos)
+                payload = data[pos + HEADER.size:pos + HEADER.size + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    log.warning('WAL %s: оборванная запись на смещении %d', path, pos)
+                    break
+                pos += HEADER.size + length
+                self.last_lsn = max(self.last_lsn, lsn)
+                if lsn > after_lsn:
+                    op, args = json.loads(payload)
+                    yield lsn, op, args
+        self.last_lsn = max(self.last_lsn, after_lsn)
+        self.durable_lsn = self.last_lsn
+    
+    def start(self):
+        # Новый запуск всегда пишет в новый сегмент
+        self._open_segment(self.last_lsn + 1)
+        self._thread = threading.Thread(target=self._flusher, name='wal-flusher', daemon=True)
+        self._thread.start()
+    
+    def append(self, op, args):
+        payload = json.dumps([op, args], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        with self._cond:
+            self.last_lsn += 1
+            lsn = self.last_lsn
+            self._pending += HEADER.pack(lsn, len(payload), zlib.crc32(payload))
+            self._pending += payload
+            self._pending_lsn = lsn
+            self._cond.notify_all()
+        return lsn
+    
+    def wait(self, lsn):
+        # Ждет, пока запись lsn не окажется на диске
+        with self._cond:
+            while self.durable_lsn < lsn and not self._closing:
+                self._cond.wait()
+    
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        if self._file:
+            self._file.close()
+            self._file = None
+    
+    def truncate(self, upto_lsn):
+        # Удаляет сегменты, все записи которых не новее upto_lsn
+        segments = self.segments()
+        for (first_lsn, path), (next_lsn, _) in zip(segments, segments[1:]):
+            if next_lsn - 1 <= upto_lsn:
+                os.remove(path)
+    
+    def _open_segment(self, first_lsn):
+        if self._file:
+            self._file.close()
+        path = os.path.join(self.directory, f'wal-{first_lsn:016d}.log')
+        self._file = open(path, 'ab', buffering=0)
+        _fsync_dir(self.directory)
+    
+    def _flusher(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if self._closing and not self._pending:
+                    return
+            # Даем набраться группе, чтобы один fsync покрыл несколько записей
+            if self.commit_interval and not self._closing:
+                time.sleep(self.commit_interval)
+            with self._cond:
+                batch, self._pending = self._pending, bytearray()
+                batch_lsn = self._pending_lsn
+            if self._file.tell() >= self.segment_size:
+                self._open_segment(self.durable_lsn + 1)
+            self._file.write(batch)
+            os.fsync(self._file.fileno())
+            self.fsyncs += 1
+            with self._cond:
+                self.durable_lsn = batch_lsn
+                self._cond.notify_all()
+
+
+def save_snapshot(directory, lsn, state):
+    # Атомарно: пишем во временный файл, fsync, затем rename
+    path = os.path.join(directory, f'snapshot-{lsn:016d}.pkl')
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(directory)
+    return path
+
+
+def load_snapshot(directory):
+    # Последний снимок читается через mmap без промежуточной копии файла
+    snapshots = _numbered(directory, 'snapshot-', '.pkl')
+    if not snapshots:
+        return 0, None
+    lsn, path = snapshots[-1]
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return lsn, pickle.loads(data)
+
+
+class Persistence:
+    def __init__(self, directory, get_state, lock, snapshot_every=SNAPSHOT_EVERY,
+                 sync_commit=False, **log_options):
+        self.directory = directory
+        self.get_state = get_state
+        self.lock = lock
+        self.snapshot_every = snapshot_every
+        self.sync_commit = sync_commit
+        self.log = EventLog(directory, **log_options)
+        self.snapshot_lsn = 0
+        self._snapshotting = False
+    
+    def load(self):
+        # Возвращает (состояние из снимка или None, генератор хвоста журнала)
+        self.snapshot_lsn, state = load_snapshot(self.directory)
+        return state, ((op, args) for _, op, args in self.log.replay(self.snapshot_lsn))
+    
+    def start(self):
+        self.log.start()
+    
+    def close(self):
+        self.log.close()
+    
+    def record(self, op, args):
+        # Вызывается под self.lock сразу после применения мутации
+        lsn = self.log.append(op, args)
+        if self.snapshot_every and lsn - self.snapshot_lsn >= self.snapshot_every:
+            self.snapshot()
+        return lsn
+    
+    def snapshot(self, wait=False):
+        with self.lock:
+            if self._snapshotting:
+                return
+            self._snapshotting = True
+            lsn = self.log.last_lsn
+            if hasattr(os, 'fork'):
+                # Снимок пишет дочерний процесс с copy-on-write копией памяти
+                # (как BGSAVE в Redis), основной процесс стоит только на fork
+                pid = os.fork()
+                if pid == 0:
+                    code = 1
+                    try:
+                        save_snapshot(self.directory, lsn, self.get_state())
+                        code = 0
+                    finally:
+                        os._exit(code)
+                job = (self._wait_child, pid)
+            else:
+                data = pickle.dumps(self.get_state(), protocol=pickle.HIGHEST_PROTOCOL)
+                job = (self._write_bytes, data)
+        thread = threading.Thread(target=self._finish_snapshot, args=(lsn,) + job,
+                                  name='snapshot', daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+    
+    def _wait_child(self, lsn, pid):
+        _, status = os.waitpid(pid, 0)
+        return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    
+    def _write_bytes(self, lsn, data):
+        path = os.path.join(self.directory, f'snapshot-{lsn:016d}.pkl')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        _fsync_dir(self.directory)
+        return True
+    
+    def _finish_snapshot(self, lsn, job, arg):
+        try:
+            started = time.perf_counter()
+            if not job(lsn, arg):
+                log.error('Не удалось записать снимок на lsn %d', lsn)
+                return
+            # Снимок готов: старые снимки и покрытые им сегменты больше не нужны
+            self.snapshot_lsn = lsn
+            for old_lsn, path in _numbered(self.directory, 'snapshot-', '.pkl'):
+                if old_lsn < lsn:
+                    os.remove(path)
+            self.log.truncate(lsn)
+            log.info('Снимок на lsn %d записан за %.2f с', lsn, time.perf_counter() - started)
+        finally:
+            self._snapshotting = False
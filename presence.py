@@ -0,0 +1,128 @@
+# Реестр присутствия: кто онлайн и через какие сокеты.
+#
+# Пользователь может быть подключен с нескольких вкладок и устройств, поэтому
+# хранятся обе стороны связи: sid -> логин и логин -> множество sid. Онлайн
+# объявляется при первом сокете пользователя, офлайн - когда закрылся последний
+# и пользователь не вернулся за FLAP_DEBOUNCE секунд. Переподключение внутри
+# этого окна (перезагрузка страницы, смена сети) не порождает событий вовсе.
+#
+# В режиме нескольких воркеров каждый держит свои сокеты, а о пользователях,
+# подключенных к другим воркерам, узнает из шины (remote_update). Объявляет
+# статус тот воркер, где пользователь появился первым или пропал последним.
+import threading
+import time
+from collections import defaultdict
+
+FLAP_DEBOUNCE = 3.0  # Секунды без сокетов, после которых пользователь офлайн
+
+
+class PresenceRegistry:
+    def __init__(self, debounce=FLAP_DEBOUNCE):
+        self.debounce = debounce
+        self._lock = threading.Lock()
+        self._sid_user = {}  # sid -> логин
+        self._user_sids = defaultdict(set)  # логин -> sid всех его сокетов
+        self._pending_offline = {}  # логин -> момент, когда объявить офлайн
+        self._subscribers = defaultdict(set)  # логин -> sid, подписанные на его статус
+        self._subscriptions = defaultdict(set)  # sid -> логины, на которые он подписан
+        self._remote = defaultdict(set)  # логин -> воркеры, где у него есть сокеты
+        self.on_local_change = None  # (логин, онлайн) при появлении/уходе пользователя с этого воркера
+    
+    def connect(self, sid, username):
+        # True, если о появлении пользователя нужно объявить
+        with self._lock:
+            current = self._sid_user.get(sid)
+            if current == username:
+                return False
+            if current is not None:
+                self._unbind(sid)
+            self._sid_user[sid] = username
+            sessions = self._user_sids[username]
+            sessions.add(sid)
+            if len(sessions) > 1:
+                return False
+            # Офлайн еще не объявлен - для остальных пользователь и не уходил
+            if self._pending_offline.pop(username, None) is not None:
+                return False
+            remote = bool(self._remote.get(username))
+        if self.on_local_change:
+            self.on_local_change(username, True)
+        return not remote
+    
+    def disconnect(self, sid):
+        # Возвращает логин, если закрылся последний сокет пользователя;
+        # офлайн будет объявлен через expired(), если он не вернется
+        with self._lock:
+            self._unsubscribe(sid)
+            if sid not in self._sid_user:
+                return None
+            return self._unbind(sid)
+    
+    def _unbind(self, sid):
+        username = self._sid_user.pop(sid)
+        sessions = self._user_sids[username]
+        sessions.discard(sid)
+        if sessions:
+            return None
+        del self._user_sids[username]
+        self._pending_offline[username] = time.monotonic() + self.debounce
+        return username
+    
+    def expired(self, now=None):
+        # Пользователи, чье окно переподключения истекло и у которых
+        # не осталось сокетов и на других воркерах - теперь они офлайн
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            due = [username for username, deadline in self._pending_offline.items() if deadline <= now]
+            for username in due:
+                del self._pending_offline[username]
+        if self.on_local_change:
+            for username in due:
+                self.on_local_change(username, False)
+        return [username for username in due if not self._remote.get(username)]
+    
+    def remote_update(self, worker, username, online):
+        with self._lock:
+            workers = self._remote[username]
+            if online:
+                workers.add(worker)
+            else:
+                workers.discard(worker)
+                if not workers:
+                    del self._remote[username]
+    
+    def is_online(self, username):
+        # Пользователь в окне переподключения еще считается онлайн
+        return (username in self._user_sids or username in self._pending_offline
+                or username in self._remote)
+    
+    def username(self, sid):
+        return self._sid_user.get(sid)
+    
+    def sessions(self, username):
+        return set(self._user_sids.get(username, ()))
+    
+    def online_count(self):
+        return len(self._user_sids)
+    
+    def subscribe(self, sid, usernames):
+        # Подписка сокета на статусы пользователей вне его чатов (например,
+        # из результатов поиска). Новый список заменяет предыдущий
+        with self._lock:
+            self._unsubscribe(sid)
+            targets = set(usernames)
+            if targets:
+                self._subscriptions[sid] = targets
+                for target in targets:
+                    self._subscribers[target].add(sid)
+    
+    def subscribers(self, username):
+        with self._lock:
+            return list(self._subscribers.get(username, ()))
+    
+    def _unsubscribe(self, sid):
+        for target in self._subscriptions.pop(sid, ()):
+            subscribers = self._subscribers[target]
+            subscribers.discard(sid)
+            if not subscribers:
+                del self._subscribers[target]
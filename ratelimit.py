@@ -0,0 +1,75 @@
+# Ограничение частоты событий корзинами токенов.
+#
+# У каждого ключа (сокет, пользователь, адрес) на каждое событие своя
+# корзина: rate токенов в секунду, не больше burst. Событие проходит, если
+# токен есть во всех его корзинах; тогда из каждой списывается по одному.
+# Отказ корзины не тратит токены остальных: сокет, упершийся в лимит
+# пользователя, не расходует свой. Полная корзина неотличима от
+# отсутствующей, поэтому такие раз в SWEEP_INTERVAL удаляются - память
+# ограничена ключами, которые были активны недавно.
+import threading
+import time
+from collections import Counter
+
+SWEEP_INTERVAL = 60.0  # Секунд между уборками полных корзин
+
+
+class RateLimiter:
+    def __init__(self, rules, scale=1.0):
+        # rules: событие -> (токенов в секунду, всплеск). scale умножает оба
+        # числа; 0 выключает ограничения
+        self.rules = {event: (rate * scale, max(1.0, burst * scale)) for event, (rate, burst) in rules.items()}
+        self.enabled = scale > 0
+        self._lock = threading.Lock()
+        self._buckets = {}  # (вид ключа, ключ) -> {событие: [токены, время пополнения]}
+        self._swept = time.monotonic()
+        self.throttled = Counter()  # (событие, вид ключа) -> отказов
+    
+    def acquire(self, event, keys, now=None):
+        # 0, если событие проходит; иначе сколько секунд ждать следующего токена.
+        # keys - [(вид ключа, ключ)], например [('sid', sid), ('user', логин)]
+        rule = self.rules.get(event)
+        if rule is None or not self.enabled:
+            return 0
+        rate, burst = rule
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now - self._swept >= SWEEP_INTERVAL:
+                self._sweep(now)
+            buckets = []
+            for key in keys:
+                events = self._buckets.get(key)
+                if events is None:
+                    events = self._buckets[key] = {}
+                bucket = events.get(event)
+                if bucket is None:
+                    bucket = events[event] = [burst, now]
+                else:
+                    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+                if bucket[0] < 1:
+                    self.throttled[(event, key[0])] += 1
+                    return (1 - bucket[0]) / rate
+                buckets.append(bucket)
+            for bucket in buckets:
+                bucket[0] -= 1
+        return 0
+    
+    def forget(self, key):
+        # Сокет закрылся - его корзины больше не нужны
+        with self._lock:
+            self._buckets.pop(key, None)
+    
+    def _sweep(self, now):
+        for key, events in list(self._buckets.items()):
+            for event, (tokens, stamp) in list(events.items()):
+                rate, burst = self.rules[event]
+                if tokens + (now - stamp) * rate >= burst:
+                    del events[event]
+            if not events:
+                del self._buckets[key]
+        self._swept = now
+    
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._buckets), 'throttled': dict(self.throttled)}
@@ -0,0 +1,423 @@
+# Поисковые индексы: пользователи для /api/search и текст сообщений для
+# /api/messages/search.
+#
+# Пользователи: префиксы ищутся бинарным поиском по отсортированным спискам
+# логинов и слов никнейма, подстроки - пересечением триграммных постинг-листов.
+# Результаты ранжируются по уровням (точное совпадение логина, префикс логина,
+# префикс никнейма, подстрока) и выдача прекращается, как только набран лимит.
+#
+# Сообщения: обратный индекс слово -> номера документов. Документ - сообщение,
+# номера выдаются по порядку сохранения, поэтому постинг-листы растут только
+# дописыванием в конец, а обход с конца дает самые свежие сообщения первыми.
+# Текст приводится к одному виду (casefold, ё -> е, без знаков ударения), от
+# слов запроса отрезается окончание, и основа находит все формы слова: слова
+# индекса, которые начинаются с нее и длиннее не больше чем на MAX_SUFFIX букв
+# ("проекты" находит "проект", "проекта" и "проектами").
+# Удаленные документы помечаются и пропускаются, а из постинг-листов
+# вычищаются в compact().
+import re
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+from heapq import merge
+
+TOKEN = re.compile(r'\w+')
+# Ударения и мягкий перенос в тексте встречаются, но на поиск влиять не должны
+STRIP = re.compile('[\u0300\u0301\u00ad]')
+# Окончания, которые отрезаются от слова запроса; длинные проверяются первыми
+ENDINGS = tuple(sorted((
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'иях', 'ах', 'ях', 'ов', 'ев', 'ей', 'ой', 'ий',
+    'ый', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ом', 'ем', 'ам', 'ям', 'ую', 'юю', 'ия', 'ть', 'а', 'я', 'о',
+    'е', 'ы', 'и', 'у', 'ю', 'ь'), key=len, reverse=True))
+MIN_STEM = 3  # Основа не короче трех букв: "елки" -> "елк", но "кот" остается целым
+MAX_SUFFIX = 3  # Сколько букв может добавить окончание к основе
+PREFIX_TERMS = 1000  # Сколько слов индекса может покрыть одна основа запроса
+SCOPE_COST = 8  # Во сколько раз проверка документа чата дороже шага по постинг-листу
+
+
+def normalize(text):
+    return STRIP.sub('', text.casefold().replace('ё', 'е'))
+
+
+def words(text):
+    # Слова текста для индекса; однобуквенные не индексируются
+    return {word for word in TOKEN.findall(normalize(text)) if len(word) > 1}
+
+
+def stem(word):
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def query_terms(query):
+    # [(слово или основа, искать ли по префиксу)]: короткие слова - только целиком
+    terms = []
+    for word in dict.fromkeys(TOKEN.findall(normalize(query))):
+        if len(word) > 2:
+            terms.append((stem(word), True))
+        elif len(word) == 2:
+            terms.append((word, False))
+    return list(dict.fromkeys(terms))
+
+
+def term_matches(word, term, prefix):
+    return word == term or (prefix and word.startswith(term) and len(word) - len(term) <= MAX_SUFFIX)
+
+
+def matches(text, terms):
+    # Есть ли в тексте все слова запроса (terms из query_terms)
+    text_words = words(text)
+    return all(any(term_matches(word, term, prefix) for word in text_words) for term, prefix in terms)
+
+
+def _contains(postings, doc):
+    pos = bisect_left(postings, doc)
+    return pos < len(postings) and postings[pos] == doc
+
+
+def _descending(postings, before):
+    # Номера документов меньше before, от больших к меньшим
+    pos = len(postings) if before is None else bisect_left(postings, before)
+    while pos > 0:
+        pos -= 1
+        yield postings[pos]
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class UserSearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usernames = []  # Отсортированные логины
+        self._nickname_terms = []  # Отсортированные (слово никнейма, логин)
+        self._trigrams = defaultdict(set)  # триграмма -> логины
+        self._keys = {}  # логин -> никнейм в нижнем регистре
+    
+    def __len__(self):
+        return len(self._keys)
+    
+    def __getstate__(self):
+        # Блокировку не берем: снимок делается в дочернем процессе после fork
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    def add(self, username, nickname):
+        with self._lock:
+            if username in self._keys:
+                self._remove(username)
+            self._add(username, nickname)
+    
+    def add_many(self, items):
+        # Массовая загрузка (старт, сидинг): одна сортировка вместо insort на каждого
+        with self._lock:
+            updates = []
+            for username, nickname in items:
+                if username in self._keys:
+                    updates.append((username, nickname))
+                    continue
+                nickname = nickname.lower()
+                self._keys[username] = nickname
+                self._usernames.append(username)
+                for term in self._terms(nickname):
+                    self._nickname_terms.append((term, username))
+                for gram in trigrams(username) | trigrams(nickname):
+                    self._trigrams[gram].add(username)
+            self._usernames.sort()
+            self._nickname_terms.sort()
+            for username, nickname in updates:
+                self._remove(username)
+                self._add(username, nickname)
+    
+    def update(self, username, nickname):
+        self.add(username, nickname)
+    
+    def remove(self, username):
+        with self._lock:
+            if username in self._keys:
+                self._remove(username)
+    
+    def _terms(self, nickname):
+        return {nickname} | set(nickname.split())
+    
+    def _add(self, username, nickname):
+        nickname = nickname.lower()
+        self._keys[username] = nickname
+        insort(self._usernames, username)
+        for term in self._terms(nickname):
+            insort(self._nickname_terms, (term, username))
+        for gram in trigrams(username) | trigrams(nickname):
+            self._trigrams[gram].add(username)
+    
+    def _remove(self, username):
+        nickname = self._keys.pop(username)
+        pos = bisect_left(self._usernames, username)
+        del self._usernames[pos]
+        for term in self._terms(nickname):
+            pos = bisect_left(self._nickname_terms, (term, username))
+            del self._nickname_terms[pos]
+        for gram in trigrams(username) | trigrams(nickname):
+            postings = self._trigrams[gram]
+            postings.discard(username)
+            if not postings:
+                del self._trigrams[gram]
+    
+    def search(self, query, limit=50, exclude=None):
+        query = query.lower()
+        if not query:
+            return []
+        
+        with self._lock:
+            results = []
+            seen = {exclude}
+            
+            def take(username):
+                if username not in seen:
+                    seen.add(username)
+                    results.append(username)
+                return len(results) >= limit
+            
+            # 1-2. Точное совпадение и префикс логина
+            if query in self._keys and take(query):
+                return results
+            pos = bisect_left(self._usernames, query)
+            while pos < len(self._usernames) and self._usernames[pos].startswith(query):
+                if take(self._usernames[pos]):
+                    return results
+                pos += 1
+            
+            # 3. Префикс никнейма или одного из его слов
+            pos = bisect_left(self._nickname_terms, (query,))
+            while pos < len(self._nickname_terms) and self._nickname_terms[pos][0].startswith(query):
+                if take(self._nickname_terms[pos][1]):
+                    return results
+                pos += 1
+            
+            # 4. Подстрока
+            for username in self._substring_candidates(query):
+                if username in seen:
+                    continue
+                if query in username or query in self._keys[username]:
+                    if take(username):
+                        return results
+            return results
+    
+    def _substring_candidates(self, query):
+        if len(query) < 3:
+            # Для коротких запросов триграмм нет. Совпадения у них плотные,
+            # поэтому перебор обычно останавливается на лимите почти сразу
+            return self._keys
+        postings = []
+        for gram in trigrams(query):
+            if gram not in self._trigrams:
+                return ()
+            postings.append(self._trigrams[gram])
+        postings.sort(key=len)
+        return set.intersection(*postings) if len(postings) > 1 else postings[0]
+
+
+class MessageSearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}  # слово -> array номеров документов по возрастанию
+        self._terms = []  # Отсортированные слова индекса для поиска по префиксу
+        self._doc_chat = array('I')  # документ -> номер чата
+        self._doc_seq = array('I')  # документ -> seq сообщения
+        self._dead = bytearray()  # документ -> 1, если сообщение удалено
+        self._chat_docs = []  # номер чата -> array документов по seq (seq 1 - позиция 0)
+        self._chat_numbers = {}  # chat_id -> номер чата
+        self._chat_ids = []
+        self.deleted = 0  # Удаленных документов
+        self.purged = 0  # Из них уже вычищенных из постинг-листов
+    
+    def __len__(self):
+        return len(self._doc_chat) - self.deleted
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    def stats(self):
+        # Размер индекса: документы, слова, элементы постинг-листов и байты
+        # массивов (без накладных расходов словаря и самих строк слов)
+        with self._lock:
+            postings = sum(len(docs) for docs in self._postings.values())
+            chat_docs = sum(len(docs) for docs in self._chat_docs)
+            return {
+                'documents': len(self._doc_chat) - self.deleted,
+                'terms': len(self._postings),
+                'postings': postings,
+                'array_bytes': (postings + chat_docs + 2 * len(self._doc_chat)) * 4 + len(self._dead)
+            }
+    
+    def add(self, chat_id, seq, text):
+        with self._lock:
+            self._add(chat_id, seq, text)
+    
+    def add_many(self, items):
+        # Массовая загрузка [(chat_id, seq, текст)] в порядке сохранения:
+        # одна сортировка словаря вместо insort на каждое новое слово
+        with self._lock:
+            terms = self._terms
+            self._terms = None
+            try:
+                for chat_id, seq, text in items:
+                    self._add(chat_id, seq, text)
+            finally:
+                self._terms = terms
+                terms[:] = sorted(self._postings)
+    
+    def update(self, chat_id, seq, old_text, new_text):
+        # Правка: документ остается тем же, меняются только его слова
+        with self._lock:
+            doc = self._doc(chat_id, seq)
+            if doc is None:
+                return
+            old, new = words(old_text), words(new_text)
+            for word in old - new:
+                postings = self._postings.get(word)
+                if postings is None or not _contains(postings, doc):
+                    continue
+                del postings[bisect_left(postings, doc)]
+                if not postings:
+                    del self._postings[word]
+                    del self._terms[bisect_left(self._terms, word)]
+            for word in new - old:
+                postings = self._postings.get(word)
+                if postings is None:
+                    self._postings[word] = array('I', (doc,))
+                    insort(self._terms, word)
+                else:
+                    insort(postings, doc)
+    
+    def remove(self, chat_id, seq):
+        with self._lock:
+            doc = self._doc(chat_id, seq)
+            if doc is not None and not self._dead[doc]:
+                self._dead[doc] = 1
+                self.deleted += 1
+    
+    def compact(self):
+        # Вычищает удаленные документы из постинг-листов, когда их набралось
+        # много. Номера документов не меняются, курсоры страниц остаются верными
+        with self._lock:
+            if (self.deleted - self.purged) * 4 < len(self._doc_chat):
+                return 0
+            dead = self._dead
+            for word in list(self._postings):
+                postings = array('I', (doc for doc in self._postings[word] if not dead[doc]))
+                if postings:
+                    self._postings[word] = postings
+                else:
+                    del self._postings[word]
+            self._terms = sorted(self._postings)
+            purged, self.purged = self.deleted - self.purged, self.deleted
+            return purged
+    
+    def search(self, query, chat_ids, before=None, limit=50):
+        # Сообщения чатов chat_ids со всеми словами запроса, от новых к старым.
+        # ([(chat_id, seq)], курсор следующей страницы или None)
+        with self._lock:
+            groups = []
+            for term, prefix in query_terms(query):
+                postings = self._expand(term) if prefix else [self._postings.get(term)]
+                postings = [docs for docs in postings if docs]
+                if not postings:
+                    return [], None
+                groups.append(postings)
+            scope = {self._chat_numbers[chat_id] for chat_id in chat_ids if chat_id in self._chat_numbers}
+            if not groups or not scope:
+                return [], None
+            
+            # Самое редкое слово задает кандидатов, остальные проверяются
+            # бинарным поиском. Если в чатах пользователя сообщений меньше,
+            # чем кандидатов, выгоднее идти по документам самих чатов
+            groups.sort(key=lambda postings: sum(map(len, postings)))
+            driver = groups[0]
+            scope_size = sum(len(self._chat_docs[number]) for number in scope)
+            if sum(map(len, driver)) <= scope_size * SCOPE_COST:
+                candidates = self._merge(driver, before)
+                checks = groups[1:]
+            else:
+                candidates = self._merge([self._chat_docs[number] for number in scope], before)
+                checks = groups
+            
+            found = []
+            last = None
+            doc_chat, dead = self._doc_chat, self._dead
+            for doc in candidates:
+                if doc == last or dead[doc] or doc_chat[doc] not in scope:
+                    continue
+                last = doc
+                if all(any(_contains(docs, doc) for docs in postings) for postings in checks):
+                    found.append(doc)
+                    if len(found) == limit:
+                        break
+            hits = [(self._chat_ids[doc_chat[doc]], self._doc_seq[doc]) for doc in found]
+            return hits, (found[-1] if len(found) == limit else None)
+    
+    def _add(self, chat_id, seq, text):
+        number = self._chat_numbers.get(chat_id)
+        if number is None:
+            number = self._chat_numbers[chat_id] = len(self._chat_ids)
+            self._chat_ids.append(chat_id)
+            self._chat_docs.append(array('I'))
+        chat_docs = self._chat_docs[number]
+        if len(chat_docs) >= seq:
+            return  # Уже в индексе
+        doc = len(self._doc_chat)
+        if len(chat_docs) < seq - 1:
+            # Пропуски seq (сообщения, убранные compact() до построения индекса)
+            # заполняются предыдущим номером, чтобы массив оставался отсортированным
+            chat_docs.extend([chat_docs[-1] if chat_docs else doc] * (seq - 1 - len(chat_docs)))
+        chat_docs.append(doc)
+        self._doc_chat.append(number)
+        self._doc_seq.append(seq)
+        self._dead.append(0)
+        for word in words(text):
+            postings = self._postings.get(word)
+            if postings is None:
+                self._postings[word] = array('I', (doc,))
+                if self._terms is not None:
+                    insort(self._terms, word)
+            else:
+                postings.append(doc)
+    
+    def _doc(self, chat_id, seq):
+        number = self._chat_numbers.get(chat_id)
+        if number is None or not 0 < seq <= len(self._chat_docs[number]):
+            return None
+        doc = self._chat_docs[number][seq - 1]
+        if self._doc_chat[doc] != number or self._doc_seq[doc] != seq:
+            return None  # Заполненный пропуск
+        return doc
+    
+    def _expand(self, stem):
+        # Постинг-листы всех форм слова с этой основой
+        terms = self._terms
+        pos = bisect_left(terms, stem)
+        postings = []
+        while pos < len(terms) and terms[pos].startswith(stem) and len(postings) < PREFIX_TERMS:
+            if len(terms[pos]) - len(stem) <= MAX_SUFFIX:
+                postings.append(self._postings[terms[pos]])
+            pos += 1
+        return postings
+    
+    def _merge(self, postings, before):
+        if len(postings) == 1:
+            return _descending(postings[0], before)
+        return merge(*(_descending(docs, before) for docs in postings), reverse=True)
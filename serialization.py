@@ -0,0 +1,84 @@
+# Быстрая сериализация ответов REST и событий Socket.IO.
+#
+# orjson (если установлен) кодирует в разы быстрее стандартного json и пишет
+# кириллицу как есть в UTF-8, а не escape-последовательностями \uXXXX по 6
+# байт на букву. Без orjson все работает на стандартном json с теми же
+# настройками. DEEPLINK_JSON=stdlib принудительно выключает orjson (для
+# сравнения в бенчмарках).
+#
+# Socket.IO дополнительно умеет MessagePack (DEEPLINK_SOCKETIO_SERIALIZER=
+# msgpack): режим общий для сервера, клиент узнает его из /api/config и
+# подключает сборку socket.io с парсером msgpack.
+#
+# Оба пакета необязательные и ставятся из PyPI: pip install orjson msgpack
+# (см. README). msgpack нужен только в режиме msgpack.
+import json
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if os.environ.get('DEEPLINK_JSON') == 'stdlib':
+    orjson = None
+
+SOCKETIO_SERIALIZER = os.environ.get('DEEPLINK_SOCKETIO_SERIALIZER', 'json')
+if SOCKETIO_SERIALIZER not in ('json', 'msgpack'):
+    raise RuntimeError(f'Неизвестный DEEPLINK_SOCKETIO_SERIALIZER: {SOCKETIO_SERIALIZER}')
+
+if orjson is not None:
+    OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def dumps_bytes(obj):
+    # JSON в UTF-8: тело ответа и кадр шины
+    if orjson is not None:
+        return orjson.dumps(obj, option=OPTIONS)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(obj, **kwargs):
+    # Совместимо с json.dumps для Socket.IO и Engine.IO; они передают только
+    # separators=(',', ':'), а orjson и так пишет без пробелов
+    if orjson is not None:
+        return orjson.dumps(obj, option=OPTIONS).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def loads(data, **kwargs):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSON:
+    # Модуль json для SocketIO(json=...): нужны только dumps и loads
+    dumps = staticmethod(dumps)
+    loads = staticmethod(loads)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    # jsonify() без промежуточной строки: тело ответа сразу байтами.
+    # Ключи не сортируются - клиенту порядок не важен
+    sort_keys = False
+    ensure_ascii = False
+    
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=OPTIONS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=OPTIONS),
+                                        mimetype=self.mimetype)
@@ -1,39 +1,417 @@
-from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO, emit, join_room, leave_room
-import json
+from flask import Flask, Response, request, jsonify
+from flask_socketio import SocketIO, ConnectionRefusedError, emit, join_room, leave_room
+import atexit
 import os
+import threading
+import time
 import uuid
 from datetime import datetime
-from collections import defaultdict
+from functools import wraps
 import logging
+from storage import create_storage, MEMBER_PAGE_SIZE, PAGE_SIZE
+from presence import PresenceRegistry
+from typing_engine import TypingEngine
+from bus import create_bus, BusManager
+from metrics import Registry, SamplingProfiler, instrument_app, instrument_socketio
+from assets import StaticAsset
+from outbound import BoundedManager, OutboundQueues
+from ratelimit import RateLimiter
+from serialization import FastJSON, FastJSONProvider, SOCKETIO_SERIALIZER
 
 logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__, template_folder='.', static_folder='.')
 app.config['SECRET_KEY'] = 'deeplink-neon-secret-2024'
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-# База данных в памяти
-users = {}
-chats = {}
-messages = defaultdict(list)
-user_chats = defaultdict(set)
-online_users = {}
-user_settings = defaultdict(dict)
-deleted_messages = set()  # Для удаленных сообщений
-message_reactions = defaultdict(dict)  # Реакции на сообщения
+app.json = FastJSONProvider(app)  # jsonify через orjson, если он установлен
+
+# Каталог журнала и снимков; пустая строка - хранить все только в памяти
+DATA_DIR = os.environ.get('DEEPLINK_DATA_DIR', 'data')
+SYNC_COMMIT = os.environ.get('DEEPLINK_SYNC_COMMIT') == '1'  # Ждать fsync перед ответом
+# Записей журнала между снимками; 0 - без снимков, только журнал
+SNAPSHOT_EVERY = int(os.environ.get('DEEPLINK_SNAPSHOT_EVERY', '500000'))
+# Память под сообщения хранилища в памяти, МБ (можно дробное); остальная
+# история уходит в сегменты в каталоге данных. 0 - держать в памяти все
+HOT_MESSAGES_MB = float(os.environ.get('DEEPLINK_HOT_MESSAGES_MB', '256'))
+
+# Режим нескольких воркеров (workers.py): сокет брокера шины и номер воркера
+BUS_PATH = os.environ.get('DEEPLINK_BUS', '')
+WORKER_ID = int(os.environ.get('DEEPLINK_WORKER', '0'))
+
+# Параметры соединений (workers.py). Поддерживается модель threading;
+# eventlet и gevent экспериментальные и не тестируются (см. workers.py)
+ASYNC_MODE = os.environ.get('DEEPLINK_ASYNC_MODE', 'threading')
+MAX_CONNECTIONS = int(os.environ.get('DEEPLINK_MAX_CONNECTIONS', '10000'))  # Сокетов на воркер
+PING_INTERVAL = float(os.environ.get('DEEPLINK_PING_INTERVAL', '25'))
+PING_TIMEOUT = float(os.environ.get('DEEPLINK_PING_TIMEOUT', '20'))
+# Пакетов в исходящей очереди сокета, после которых медленный клиент
+# отключается; 0 - без предела
+OUTBOUND_QUEUE = int(os.environ.get('DEEPLINK_OUTBOUND_QUEUE', '1000'))
+OUTBOUND_FLUSH = 0.25  # Секунд между попытками отдать отложенные события
+
+# Частота событий Socket.IO и REST-мутаторов: имя -> (в секунду, всплеск).
+# Корзины отдельно на сокет (для REST - на адрес) и на пользователя.
+# DEEPLINK_RATE_LIMIT_SCALE умножает все пределы, 0 выключает их (бенчмарки)
+RATE_LIMIT_SCALE = float(os.environ.get('DEEPLINK_RATE_LIMIT_SCALE', '1'))
+RATE_LIMITS = {
+    'send_message': (10, 30),
+    'edit_message': (5, 20),
+    'typing': (10, 20),
+    'read_up_to': (20, 50),
+    'read_message': (20, 50),
+    'sync': (2, 10),
+    'join_chat': (20, 50),
+    'leave_chat': (20, 50),
+    'user_online': (2, 10),
+    'user_offline': (2, 10),
+    'subscribe_presence': (5, 20),
+    'api_register': (0.2, 5),
+    'api_login': (1, 10),
+    'api_chat_create': (2, 20),
+    'api_group_create': (1, 10),
+    'api_chat_members_add': (5, 20),
+    'api_chat_members_remove': (5, 20),
+    'api_chat_members_role': (5, 20),
+    'api_user_update': (2, 10),
+    'api_settings_update': (2, 10),
+    'api_message_delete': (5, 20),
+    'api_message_react': (10, 30),
+    'api_chat_clear': (1, 5)
+}
+# Об отказе в этих событиях клиент узнает (rate_limited), остальные теряются молча
+NOTIFY_THROTTLED = ('send_message', 'edit_message')
+
+bus = create_bus(BUS_PATH)
+outbound = OutboundQueues(OUTBOUND_QUEUE)
+limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_SCALE)
+socketio_options = {
+    'cors_allowed_origins': "*",
+    'async_mode': ASYNC_MODE,
+    'ping_interval': PING_INTERVAL,
+    'ping_timeout': PING_TIMEOUT,
+    'json': FastJSON,
+    # json или msgpack; клиент узнает режим из /api/config
+    'serializer': 'msgpack' if SOCKETIO_SERIALIZER == 'msgpack' else 'default'
+}
+if BUS_PATH:
+    # События комнат уходят через шину во все воркеры
+    socketio = SocketIO(app, client_manager=BusManager(bus, outbound=outbound), **socketio_options)
+else:
+    socketio = SocketIO(app, client_manager=BoundedManager(outbound), **socketio_options)
+
+# Пользователи, чаты, сообщения, реакции и настройки (DEEPLINK_STORAGE=memory|sqlite).
+# Воркеры делят одну базу SQLite; хранилище в памяти у каждого процесса свое
+store = create_storage(shared=bool(BUS_PATH))
+if BUS_PATH and not getattr(store, 'shared', False):
+    raise RuntimeError('Для нескольких воркеров нужно общее хранилище: DEEPLINK_STORAGE=sqlite')
+atexit.register(store.close)
+
+# Состояние соединений живет только в памяти процесса
+presence = PresenceRegistry()  # sid <-> пользователь, несколько вкладок на пользователя
+background_tasks = None  # Фоновые задачи: офлайн после окна переподключения, истечение набора
+background_lock = threading.Lock()
+connections = 0  # Открытых сокетов на этом воркере
+connections_lock = threading.Lock()
 user_presence = {}  # Онлайн статус
-typing_status = {}  # Статус набора
+typing = TypingEngine()  # Статус набора: слияние нажатий и истечение по TTL
+chat_create_lock = threading.Lock()  # Проверка и создание приватного чата атомарны
+
+PROFILE_FIELDS = ('nickname', 'bio', 'avatar', 'privacy', 'theme')
+
+SEARCH_LIMIT = 50
+
+MAX_PAGE_SIZE = 200
+
+SYNC_LIMIT = 500  # Событий ленты в одном ответе /api/sync
+
+# Реакция - эмодзи; с модификаторами и составными последовательностями
+# это до десятка символов. Длиннее - не эмодзи, и интернировать его нельзя
+MAX_REACTION_LENGTH = 16
+
+MAX_CHAT_NAME_LENGTH = 64  # Название группы или канала видят все участники
+
+# Роли в группах и каналах. Подписчик канала только читает
+GROUP_TYPES = {'group': 'member', 'channel': 'subscriber'}  # тип -> роль нового участника
+POSTING_ROLES = ('owner', 'admin', 'member')
+MANAGING_ROLES = ('owner', 'admin')
+
+# Приложение отдается заранее сжатым. URL у него постоянный, поэтому браузер
+# каждый раз переспрашивает по ETag и при неизменном файле получает 304
+spa = StaticAsset(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html'), 'text/html')
+
+# Удаленные сообщения физически убираются, когда событие message_deleted
+# давно доставлено: подключенные клиенты его применили, а новые загрузки
+# истории удаленных сообщений уже не содержат
+TOMBSTONE_GRACE = float(os.environ.get('DEEPLINK_TOMBSTONE_GRACE', '60'))  # Секунд после удаления
+# Секунд между уборками: удаленные, слияние блоков холодной истории, файлы сегментов
+COMPACT_INTERVAL = float(os.environ.get('DEEPLINK_COMPACT_INTERVAL', '30'))
+
+# Метрики для /metrics; профилировщик включается на ходу через /metrics/profile,
+# если разрешен переменной DEEPLINK_PROFILER=1
+metrics = Registry()
+profiler = SamplingProfiler()
+PROFILER_ENABLED = os.environ.get('DEEPLINK_PROFILER') == '1'
+
+def room_stats():
+    # {(вид комнаты, показатель): значение} по комнатам Socket.IO этого воркера.
+    # Личные комнаты сокетов (имя = sid) и комната всех сокетов (None) не считаются
+    result = {}
+    for room, members in list(socketio.server.manager.rooms.get('/', {}).items()):
+        if room is None or room in members:
+            continue
+        kind = 'user' if room.startswith('user:') else 'chat'
+        size = len(members)
+        result[(kind, 'rooms')] = result.get((kind, 'rooms'), 0) + 1
+        result[(kind, 'sockets')] = result.get((kind, 'sockets'), 0) + size
+        result[(kind, 'max_sockets')] = max(result.get((kind, 'max_sockets'), 0), size)
+    return result
+
+metrics.gauge('deeplink_worker_info', 'Номер воркера', lambda: {str(WORKER_ID): 1}, ('worker',))
+metrics.gauge('deeplink_store_objects', 'Размеры хранилища', lambda: store.stats(), ('kind',))
+metrics.gauge('deeplink_connections', 'Открытые сокеты Socket.IO', lambda: connections)
+metrics.gauge('deeplink_online_users', 'Пользователи с сокетами на этом воркере', presence.online_count)
+metrics.gauge('deeplink_typing_active', 'Пары (чат, пользователь), где сейчас печатают',
+              lambda: typing.stats()['active'])
+metrics.gauge('deeplink_typing_events_total', 'События набора по исходу',
+              lambda: {key: value for key, value in typing.stats().items() if key != 'active'},
+              ('result',), kind='counter')
+metrics.gauge('deeplink_room_fanout', 'Комнаты Socket.IO и число сокетов в них', room_stats, ('kind', 'stat'))
+metrics.gauge('deeplink_message_tier_events_total',
+              'Страницы истории из памяти и с диска, подкачки, вытеснения и выгруженные сообщения',
+              lambda: store.tier_stats()['events'], ('event',), kind='counter')
+metrics.gauge('deeplink_message_tier', 'Сообщения в памяти и на диске: бюджет, байты, чаты, файлы',
+              lambda: store.tier_stats()['size'], ('stat',))
+metrics.gauge('deeplink_rate_limited_total', 'Отклоненные ограничением частоты события по ключу корзины',
+              lambda: limiter.stats()['throttled'], ('event', 'scope'), kind='counter')
+metrics.gauge('deeplink_outbound_events_total',
+              'Исходящие события медленным клиентам: отложены, слиты, выброшены, отключение по переполнению',
+              lambda: outbound.stats()['events'], ('event', 'result'), kind='counter')
+metrics.gauge('deeplink_outbound_queue', 'Исходящие очереди сокетов: наибольшая и суммарная глубина в пакетах',
+              lambda: outbound.depths(socketio.server), ('stat',))
+metrics.gauge('deeplink_outbound_pending', 'Отложенные малоценные события', lambda: outbound.stats()['pending'])
+metrics.gauge('deeplink_profiler_samples', 'Снимков стеков с последнего запуска профилировщика',
+              lambda: profiler.samples)
+sync_requests = metrics.counter('deeplink_sync_total', 'Запросы синхронизации по исходу', ('result',))
 
 def generate_avatar(username):
     return f"https://ui-avatars.com/api/?name={username}&background=0a0a0a&color=ffffff&bold=true&size=128"
 
+def publish_presence(username, online):
+    bus.publish('presence', {'worker': WORKER_ID, 'username': username, 'online': online})
+
+def on_remote_presence(data):
+    if data['worker'] == WORKER_ID:
+        return
+    username = data['username']
+    was_online = presence.is_online(username)
+    presence.remote_update(data['worker'], username, data['online'])
+    if presence.is_online(username) != was_online:
+        # Собеседникам статус разошлет воркер пользователя через его комнаты,
+        # а о подписчиках на этом воркере он не знает - уведомляем их здесь
+        contacts = store.contacts(username)
+        sids = [sid for sid in presence.subscribers(username) if presence.username(sid) not in contacts]
+        if sids:
+            status = 'online' if data['online'] else 'offline'
+            socketio.emit(f'user_{status}', {'username': username}, to=sids)
+
+def publish_user(username, nickname):
+    # Индекс поиска у каждого воркера свой - сообщаем остальным о новом никнейме
+    bus.publish('users', {'worker': WORKER_ID, 'username': username, 'nickname': nickname})
+
+def on_remote_user(data):
+    if data['worker'] != WORKER_ID:
+        store.user_search.add(data['username'], data['nickname'])
+
+presence.on_local_change = publish_presence
+bus.subscribe('presence', on_remote_presence)
+bus.subscribe('users', on_remote_user)
+
+def mark_read(chat_id, username, seq):
+    # Одна квитанция в комнату чата, если отметка сдвинулась
+    mark = store.read_up_to(chat_id, username, seq)
+    if mark:
+        socketio.emit('messages_read', {'chat_id': chat_id, 'username': username, 'seq': mark}, to=chat_id)
+
+def feed_cursor(seq):
+    # Курсор для клиента: эпоха ленты и номер последнего события
+    return f'{store.epoch}:{seq}'
+
+def publish_change(chat_id, event, data, to=None):
+    # Событие чата пишется в ленту изменений и рассылается с курсором.
+    # В ленту уходит копия: сообщение в памяти меняется при правке
+    data = dict(data)
+    seq = store.record_change(chat_id, event, data)
+    socketio.emit(event, dict(data, cursor=feed_cursor(seq)), to=to or chat_id)
+
+def coalesce_changes(changes):
+    # Из правок одного сообщения нужна только последняя, а события сообщения,
+    # удаленного позже, клиенту уже не нужны - кроме самого удаления.
+    # Реакции приходят изменениями счетчиков, их пропускать нельзя
+    kept = []
+    superseded = set()
+    deleted = set()
+    for _, _, event, data in reversed(changes):
+        message_id = data['id'] if event == 'new_message' else data.get('message_id')
+        if event == 'message_deleted':
+            deleted.add(message_id)
+        elif message_id in deleted:
+            continue
+        elif event == 'message_edited':
+            if message_id in superseded:
+                continue
+            superseded.add(message_id)
+        kept.append({'event': event, 'data': data})
+    kept.reverse()
+    return kept
+
+def sync_changes(username, since):
+    # События чатов пользователя после курсора. reset - курсор из другой
+    # эпохи или вытеснен из буфера: клиент перезагружает чаты целиком
+    epoch, _, seq = (since or '').partition(':')
+    seq = int(seq) if epoch == str(store.epoch) and seq.isdigit() else None
+    position, changes = store.changes_since(seq, store.user_chat_ids(username), SYNC_LIMIT)
+    if changes is None:
+        sync_requests.inc('reset')
+        return {'reset': True, 'cursor': feed_cursor(position), 'events': [], 'more': False}
+    sync_requests.inc('delta')
+    return {
+        'reset': False,
+        'cursor': feed_cursor(position),
+        'events': coalesce_changes(changes),
+        'more': len(changes) == SYNC_LIMIT
+    }
+
+def conditional(tag, build):
+    # Условный GET по версии сущности: версия читается до построения ответа,
+    # поэтому ETag никогда не новее тела. Совпала - 304 без построения
+    etag = f'{store.epoch}-{tag}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def user_room(username):
+    # Личная комната: в ней все сокеты пользователя
+    return f'user:{username}'
+
+def announce_presence(username, status):
+    # Статус получают только собеседники по чатам и подписчики, а не все сокеты
+    store.set_presence(username, status, datetime.now().isoformat())
+    contacts = store.contacts(username)
+    rooms = [user_room(contact) for contact in contacts if presence.is_online(contact)]
+    rooms.extend(sid for sid in presence.subscribers(username) if presence.username(sid) not in contacts)
+    if rooms:
+        socketio.emit(f'user_{status}', {'username': username}, to=rooms)
+
+def flush_presence():
+    while True:
+        socketio.sleep(presence.debounce / 4)
+        for username in presence.expired():
+            announce_presence(username, 'offline')
+
+def sweep_typing():
+    # Набор, о конце которого клиент не сообщил, гасим по TTL
+    while True:
+        socketio.sleep(typing.interval / 2)
+        for chat_id, username in typing.sweep():
+            socketio.emit('user_typing', {
+                'chat_id': chat_id,
+                'username': username,
+                'is_typing': False
+            }, to=chat_id)
+
+def flush_outbound():
+    # Отложенные события набора и статуса - сокетам, разобравшим очередь
+    while True:
+        socketio.sleep(OUTBOUND_FLUSH)
+        outbound.flush(socketio.server)
+
+def compact_tombstones():
+    while True:
+        socketio.sleep(COMPACT_INTERVAL)
+        removed = store.compact(time.time() - TOMBSTONE_GRACE)
+        if removed:
+            logging.info(f'Убрано удаленных сообщений: {removed}')
+
+def start_background_tasks():
+    global background_tasks
+    with background_lock:
+        if background_tasks is None:
+            background_tasks = [socketio.start_background_task(flush_presence),
+                                socketio.start_background_task(sweep_typing),
+                                socketio.start_background_task(flush_outbound)]
+            if WORKER_ID == 0:
+                # База общая, убирать удаленные достаточно одному воркеру
+                background_tasks.append(socketio.start_background_task(compact_tombstones))
+
+def throttled(wait):
+    # Ответ REST-мутатора на превышение частоты
+    response = jsonify({'success': False, 'error': 'Слишком много запросов, попробуйте позже',
+                        'retry_after': round(wait, 2)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, round(wait)))
+    return response
+
+def rate_limited(anonymous=False):
+    # Корзины REST-мутатора: адрес всегда, плюс пользователь из тела запроса.
+    # Имя в теле выбирает клиент, поэтому одно оно лимит не держит: сменой
+    # имени на каждом запросе обходится корзина пользователя, но не адреса.
+    # anonymous - пользователя еще нет (регистрация), только адрес
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(silent=True)
+            data = data if isinstance(data, dict) else {}
+            username = None if anonymous else data.get('username') or data.get('creator') or data.get('user1')
+            keys = [('addr', request.remote_addr)]
+            if isinstance(username, str) and username:
+                keys.append(('user', username.strip().lower()))
+            wait = limiter.acquire(view.__name__, keys)
+            if wait:
+                return throttled(wait)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def rate_limit_socketio():
+    # Оборачивает обработчики событий из RATE_LIMITS корзинами сокета и пользователя
+    for handlers in socketio.server.handlers.values():
+        for event, handler in list(handlers.items()):
+            if event in RATE_LIMITS:
+                handlers[event] = socket_rate_limited(handler, event)
+
+def socket_rate_limited(handler, event):
+    @wraps(handler)
+    def wrapper(sid, *args):
+        # Пользователь сокета, а до user_online - тот, от чьего имени событие
+        data = args[0] if args and isinstance(args[0], dict) else {}
+        username = presence.username(sid) or data.get('username') or data.get('sender')
+        keys = [('sid', sid)]
+        if isinstance(username, str) and username:
+            keys.append(('user', username))
+        wait = limiter.acquire(event, keys)
+        if wait:
+            if event in NOTIFY_THROTTLED:
+                socketio.emit('rate_limited', {'event': event, 'retry_after': round(wait, 2)}, to=sid)
+            return None
+        return handler(sid, *args)
+    return wrapper
+
+def open_persistence(directory, **options):
+    # Журнал и снимки нужны только хранилищу в памяти, SQLite пишет на диск сам
+    if not hasattr(store, 'open'):
+        return None
+    return store.open(directory, **options)
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return spa.serve(request)
 
 # API
 @app.route('/api/register', methods=['POST'])
+@rate_limited(anonymous=True)
 def api_register():
     data = request.get_json()
     username = data.get('username', '').strip().lower()
@@ -43,14 +421,14 @@ def api_register():
     if not username or not password:
         return jsonify({'success': False, 'error': 'Заполните все поля'})
     
-    if username in users:
+    if store.get_user(username):
         return jsonify({'success': False, 'error': 'Имя пользователя уже занято'})
     
     if password == username:
         return jsonify({'success': False, 'error': 'Пароль не может совпадать с логином'})
     
     user_id = str(uuid.uuid4())
-    users[username] = {
+    user = {
         'id': user_id,
         'username': username,
         'password': password,
@@ -65,7 +443,7 @@ def api_register():
     }
     
     # Создаем настройки по умолчанию
-    user_settings[username] = {
+    settings = {
         'notifications': True,
         'sound': True,
         'vibration': True,
@@ -75,6 +453,8 @@ def api_register():
         'auto_download': True,
         'save_to_gallery': False
     }
+    store.add_user(user, settings)
+    publish_user(username, nickname)
     
     return jsonify({
         'success': True,
@@ -87,6 +467,7 @@ def api_register():
     })
 
 @app.route('/api/login', methods=['POST'])
+@rate_limited()
 def api_login():
     data = request.get_json()
     username = data.get('username', '').strip().lower()
@@ -95,15 +476,14 @@ def api_login():
     if not username or not password:
         return jsonify({'success': False, 'error': 'Заполните все поля'})
     
-    user = users.get(username)
+    user = store.get_user(username)
     if not user:
         return jsonify({'success': False, 'error': 'Пользователь не найден'})
     
     if user['password'] != password:
         return jsonify({'success': False, 'error': 'Неверный пароль'})
     
-    user['status'] = 'online'
-    user['last_seen'] = datetime.now().isoformat()
+    store.set_presence(username, 'online', datetime.now().isoformat())
     
     return jsonify({
         'success': True,
@@ -123,23 +503,35 @@ def api_search():
     if not query:
         return jsonify([])
     
+    # Индекс отдает уже ранжированные логины и останавливается на лимите
     results = []
-    for username, user in users.items():
-        if username == current_user:
-            continue
+    for username in store.search_users(query, limit=SEARCH_LIMIT, exclude=current_user):
+        user = store.get_user(username)
+        results.append({
+            'username': user['username'],
+            'nickname': user['nickname'],
+            'avatar': user['avatar'],
+            'status': user['status'],
+            'last_seen': user['last_seen'],
+            'bio': user['bio'][:100] + '...' if len(user['bio']) > 100 else user['bio']
+        })
         
-        if (query in username.lower() or 
-            query in user.get('nickname', '').lower()):
-            results.append({
-                'username': user['username'],
-                'nickname': user['nickname'],
-                'avatar': user['avatar'],
-                'status': user['status'],
-                'last_seen': user['last_seen'],
-                'bio': user['bio'][:100] + '...' if len(user['bio']) > 100 else user['bio']
-            })
+    return jsonify(results)
+
+@app.route('/api/messages/search', methods=['GET'])
+def api_messages_search():
+    # Поиск по тексту сообщений в чатах пользователя, от новых к старым.
+    # Следующая страница - ?before=<next_before>
+    username = request.args.get('username')
+    query = request.args.get('q', '').strip()
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    
+    if not username or not query:
+        return jsonify({'success': True, 'messages': [], 'next_before': None})
     
-    return jsonify(results[:50])
+    found, next_before = store.search_messages(username, query, before=before, limit=limit)
+    return jsonify({'success': True, 'messages': found, 'next_before': next_before})
 
 @app.route('/api/chats', methods=['GET'])
 def api_chats():
@@ -147,69 +539,74 @@ def api_chats():
     if not username:
         return jsonify([])
     
+    return conditional(f'c{store.get_version("chats", username)}', lambda: jsonify(chat_list(username)))
+
+def chat_list(username):
+    # Хранилище отдает чаты уже упорядоченными по активности вместе
+    # с последним сообщением и счетчиком непрочитанных
     user_chats_list = []
-    for chat_id in user_chats.get(username, set()):
-        chat = chats.get(chat_id)
-        if chat:
-            chat_data = chat.copy()
-            
-            # Для приватных чатов получаем информацию о собеседнике
-            if chat['type'] == 'private':
-                other_user = [u for u in chat['members'] if u != username][0]
-                other_data = users.get(other_user, {})
-                chat_data['display_name'] = other_data.get('nickname', other_user)
-                chat_data['avatar'] = other_data.get('avatar', generate_avatar(other_user))
-                chat_data['status'] = other_data.get('status', 'offline')
+    for chat, last_msg, unread in store.chat_list(username):
+        chat_data = chat.copy()
             
-            # Получаем последнее сообщение
-            chat_messages = messages.get(chat_id, [])
-            last_msg = None
-            for msg in reversed(chat_messages):
-                if msg['id'] not in deleted_messages:
-                    last_msg = msg
-                    break
+        # Для приватных чатов получаем информацию о собеседнике
+        if chat['type'] == 'private':
+            other_user = [u for u in chat['members'] if u != username][0]
+            other_data = store.get_user(other_user) or {}
+            chat_data['display_name'] = other_data.get('nickname', other_user)
+            chat_data['avatar'] = other_data.get('avatar', generate_avatar(other_user))
+            chat_data['status'] = other_data.get('status', 'offline')
+        else:
+            # Список участников группы не отдаем: он грузится страницами отдельно
+            chat_data['display_name'] = chat['name']
+            chat_data['avatar'] = chat.get('avatar') or generate_avatar(chat['name'])
+            chat_data['member_count'] = store.member_count(chat['id'])
+            chat_data['role'] = store.member_role(chat['id'], username)
             
-            if last_msg:
-                chat_data['last_message'] = {
-                    'text': last_msg['content'],
-                    'time': last_msg['timestamp'],
-                    'sender': last_msg['sender']
-                }
-                # Считаем непрочитанные
-                unread = sum(1 for msg in chat_messages 
-                           if msg['sender'] != username and not msg.get('read', False) and msg['id'] not in deleted_messages)
-                chat_data['unread'] = unread
+        if last_msg:
+            chat_data['last_message'] = {
+                'text': last_msg['content'],
+                'time': last_msg['timestamp'],
+                'sender': last_msg['sender']
+            }
+            chat_data['unread'] = unread
             
-            user_chats_list.append(chat_data)
+        user_chats_list.append(chat_data)
     
-    # Сортируем по времени последнего сообщения
-    user_chats_list.sort(key=lambda x: x.get('last_message', {}).get('time', ''), reverse=True)
-    return jsonify(user_chats_list)
+    return user_chats_list
 
 @app.route('/api/chat/<chat_id>/messages', methods=['GET'])
 def api_chat_messages(chat_id):
     username = request.args.get('username')
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
     
-    if chat_id not in messages:
+    if not store.get_chat(chat_id):
         return jsonify([])
     
-    # Возвращаем только неудаленные сообщения
-    chat_messages = [msg for msg in messages[chat_id] if msg['id'] not in deleted_messages]
+    # Возвращаем одну страницу неудаленных сообщений (по умолчанию - последнюю)
+    chat_messages = store.message_page(chat_id, before=before, after=after, limit=limit)
     
-    # Помечаем сообщения как прочитанные
-    for msg in chat_messages:
-        if msg['sender'] != username:
-            msg['read'] = True
+    # Открытие чата - прочитано до последнего сообщения страницы
+    if chat_messages and username:
+        mark_read(chat_id, username, chat_messages[-1]['seq'])
     
-    # Добавляем реакции к сообщениям
+    # Добавляем к сообщениям счетчики реакций и реакцию самого пользователя
+    # (в копии, само сообщение не меняем)
+    message_reactions = store.get_reactions([msg['id'] for msg in chat_messages], username)
+    page = []
     for msg in chat_messages:
-        msg_id = msg['id']
-        if msg_id in message_reactions:
-            msg['reactions'] = message_reactions[msg_id]
+        reactions = message_reactions.get(msg['id'])
+        if reactions:
+            counts, mine = reactions
+            msg = dict(msg, reactions=counts, my_reaction=mine) if mine else dict(msg, reactions=counts)
+        page.append(msg)
     
-    return jsonify(chat_messages)
+    return jsonify(page)
 
 @app.route('/api/chat/create', methods=['POST'])
+@rate_limited()
 def api_chat_create():
     data = request.get_json()
     user1 = data.get('user1')
@@ -218,94 +615,238 @@ def api_chat_create():
     if not user1 or not user2:
         return jsonify({'success': False, 'error': 'Не указаны пользователи'})
     
-    # Проверяем существующий чат
-    for chat_id, chat in chats.items():
-        if (chat['type'] == 'private' and 
-            user1 in chat['members'] and 
-            user2 in chat['members']):
+    # Под блокировкой, чтобы два одновременных запроса не создали два чата
+    with chat_create_lock:
+        # Проверяем существующий чат
+        chat_id = store.find_private_chat(user1, user2)
+        if chat_id:
             return jsonify({'success': True, 'chat_id': chat_id, 'exists': True})
     
-    # Создаем новый чат
-    chat_id = str(uuid.uuid4())
+        # Создаем новый чат
+        chat_id = str(uuid.uuid4())
     
-    user1_data = users.get(user1, {})
-    user2_data = users.get(user2, {})
+        user1_data = store.get_user(user1) or {}
+        user2_data = store.get_user(user2) or {}
     
-    chat_name = f"{user1_data.get('nickname', user1)} и {user2_data.get('nickname', user2)}"
+        chat_name = f"{user1_data.get('nickname', user1)} и {user2_data.get('nickname', user2)}"
     
-    chats[chat_id] = {
+        chat = {
+            'id': chat_id,
+            'type': 'private',
+            'name': chat_name,
+            'members': [user1, user2],
+            'created_at': datetime.now().isoformat(),
+            'last_message': None,
+            'unread': 0
+        }
+    
+        # Добавляем приветственное сообщение
+        welcome_msg = {
+            'id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'sender': 'system',
+            'content': 'Чат создан. Начните общение!',
+            'timestamp': datetime.now().isoformat()
+        }
+        # Другой воркер мог успеть создать чат этой пары - хранилище вернет его
+        created = store.create_chat(chat, welcome_msg)
+    
+    if created == chat_id:
+        # Участники узнают о чате в своих личных комнатах
+        publish_change(chat_id, 'chat_created', {'chat_id': chat_id, 'type': chat['type'],
+                                                 'members': chat['members']},
+                       to=[user_room(member) for member in chat['members']])
+    
+    return jsonify({'success': True, 'chat_id': created, 'exists': created != chat_id})
+
+@app.route('/api/group/create', methods=['POST'])
+@rate_limited()
+def api_group_create():
+    data = request.get_json()
+    creator = data.get('creator')
+    name = data.get('name')
+    chat_type = data.get('type', 'group')
+    
+    if not creator or not name or chat_type not in GROUP_TYPES:
+        return jsonify({'success': False, 'error': 'Не указаны данные'})
+    
+    # Название уходит каждому добавленному участнику, отказаться он не может
+    name = name.strip() if isinstance(name, str) else ''
+    if not name or len(name) > MAX_CHAT_NAME_LENGTH:
+        return jsonify({'success': False, 'error': 'Недопустимое название'}), 400
+    
+    if not store.get_user(creator):
+        return jsonify({'success': False, 'error': 'Пользователь не найден'})
+    
+    # Создатель - владелец, остальные - участники (подписчики канала)
+    roles = {creator: 'owner'}
+    for member in data.get('members') or []:
+        if member not in roles and store.get_user(member):
+            roles[member] = GROUP_TYPES[chat_type]
+    
+    chat_id = str(uuid.uuid4())
+    chat = {
         'id': chat_id,
-        'type': 'private',
-        'name': chat_name,
-        'members': [user1, user2],
+        'type': chat_type,
+        'name': name,
+        'owner': creator,
         'created_at': datetime.now().isoformat(),
         'last_message': None,
         'unread': 0
     }
-    
-    user_chats[user1].add(chat_id)
-    user_chats[user2].add(chat_id)
-    
-    # Добавляем приветственное сообщение
     welcome_msg = {
         'id': str(uuid.uuid4()),
         'chat_id': chat_id,
         'sender': 'system',
-        'content': 'Чат создан. Начните общение!',
-        'timestamp': datetime.now().isoformat(),
-        'read': True
+        'content': 'Канал создан' if chat_type == 'channel' else 'Группа создана. Начните общение!',
+        'timestamp': datetime.now().isoformat()
     }
-    messages[chat_id].append(welcome_msg)
+    store.create_chat(chat, welcome_msg, roles)
     
-    return jsonify({'success': True, 'chat_id': chat_id, 'exists': False})
+    publish_change(chat_id, 'chat_created', {'chat_id': chat_id, 'type': chat_type, 'member_count': len(roles)},
+                   to=[user_room(member) for member in roles])
+    
+    return jsonify({'success': True, 'chat_id': chat_id, 'member_count': len(roles)})
 
-@app.route('/api/user/update', methods=['POST'])
-def api_user_update():
+@app.route('/api/chat/<chat_id>/members', methods=['GET'])
+def api_chat_members(chat_id):
+    # Участники страницами: ?offset=N&limit=M
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = max(1, min(request.args.get('limit', MEMBER_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    
+    if not store.get_chat(chat_id):
+        return jsonify({'success': False, 'error': 'Чат не найден'})
+    
+    page, total = store.member_page(chat_id, offset, limit)
+    members = []
+    for member, role in page:
+        user = store.get_user(member) or {}
+        members.append({
+            'username': member,
+            'role': role,
+            'nickname': user.get('nickname', member),
+            'avatar': user.get('avatar') or generate_avatar(member),
+            'status': user.get('status', 'offline')
+        })
+    
+    return jsonify({'success': True, 'members': members, 'total': total,
+                    'has_more': offset + len(members) < total})
+
+@app.route('/api/chat/<chat_id>/members/add', methods=['POST'])
+@rate_limited()
+def api_chat_members_add(chat_id):
     data = request.get_json()
     username = data.get('username')
-    updates = data.get('updates', {})
+    usernames = data.get('members') or []
     
-    if not username or username not in users:
-        return jsonify({'success': False, 'error': 'Пользователь не найден'})
+    chat = store.get_chat(chat_id)
+    if not chat or chat['type'] not in GROUP_TYPES:
+        return jsonify({'success': False, 'error': 'Группа не найдена'})
+    
+    if store.member_role(chat_id, username) not in MANAGING_ROLES:
+        return jsonify({'success': False, 'error': 'Доступ запрещен'})
     
-    user = users[username]
+    role = GROUP_TYPES[chat['type']]
+    added = store.add_members(chat_id, {member: role for member in usernames if store.get_user(member)})
     
-    if 'nickname' in updates:
-        user['nickname'] = updates['nickname']
+    if added:
+        # Новые участники узнают о чате в своих комнатах, открытый чат - о новых участниках
+        publish_change(chat_id, 'members_added', {'chat_id': chat_id, 'members': added,
+                                                  'member_count': store.member_count(chat_id)},
+                       to=[chat_id] + [user_room(member) for member in added])
     
-    if 'bio' in updates:
-        user['bio'] = updates['bio']
+    return jsonify({'success': True, 'added': added})
+
+@app.route('/api/chat/<chat_id>/members/remove', methods=['POST'])
+@rate_limited()
+def api_chat_members_remove(chat_id):
+    # Удалить участника может владелец или администратор, выйти - сам участник
+    data = request.get_json()
+    username = data.get('username')
+    member = data.get('member') or username
+    
+    chat = store.get_chat(chat_id)
+    if not chat or chat['type'] not in GROUP_TYPES:
+        return jsonify({'success': False, 'error': 'Группа не найдена'})
+    
+    role = store.member_role(chat_id, member)
+    if not role:
+        return jsonify({'success': False, 'error': 'Пользователь не в группе'})
+    if role == 'owner':
+        return jsonify({'success': False, 'error': 'Владельца нельзя удалить из группы'})
+    if member != username and (store.member_role(chat_id, username) not in MANAGING_ROLES or
+                               (role == 'admin' and store.member_role(chat_id, username) != 'owner')):
+        return jsonify({'success': False, 'error': 'Доступ запрещен'})
     
-    if 'avatar' in updates:
-        user['avatar'] = updates['avatar']
+    if store.remove_member(chat_id, member):
+        publish_change(chat_id, 'member_removed', {'chat_id': chat_id, 'username': member,
+                                                   'member_count': store.member_count(chat_id)},
+                       to=[chat_id, user_room(member)])
     
-    if 'privacy' in updates:
-        user['privacy'] = updates['privacy']
+    return jsonify({'success': True})
+
+@app.route('/api/chat/<chat_id>/members/role', methods=['POST'])
+@rate_limited()
+def api_chat_members_role(chat_id):
+    # Назначить или снять администратора может только владелец
+    data = request.get_json()
+    username = data.get('username')
+    member = data.get('member')
+    admin = bool(data.get('admin'))
+    
+    chat = store.get_chat(chat_id)
+    if not chat or chat['type'] not in GROUP_TYPES:
+        return jsonify({'success': False, 'error': 'Группа не найдена'})
+    
+    if store.member_role(chat_id, username) != 'owner' or member == username:
+        return jsonify({'success': False, 'error': 'Доступ запрещен'})
     
-    if 'theme' in updates:
-        user['theme'] = updates['theme']
+    role = 'admin' if admin else GROUP_TYPES[chat['type']]
+    if not store.set_member_role(chat_id, member, role):
+        return jsonify({'success': False, 'error': 'Пользователь не в группе'})
     
-    return jsonify({'success': True, 'user': user})
+    return jsonify({'success': True, 'role': role})
+
+@app.route('/api/user/update', methods=['POST'])
+@rate_limited()
+def api_user_update():
+    data = request.get_json()
+    username = data.get('username')
+    updates = data.get('updates', {})
+    
+    if not username or not store.get_user(username):
+        return jsonify({'success': False, 'error': 'Пользователь не найден'})
+    
+    # Меняем только разрешенные поля профиля
+    changes = {field: updates[field] for field in PROFILE_FIELDS if field in updates}
+    if changes:
+        store.update_user(username, changes)
+        if 'nickname' in changes:
+            publish_user(username, changes['nickname'])
+    
+    return jsonify({'success': True, 'user': store.get_user(username)})
 
 @app.route('/api/settings/update', methods=['POST'])
+@rate_limited()
 def api_settings_update():
     data = request.get_json()
     username = data.get('username')
     settings = data.get('settings', {})
     
-    if not username or username not in user_settings:
+    if not username or store.get_settings(username) is None:
         return jsonify({'success': False, 'error': 'Пользователь не найден'})
     
-    user_settings[username].update(settings)
-    return jsonify({'success': True, 'settings': user_settings[username]})
+    store.update_settings(username, settings)
+    return jsonify({'success': True, 'settings': store.get_settings(username)})
 
 @app.route('/api/user/<username>', methods=['GET'])
 def api_get_user(username):
-    user = users.get(username)
+    version = store.get_version('user', username)
+    user = store.get_user(username)
     if not user:
         return jsonify({'error': 'Пользователь не найден'}), 404
     
-    return jsonify({
+    return conditional(f'u{version}', lambda: jsonify({
         'username': user['username'],
         'nickname': user['nickname'],
         'avatar': user['avatar'],
@@ -313,9 +854,10 @@ def api_get_user(username):
         'status': user['status'],
         'last_seen': user['last_seen'],
         'created_at': user['created_at']
-    })
+    }))
 
 @app.route('/api/message/delete', methods=['POST'])
+@rate_limited()
 def api_message_delete():
     data = request.get_json()
     message_id = data.get('message_id')
@@ -324,113 +866,171 @@ def api_message_delete():
     if not message_id or not username:
         return jsonify({'success': False, 'error': 'Не указаны данные'})
     
-    # Ищем сообщение во всех чатах
-    for chat_id, chat_messages in messages.items():
-        for msg in chat_messages:
-            if msg['id'] == message_id:
-                # Проверяем, что пользователь может удалить сообщение
-                if msg['sender'] == username or username in chats[chat_id]['members']:
-                    deleted_messages.add(message_id)
+    chat_id, msg = store.find_message(message_id)
+    if msg:
+        # Проверяем, что пользователь может удалить сообщение
+        # Свое сообщение - всегда; чужое - любой участник личного чата
+        # или владелец и администраторы группы
+        role = store.member_role(chat_id, username)
+        if msg['sender'] == username or (role and (store.get_chat(chat_id)['type'] == 'private'
+                                                   or role in MANAGING_ROLES)):
+            store.delete_message(message_id, time.time())
                     
-                    # Уведомляем всех в чате
-                    socketio.emit('message_deleted', {
-                        'message_id': message_id,
-                        'chat_id': chat_id,
-                        'deleted_by': username
-                    }, room=chat_id)
+            # Уведомляем всех в чате
+            publish_change(chat_id, 'message_deleted', {
+                'message_id': message_id,
+                'chat_id': chat_id,
+                'deleted_by': username
+            })
                     
-                    return jsonify({'success': True})
+            return jsonify({'success': True})
     
     return jsonify({'success': False, 'error': 'Сообщение не найдено'})
 
 @app.route('/api/message/react', methods=['POST'])
+@rate_limited()
 def api_message_react():
     data = request.get_json()
     message_id = data.get('message_id')
     username = data.get('username')
     reaction = data.get('reaction')
     
-    if not all([message_id, username, reaction]):
+    if not message_id or not username or not isinstance(username, str):
         return jsonify({'success': False, 'error': 'Не указаны данные'})
     
-    if message_id not in message_reactions:
-        message_reactions[message_id] = {}
+    # Реакция интернируется в хранилище, поэтому только непустая короткая строка
+    if not isinstance(reaction, str) or not reaction or len(reaction) > MAX_REACTION_LENGTH:
+        return jsonify({'success': False, 'error': 'Недопустимая реакция'}), 400
     
-    if username in message_reactions[message_id]:
-        # Удаляем реакцию, если она уже есть
-        del message_reactions[message_id][username]
-        if not message_reactions[message_id]:
-            del message_reactions[message_id]
-    else:
-        # Добавляем реакцию
-        message_reactions[message_id][username] = reaction
-    
-    # Находим chat_id для сообщения
-    chat_id = None
-    for cid, chat_messages in messages.items():
-        for msg in chat_messages:
-            if msg['id'] == message_id:
-                chat_id = cid
-                break
-        if chat_id:
-            break
+    chat_id, msg = store.find_message(message_id)
+    if not msg:
+        return jsonify({'success': False, 'error': 'Сообщение не найдено'})
     
-    if chat_id:
-        # Отправляем обновление всем в чате
-        socketio.emit('message_reaction', {
-            'message_id': message_id,
-            'username': username,
-            'reaction': reaction,
-            'chat_id': chat_id,
-            'reactions': message_reactions.get(message_id, {})
-        }, room=chat_id)
+    reaction, delta, count = store.toggle_reaction(message_id, username, reaction)
     
-    return jsonify({'success': True, 'reactions': message_reactions.get(message_id, {})})
+    # Всем в чате уходит только изменение одного счетчика: delta - для
+    # применения, count - итог после него (повтор события ничего не ломает)
+    change = {
+        'message_id': message_id,
+        'username': username,
+        'reaction': reaction,
+        'chat_id': chat_id,
+        'delta': delta,
+        'count': count
+    }
+    publish_change(chat_id, 'message_reaction', change)
+    
+    return jsonify(dict(change, success=True))
 
 @app.route('/api/chat/<chat_id>/clear', methods=['POST'])
-def api_chat_clear():
+@rate_limited()
+def api_chat_clear(chat_id):
     data = request.get_json()
-    chat_id = data.get('chat_id')
     username = data.get('username')
     
     if not chat_id or not username:
         return jsonify({'success': False, 'error': 'Не указаны данные'})
     
-    if chat_id not in chats or username not in chats[chat_id]['members']:
+    if not store.member_role(chat_id, username):
         return jsonify({'success': False, 'error': 'Доступ запрещен'})
     
     # Помечаем все сообщения как удаленные для этого пользователя
-    for msg in messages.get(chat_id, []):
-        if msg['sender'] != username:  # Не удаляем чужие сообщения полностью
-            deleted_messages.add(msg['id'])
+    store.clear_chat(chat_id, username, time.time())
     
     return jsonify({'success': True})
 
+@app.route('/api/sync', methods=['GET'])
+def api_sync():
+    # Дельта после переподключения: ?since=<курсор>; без курсора - только текущий курсор
+    username = request.args.get('username')
+    if not username:
+        return jsonify({'success': False, 'error': 'Не указан пользователь'})
+    
+    return jsonify(sync_changes(username, request.args.get('since')))
+
+@app.route('/api/config', methods=['GET'])
+def api_config():
+    # Параметры подключения для клиента
+    return jsonify({'socket_serializer': SOCKETIO_SERIALIZER})
+
+@app.route('/api/stats', methods=['GET'])
+def api_stats():
+    # Счетчики подсистем реального времени
+    return jsonify({
+        'connections': connections,
+        'presence': {'online': presence.online_count()},
+        'typing': typing.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/metrics/profile', methods=['GET', 'POST'])
+def metrics_profile():
+    # POST {"action": "start"|"stop", "interval": 0.005} - включить/выключить,
+    # GET ?limit=N - накопленные стеки в свернутом формате
+    if not PROFILER_ENABLED:
+        return jsonify({'success': False, 'error': 'Профилировщик выключен (DEEPLINK_PROFILER=1)'})
+    
+    if request.method == 'GET':
+        limit = request.args.get('limit', type=int)
+        return Response(profiler.collapsed(limit), mimetype='text/plain; charset=utf-8')
+    
+    data = request.get_json() or {}
+    action = data.get('action')
+    if action == 'start':
+        profiler.start(data.get('interval'))
+    elif action == 'stop':
+        profiler.stop()
+    else:
+        return jsonify({'success': False, 'error': 'Неизвестное действие'})
+    
+    return jsonify({'success': True, 'running': profiler.running, 'samples': profiler.samples})
+
 # WebSocket
 @socketio.on('connect')
 def handle_connect():
+    global connections
+    with connections_lock:
+        if connections >= MAX_CONNECTIONS:
+            raise ConnectionRefusedError('Сервер перегружен')
+        connections += 1
     logging.info(f'Client connected: {request.sid}')
+    start_background_tasks()
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    for username, socket_id in online_users.items():
-        if socket_id == request.sid:
-            del online_users[username]
-            if username in users:
-                users[username]['status'] = 'offline'
-                users[username]['last_seen'] = datetime.now().isoformat()
-            emit('user_offline', {'username': username}, broadcast=True)
-            break
+    global connections
+    with connections_lock:
+        connections -= 1
+    limiter.forget(('sid', request.sid))
+    # Офлайн объявит flush_presence, если пользователь не вернется
+    presence.disconnect(request.sid)
 
 @socketio.on('user_online')
 def handle_user_online(data):
     username = data.get('username')
     if username:
-        online_users[username] = request.sid
-        if username in users:
-            users[username]['status'] = 'online'
-            users[username]['last_seen'] = datetime.now().isoformat()
-        emit('user_online', {'username': username}, broadcast=True)
+        current = presence.username(request.sid)
+        if current and current != username:
+            leave_room(user_room(current))
+        join_room(user_room(username))
+        if presence.connect(request.sid, username):
+            announce_presence(username, 'online')
+
+@socketio.on('user_offline')
+def handle_user_offline(data):
+    # Выход из аккаунта: сокет остается, но больше не принадлежит пользователю
+    username = presence.username(request.sid)
+    if username:
+        leave_room(user_room(username))
+        presence.disconnect(request.sid)
+
+@socketio.on('subscribe_presence')
+def handle_subscribe_presence(data):
+    usernames = data.get('usernames') or []
+    presence.subscribe(request.sid, usernames[:SEARCH_LIMIT])
 
 @socketio.on('join_chat')
 def handle_join_chat(data):
@@ -453,6 +1053,10 @@ def handle_send_message(data):
     if not all([chat_id, sender, content]):
         return
     
+    # Писать могут только участники; в канале - только владелец и администраторы
+    if store.member_role(chat_id, sender) not in POSTING_ROLES:
+        return
+    
     # Создаем сообщение
     message = {
         'id': str(uuid.uuid4()),
@@ -460,51 +1064,57 @@ def handle_send_message(data):
         'sender': sender,
         'content': content,
         'timestamp': datetime.now().isoformat(),
-        'read': False,
         'edited': False
     }
     
-    # Сохраняем сообщение
-    messages[chat_id].append(message)
-    
-    # Обновляем последнее сообщение в чате
-    if chat_id in chats:
-        chats[chat_id]['last_message'] = {
-            'text': content,
-            'time': message['timestamp'],
-            'sender': sender
-        }
+    # Сохраняем сообщение (обновляет и сводку чата)
+    store.store_message(chat_id, message)
     
     # Отправляем всем в комнате чата
-    emit('new_message', message, room=chat_id, broadcast=True)
+    publish_change(chat_id, 'new_message', message)
 
 @socketio.on('typing')
 def handle_typing(data):
     chat_id = data.get('chat_id')
     username = data.get('username')
-    is_typing = data.get('is_typing')
+    is_typing = bool(data.get('is_typing'))
     
-    if chat_id and username:
-        typing_status[(chat_id, username)] = datetime.now().isoformat() if is_typing else None
-        
+    # Рассылаем только смену состояния и не чаще раза в интервал
+    if chat_id and username and typing.update(chat_id, username, is_typing):
         emit('user_typing', {
             'chat_id': chat_id,
             'username': username,
             'is_typing': is_typing
         }, room=chat_id, include_self=False)
 
+@socketio.on('read_up_to')
+def handle_read_up_to(data):
+    # Прочитано все до seq включительно - одно событие на пачку сообщений
+    chat_id = data.get('chat_id')
+    username = data.get('username')
+    seq = data.get('seq')
+    
+    if chat_id and username and isinstance(seq, int):
+        mark_read(chat_id, username, seq)
+
 @socketio.on('read_message')
 def handle_read_message(data):
+    # Старый клиент: прочитано до этого сообщения
     chat_id = data.get('chat_id')
     username = data.get('username')
     message_id = data.get('message_id')
     
     if chat_id and username and message_id:
-        # Помечаем сообщение как прочитанное
-        for msg in messages.get(chat_id, []):
-            if msg['id'] == message_id and msg['sender'] != username:
-                msg['read'] = True
-                break
+        msg_chat_id, msg = store.find_message(message_id)
+        if msg and msg_chat_id == chat_id:
+            mark_read(chat_id, username, msg['seq'])
+
+@socketio.on('sync')
+def handle_sync(data):
+    # То же, что /api/sync; дельта уходит подтверждением события
+    username = data.get('username')
+    if username:
+        return sync_changes(username, data.get('since'))
 
 @socketio.on('edit_message')
 def handle_edit_message(data):
@@ -517,21 +1127,19 @@ def handle_edit_message(data):
         return
     
     # Ищем и редактируем сообщение
-    for msg in messages.get(chat_id, []):
-        if msg['id'] == message_id and msg['sender'] == username:
-            msg['content'] = new_content
-            msg['edited'] = True
-            msg['edited_at'] = datetime.now().isoformat()
+    msg_chat_id, msg = store.find_message(message_id)
+    if msg and msg_chat_id == chat_id and msg['sender'] == username:
+        edited_at = datetime.now().isoformat()
+        store.edit_message(message_id, new_content, edited_at)
             
-            emit('message_edited', {
-                'message_id': message_id,
-                'chat_id': chat_id,
-                'content': new_content,
-                'edited_at': msg['edited_at']
-            }, room=chat_id, broadcast=True)
-            break
+        publish_change(chat_id, 'message_edited', {
+            'message_id': message_id,
+            'chat_id': chat_id,
+            'content': new_content,
+            'edited_at': edited_at
+        })
 
-if __name__ == '__main__':
+def seed_test_data():
     # Создаем тестовых пользователей
     test_users = [
         {'username': 'alice', 'nickname': 'Алиса', 'bio': 'Люблю программирование и котиков!'},
@@ -543,9 +1151,9 @@ if __name__ == '__main__':
     
     for user_data in test_users:
         username = user_data['username']
-        if username not in users:
+        if not store.get_user(username):
             user_id = str(uuid.uuid4())
-            users[username] = {
+            user = {
                 'id': user_id,
                 'username': username,
                 'password': 'password123',
@@ -558,7 +1166,7 @@ if __name__ == '__main__':
                 'privacy': 'public',
                 'theme': 'dark'
             }
-            user_settings[username] = {
+            settings = {
                 'notifications': True,
                 'sound': True,
                 'vibration': True,
@@ -568,11 +1176,13 @@ if __name__ == '__main__':
                 'auto_download': True,
                 'save_to_gallery': False
             }
+            store.add_user(user, settings)
+            publish_user(username, user_data['nickname'])
     
-    # Создаем тестовый чат
-    if True:
+    # Создаем тестовый чат (если он не восстановлен из журнала)
+    if not store.find_private_chat('alice', 'bob'):
         chat_id = str(uuid.uuid4())
-        chats[chat_id] = {
+        store.create_chat({
             'id': chat_id,
             'type': 'private',
             'name': 'Алиса и Боб',
@@ -580,9 +1190,7 @@ if __name__ == '__main__':
             'created_at': datetime.now().isoformat(),
             'last_message': None,
             'unread': 0
-        }
-        user_chats['alice'].add(chat_id)
-        user_chats['bob'].add(chat_id)
+        })
         
         # Тестовые сообщения
         test_msgs = [
@@ -601,16 +1209,28 @@ if __name__ == '__main__':
                 'sender': msg_data['sender'],
                 'content': msg_data['content'],
                 'timestamp': datetime.now().isoformat(),
-                'read': True,
                 'edited': False
             }
-            messages[chat_id].append(message)
+            store.store_message(chat_id, message)
+        # Тестовая переписка уже прочитана обоими
+        for member in ('alice', 'bob'):
+            store.read_up_to(chat_id, member, message['seq'])
         
-        # Обновляем последнее сообщение
-        chats[chat_id]['last_message'] = {
-            'text': test_msgs[-1]['content'],
-            'time': datetime.now().isoformat(),
-            'sender': test_msgs[-1]['sender']
-        }
+# Ограничения частоты и замер всех маршрутов и событий - после того, как все
+# они объявлены. Замер снаружи: отклоненные события тоже считаются
+rate_limit_socketio()
+instrument_app(app, metrics)
+instrument_socketio(socketio, metrics)
+
+if __name__ == '__main__':
+    # Поднимаем сохраненное состояние. При debug Werkzeug запускает модуль
+    # дважды, журнал открывает только рабочий процесс (WERKZEUG_RUN_MAIN)
+    if DATA_DIR and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        open_persistence(DATA_DIR, sync_commit=SYNC_COMMIT, snapshot_every=SNAPSHOT_EVERY,
+                         hot_bytes=int(HOT_MESSAGES_MB * 2 ** 20))
+    
+    seed_test_data()
     
-    socketio.run(app, host='0.0.0.0', port=10000, allow_unsafe_werkzeug=True, debug=True)
+    # Сервер разработки: отладчик и перезагрузка. Для боевого запуска - workers.py
+    socketio.run(app, host='0.0.0.0', port=int(os.environ.get('DEEPLINK_PORT', '10000')),
+                 allow_unsafe_werkzeug=True, debug=True)
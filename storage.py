@@ -0,0 +1,914 @@
+# Хранилище данных мессенджера.
+#
+# Storage - интерфейс, через который обработчики читают и меняют пользователей,
+# чаты, сообщения, реакции, настройки и присутствие. MemoryStorage держит все в
+# словарях процесса (с журналом и снимками из persistence.py), SQLiteStorage
+# (storage_sqlite.py) - в файле базы SQLite в режиме WAL.
+#
+# Сообщения и чаты передаются обычными словарями в формате API. Все значения
+# (id, время) генерирует вызывающий код, поэтому мутации детерминированы.
+# Внутри MemoryStorage сообщения лежат компактными записями (messages.py).
+#
+# Чаты бывают личные (двое участников, список прямо в чате) и групповые -
+# группы и каналы на тысячи участников. Участники и их роли хранятся отдельно
+# от чата и отдаются страницами. Отправка в группу не трогает ничего на
+# каждого участника: порядок в списках чатов - метка активности самого чата,
+# версия для ETag - версия чата, которая входит в версию списка каждого
+# участника, непрочитанные считаются по отметкам (ниже).
+#
+# Прочитанность хранится отметкой "прочитано до seq N" на пару (чат, пользователь),
+# а не флагом в каждом сообщении. Отметка только растет, отправитель сразу
+# получает отметку на свое сообщение. Непрочитанные - разность seq: последний
+# seq чата минус отметка минус удаленные сообщения после отметки. seq удаленных
+# сообщений помнятся, пока отметки всех участников не пройдут мимо них.
+#
+# Текст сообщений ищется по обратному индексу (search.py), который обновляется
+# теми же мутациями: отправка, правка, удаление и очистка чата. Поиск видит
+# только чаты пользователя и отдает страницы от новых сообщений к старым.
+#
+# С каталогом данных сообщения MemoryStorage живут на двух уровнях (tiers.py):
+# хвосты недавно активных чатов - в памяти в пределах бюджета, остальная
+# история - в сегментах на диске. self.messages и message_index держат только
+# сообщения в памяти, холодные читаются и ищутся через self.tiers, а их правка
+# и удаление переписывают блоки сегментов.
+#
+# События чатов для /api/sync пишутся в ленту изменений (changefeed.py) с
+# общей нумерацией. Для условных GET у профиля пользователя и его списка чатов
+# есть счетчики версий, которые растут вместе с мутациями. epoch меняется,
+# когда нумерация ленты и версий начинается заново.
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict, OrderedDict
+from heapq import merge
+from itertools import islice
+from operator import attrgetter
+
+from changefeed import ChangeFeed
+from messages import Message, Reactions, to_millis
+from persistence import Persistence
+from search import MessageSearchIndex, UserSearchIndex
+from tiers import footprint, HOT_TAIL, MessageTiers
+
+PAGE_SIZE = 50
+MEMBER_PAGE_SIZE = 100  # Участников на странице списка группы
+
+seq_key = attrgetter('seq')
+
+
+class Storage:
+    # Пользователи и настройки
+    def get_user(self, username):
+        raise NotImplementedError
+    
+    def add_user(self, user, settings):
+        raise NotImplementedError
+    
+    def update_user(self, username, updates):
+        raise NotImplementedError
+    
+    def set_presence(self, username, status, last_seen):
+        raise NotImplementedError
+    
+    def search_users(self, query, limit, exclude=None):
+        raise NotImplementedError
+    
+    def get_settings(self, username):
+        raise NotImplementedError
+    
+    def update_settings(self, username, settings):
+        raise NotImplementedError
+    
+    # Чаты
+    def get_chat(self, chat_id):
+        raise NotImplementedError
+    
+    def find_private_chat(self, user1, user2):
+        raise NotImplementedError
+    
+    def create_chat(self, chat, welcome_msg=None, roles=None):
+        # Возвращает id чата; для уже существующей пары - id старого чата.
+        # Участники личного чата - chat['members']; у группы и канала список
+        # в чат не входит, участники приходят в roles {username: роль}
+        raise NotImplementedError
+    
+    def chat_list(self, username):
+        # [(чат, последнее сообщение или None, непрочитанные)], свежие первыми
+        raise NotImplementedError
+    
+    def user_chat_ids(self, username):
+        raise NotImplementedError
+    
+    def contacts(self, username):
+        # Пользователи, у которых есть общий личный чат с username
+        raise NotImplementedError
+    
+    # Участники
+    def member_role(self, chat_id, username):
+        # Роль участника или None, если его в чате нет
+        raise NotImplementedError
+    
+    def member_count(self, chat_id):
+        raise NotImplementedError
+    
+    def member_page(self, chat_id, offset=0, limit=MEMBER_PAGE_SIZE):
+        # ([(username, роль)] в порядке вступления, всего участников)
+        raise NotImplementedError
+    
+    def add_members(self, chat_id, roles):
+        # roles {username: роль}. Возвращает тех, кого в чате еще не было
+        raise NotImplementedError
+    
+    def remove_member(self, chat_id, username):
+        raise NotImplementedError
+    
+    def set_member_role(self, chat_id, username, role):
+        raise NotImplementedError
+    
+    # Сообщения
+    def store_message(self, chat_id, message):
+        raise NotImplementedError
+    
+    def find_message(self, message_id):
+        # (chat_id, сообщение) или (None, None) для неизвестных и удаленных
+        raise NotImplementedError
+    
+    def search_messages(self, username, query, before=None, limit=PAGE_SIZE):
+        # Сообщения чатов username со всеми словами запроса, от новых к старым.
+        # ([сообщение], курсор для before следующей страницы или None)
+        raise NotImplementedError
+    
+    def message_page(self, chat_id, before=None, after=None, limit=PAGE_SIZE):
+        raise NotImplementedError
+    
+    def edit_message(self, message_id, content, edited_at):
+        raise NotImplementedError
+    
+    def delete_message(self, message_id, deleted_at):
+        # deleted_at - время удаления (time.time()); по нему compact решает,
+        # когда убрать сообщение физически
+        raise NotImplementedError
+    
+    def clear_chat(self, chat_id, username, deleted_at):
+        raise NotImplementedError
+    
+    def compact(self, cutoff):
+        # Физически убирает сообщения, удаленные не позже cutoff (time.time()),
+        # вместе с их реакциями. Возвращает число убранных сообщений
+        raise NotImplementedError
+    
+    def read_up_to(self, chat_id, username, seq):
+        # Сдвигает отметку прочитанного вперед (не дальше последнего seq чата).
+        # Возвращает новую отметку или None, если она не сдвинулась
+        raise NotImplementedError
+    
+    # Реакции
+    def toggle_reaction(self, message_id, username, reaction):
+        # Снимает реакцию пользователя или ставит новую. Возвращает изменение
+        # (эмодзи, +1 или -1, сколько теперь таких реакций на сообщении)
+        raise NotImplementedError
+    
+    def get_reactions(self, message_ids, username):
+        # {message_id: ({эмодзи: число}, эмодзи username или None)}
+        # только для сообщений с реакциями
+        raise NotImplementedError
+    
+    # Лента изменений
+    def record_change(self, chat_id, event, data):
+        # Возвращает номер события в общей монотонной последовательности
+        raise NotImplementedError
+    
+    def changes_since(self, seq, chat_ids, limit):
+        # (до какого seq просмотрено, [(seq, chat_id, event, data)]) - события
+        # чатов chat_ids после seq, не больше limit. Вместо списка None, если
+        # seq не задан или уже вытеснен из буфера: нужна полная перезагрузка
+        raise NotImplementedError
+    
+    # Версии для ETag
+    def get_version(self, kind, name):
+        # kind: user - профиль и присутствие, chats - список чатов пользователя
+        # (включая имена, аватары и статусы собеседников)
+        raise NotImplementedError
+    
+    def stats(self):
+        # Размеры для /metrics: users, chats, messages, deleted_messages, reacted_messages
+        raise NotImplementedError
+    
+    def tier_stats(self):
+        # Уровни хранения сообщений для /metrics: {'events': {...}, 'size': {...}}.
+        # Есть только у MemoryStorage с каталогом данных
+        return {'events': {}, 'size': {}}
+    
+    def close(self):
+        pass
+
+
+def mutation(fn):
+    # Мутация применяется под self.lock и пишется в журнал. Все аргументы
+    # приходят готовыми, поэтому при воспроизведении журнала результат тот же.
+    # Вложенные мутации не журналируются - их повторит внешняя
+    @functools.wraps(fn)
+    def wrapper(self, *args):
+        lsn = None
+        with self.lock:
+            self._depth += 1
+            try:
+                result = fn(self, *args)
+            finally:
+                self._depth -= 1
+            if self.journal is not None and self._depth == 0:
+                lsn = self.journal.record(fn.__name__, args)
+        # fsync ждем уже без блокировки, чтобы параллельные записи попали в одну группу
+        if lsn and self.journal.sync_commit:
+            self.journal.log.wait(lsn)
+        return result
+    return wrapper
+
+
+class MemoryStorage(Storage):
+    # Что попадает в снимок: данные вместе с производными индексами
+    STATE = ('users', 'chats', 'messages', 'user_chats', 'user_settings', 'tombstones',
+             'message_reactions', 'message_index', 'chat_seq', 'chat_last_message',
+             'read_marks', 'deleted_seqs', 'chat_activity', 'private_chats', 'user_search',
+             'chat_members', 'chat_touched', 'activity_clock', 'message_search', 'tiers')
+    
+    def __init__(self):
+        self.users = {}
+        self.chats = {}
+        self.messages = defaultdict(list)
+        self.user_chats = defaultdict(set)
+        self.user_settings = defaultdict(dict)
+        self.tombstones = defaultdict(int)  # chat_id -> удаленные, но еще лежащие в списке сообщения
+        self.message_reactions = {}  # message_id -> Reactions
+        self.message_index = {}  # message_id -> запись неудаленного сообщения
+        self.chat_seq = defaultdict(int)  # Последний выданный seq в каждом чате
+        self.chat_last_message = {}  # chat_id -> запись последнего неудаленного сообщения
+        self.read_marks = defaultdict(int)  # (chat_id, username) -> прочитано до этого seq
+        self.deleted_seqs = defaultdict(list)  # chat_id -> отсортированные seq удаленных сообщений
+        self.chat_activity = defaultdict(OrderedDict)  # username -> личные chat_id в порядке активности
+        self.chat_members = {}  # chat_id -> {username: роль} в порядке вступления
+        self.chat_touched = {}  # chat_id -> метка последней активности
+        self.activity_clock = 0  # Последняя выданная метка активности
+        self.private_chats = {}  # frozenset({user1, user2}) -> chat_id приватного чата
+        self.user_search = UserSearchIndex()  # Индекс для /api/search
+        self.message_search = MessageSearchIndex()  # Индекс для /api/messages/search
+        self.tiers = MessageTiers()  # Холодная история на диске, включается в open()
+        self.changes = ChangeFeed()  # Лента для /api/sync, в снимок не входит
+        self.versions = defaultdict(int)  # (вид, имя) -> версия для ETag, в снимок не входит
+        self.epoch = self.changes.epoch
+        
+        self.lock = threading.RLock()  # Под ним применяются все мутации и делается снимок
+        self.journal = None  # Persistence, если включено хранение на диске
+        self._depth = 0
+    
+    # Журнал и снимки
+    def snapshot_state(self):
+        self.tiers.sync()
+        return {name: getattr(self, name) for name in self.STATE}
+    
+    def open(self, directory, hot_bytes=0, **options):
+        # Поднимает состояние из последнего снимка и хвоста журнала,
+        # после чего все новые мутации начинают журналироваться.
+        # hot_bytes - бюджет памяти под сообщения, 0 - ничего не вытеснять
+        started = time.perf_counter()
+        journal = Persistence(directory, self.snapshot_state, self.lock, **options)
+        state, tail = journal.load()
+        if state:
+            self.__dict__.update(state)
+            self._upgrade_messages()
+            self._upgrade_reactions()
+            self._upgrade_members()
+            self._upgrade_search()
+        self.tiers.open(os.path.join(directory, 'segments'), hot_bytes)
+        self._load_hot()
+        replayed = 0
+        for op, args in tail:
+            getattr(self, op)(*args)
+            replayed += 1
+        journal.start()
+        self.journal = journal
+        logging.info(f'Состояние восстановлено: снимок lsn {journal.snapshot_lsn}, '
+                     f'записей журнала {replayed}, {time.perf_counter() - started:.2f} с')
+        return journal
+    
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.tiers.close()
+    
+    # Пользователи и настройки
+    def get_user(self, username):
+        return self.users.get(username)
+    
+    @mutation
+    def add_user(self, user, settings):
+        username = user['username']
+        self.users[username] = user
+        self.user_settings[username] = settings
+        self.user_search.add(username, user['nickname'])
+        self._bump('user', (username,))
+    
+    @mutation
+    def update_user(self, username, updates):
+        user = self.users[username]
+        user.update(updates)
+        if 'nickname' in updates:
+            self.user_search.update(username, user['nickname'])
+        self._bump_profile(username)
+    
+    def set_presence(self, username, status, last_seen):
+        # Присутствие не журналируется: после рестарта все офлайн
+        with self.lock:
+            user = self.users.get(username)
+            if user:
+                user['status'] = status
+                user['last_seen'] = last_seen
+                self._bump_profile(username)
+    
+    def search_users(self, query, limit, exclude=None):
+        return self.user_search.search(query, limit=limit, exclude=exclude)
+    
+    def get_settings(self, username):
+        return self.user_settings.get(username)
+    
+    @mutation
+    def update_settings(self, username, settings):
+        self.user_settings[username].update(settings)
+    
+    # Чаты
+    def get_chat(self, chat_id):
+        return self.chats.get(chat_id)
+    
+    def find_private_chat(self, user1, user2):
+        return self.private_chats.get(frozenset((user1, user2)))
+    
+    @mutation
+    def create_chat(self, chat, welcome_msg=None, roles=None):
+        chat_id = chat['id']
+        if chat['type'] == 'private':
+            pair = frozenset(chat['members'])
+            if pair in self.private_chats:
+                return self.private_chats[pair]
+            self.private_chats[pair] = chat_id
+            roles = dict.fromkeys(chat['members'], 'member')
+        self.chats[chat_id] = chat
+        self.chat_members[chat_id] = dict(roles)
+        for member in roles:
+            self.user_chats[member].add(chat_id)
+        self._bump('chats', roles)
+        if welcome_msg:
+            self.store_message(chat_id, welcome_msg)
+            # Приветствие считается прочитанным всеми
+            for member in roles:
+                self.read_marks[(chat_id, member)] = welcome_msg['seq']
+        return chat_id
+    
+    def chat_list(self, username):
+        # Личные чаты уже упорядочены по активности, сообщения не просматриваются.
+        # Групп у пользователя немного (участников в них много, поэтому порядок
+        # у каждого участника при отправке не двигаем): они сортируются по метке
+        # активности чата и вливаются в тот же порядок. Порядок меняется при
+        # каждой отправке, поэтому обходим его под блокировкой
+        with self.lock:
+            touched = self.chat_touched
+            groups = sorted((chat_id for chat_id in self.user_chats.get(username, ())
+                             if chat_id in touched and self.chats[chat_id]['type'] != 'private'),
+                            key=touched.get, reverse=True)
+            private = reversed(self.chat_activity.get(username, OrderedDict()))
+            result = []
+            for chat_id in merge(private, groups, key=lambda chat_id: touched.get(chat_id, 0), reverse=True):
+                chat = self.chats.get(chat_id)
+                if chat:
+                    last = self.chat_last_message.get(chat_id)
+                    result.append((chat, last and last.to_dict(), self._unread(chat_id, username)))
+            return result
+    
+    def user_chat_ids(self, username):
+        return self.user_chats.get(username, set())
+    
+    def contacts(self, username):
+        with self.lock:
+            result = set()
+            for chat_id in self.user_chats.get(username, ()):
+                if self.chats[chat_id]['type'] == 'private':
+                    result.update(self.chat_members[chat_id])
+            result.discard(username)
+            return result
+    
+    # Участники
+    def member_role(self, chat_id, username):
+        return self.chat_members.get(chat_id, {}).get(username)
+    
+    def member_count(self, chat_id):
+        return len(self.chat_members.get(chat_id, ()))
+    
+    def member_page(self, chat_id, offset=0, limit=MEMBER_PAGE_SIZE):
+        with self.lock:
+            members = self.chat_members.get(chat_id, {})
+            return list(islice(members.items(), offset, offset + limit)), len(members)
+    
+    @mutation
+    def add_members(self, chat_id, roles):
+        members = self.chat_members.get(chat_id)
+        if members is None:
+            return []
+        added = [username for username in roles if username not in members]
+        seq = self.chat_seq.get(chat_id, 0)
+        for username in added:
+            members[username] = roles[username]
+            self.user_chats[username].add(chat_id)
+            # История видна, но непрочитанной новому участнику не считается
+            self.read_marks[(chat_id, username)] = seq
+        self._bump('chats', added)
+        return added
+    
+    @mutation
+    def remove_member(self, chat_id, username):
+        members = self.chat_members.get(chat_id)
+        if not members or username not in members:
+            return False
+        del members[username]
+        self.user_chats[username].discard(chat_id)
+        self.read_marks.pop((chat_id, username), None)
+        # Версия чата выпадает из суммы в get_version - своя растет на большее,
+        # чтобы версия списка не вернулась к уже выданному значению
+        self.versions[('chats', username)] += self.versions.get(('chat', chat_id), 0) + 1
+        return True
+    
+    @mutation
+    def set_member_role(self, chat_id, username, role):
+        members = self.chat_members.get(chat_id)
+        if not members or username not in members:
+            return False
+        members[username] = role
+        return True
+    
+    # Сообщения
+    @mutation
+    def store_message(self, chat_id, message):
+        # Единая точка сохранения: список чата + индекс по id.
+        # seq монотонно растет внутри чата, поэтому список всегда отсортирован по нему.
+        # seq возвращается вызывающему в его же словаре
+        self.chat_seq[chat_id] += 1
+        message['seq'] = self.chat_seq[chat_id]
+        record = Message.from_dict(chat_id, message)
+        self.messages[chat_id].append(record)
+        self.message_index[record.id] = record
+        self.message_search.add(chat_id, record.seq, record.content)
+        if self.tiers.enabled:
+            self._keep_hot(chat_id, record)
+        
+        # Сводка для списка чатов: последнее сообщение, отметка отправителя и порядок
+        self.chat_last_message[chat_id] = record
+        chat = self.chats.get(chat_id)
+        if chat:
+            members = self.chat_members[chat_id]
+            if record.sender in members:
+                self.read_marks[(chat_id, record.sender)] = record.seq
+            self.activity_clock += 1
+            self.chat_touched[chat_id] = self.activity_clock
+            if chat['type'] == 'private':
+                for member in members:
+                    self._touch_chat(member, chat_id)
+            self._bump_chat(chat_id)
+    
+    def find_message(self, message_id):
+        record = self.message_index.get(message_id)
+        if record is None and self.tiers.cold_messages:
+            with self.lock:
+                record = self.message_index.get(message_id) or self.tiers.find(message_id)
+        if record is None:
+            return None, None
+        return record.chat_id, record.to_dict()
+    
+    def search_messages(self, username, query, before=None, limit=PAGE_SIZE):
+        with self.lock:
+            chat_ids = list(self.user_chats.get(username, ()))
+        hits, cursor = self.message_search.search(query, chat_ids, before, limit)
+        found = []
+        with self.lock:
+            for chat_id, seq in hits:
+                # Между поиском и чтением сообщение могли удалить
+                msg = self._message_at(chat_id, seq)
+                if msg is not None:
+                    found.append(msg.to_dict())
+        return found, cursor
+    
+    def message_page(self, chat_id, before=None, after=None, limit=PAGE_SIZE):
+        # Страница неудаленных сообщений по курсору seq, поиск позиции бинарный.
+        # after - сообщения новее курсора, иначе - последние сообщения до before.
+        # С уровнями хранения - под блокировкой: вытеснение заменяет список
+        # чата, а начало истории может лежать на диске
+        if not self.tiers.enabled:
+            return self._page(self.messages.get(chat_id, []), before, after, limit)
+        with self.lock:
+            return self._tiered_page(chat_id, before, after, limit)
+    
+    @mutation
+    def edit_message(self, message_id, content, edited_at):
+        msg = self.message_index.get(message_id)
+        cold = msg is None
+        if cold:
+            msg = self.tiers.find(message_id)
+        if msg:
+            self.message_search.update(msg.chat_id, msg.seq, msg.content, content)
+            if not cold:
+                self.tiers.resize(msg.chat_id, sys.getsizeof(content) - sys.getsizeof(msg.content))
+            msg.content = content
+            msg.edited_at = to_millis(edited_at)
+            if cold:
+                # Блок переписывается, а копия последнего сообщения чата в памяти правится на месте
+                self.tiers.replace(msg.chat_id, msg.seq, msg)
+                last = self.chat_last_message.get(msg.chat_id)
+                if last is not None and last.id == message_id:
+                    last.content = msg.content
+                    last.edited_at = msg.edited_at
+            self._bump_chat(msg.chat_id)
+    
+    @mutation
+    def delete_message(self, message_id, deleted_at=None):
+        msg = self.message_index.get(message_id)
+        if msg:
+            self._remove_message(msg.chat_id, msg, deleted_at)
+        else:
+            msg = self.tiers.find(message_id)
+            if msg:
+                self.tiers.replace(msg.chat_id, msg.seq, None)
+                self._remove_cold(msg.chat_id, [msg])
+        if msg:
+            last = self.chat_last_message.get(msg.chat_id)
+            if last is not None and last.id == message_id:
+                self._refresh_last_message(msg.chat_id)
+            self._bump_chat(msg.chat_id)
+    
+    @mutation
+    def clear_chat(self, chat_id, username, deleted_at=None):
+        for msg in self.messages.get(chat_id, []):
+            if msg.sender != username and not msg.deleted:  # Не удаляем чужие сообщения полностью
+                self._remove_message(chat_id, msg, deleted_at)
+        if chat_id in self.tiers.blocks:
+            self._remove_cold(chat_id, self.tiers.remove_where(chat_id, lambda msg: msg.sender != username))
+        self._refresh_last_message(chat_id)
+        self._bump_chat(chat_id)
+    
+    @mutation
+    def read_up_to(self, chat_id, username, seq):
+        if username not in self.chat_members.get(chat_id, ()):
+            return None
+        key = (chat_id, username)
+        seq = min(seq, self.chat_seq.get(chat_id, 0))
+        if seq <= self.read_marks.get(key, 0):
+            return None
+        self.read_marks[key] = seq
+        self._bump('chats', (username,))
+        return seq
+    
+    def compact(self, cutoff):
+        # Не журналируется: это уборка, а не изменение данных. seq у оставшихся
+        # сообщений не меняется, поэтому курсоры пагинации остаются верными.
+        # Блокировка берется на каждый чат отдельно, чтобы не держать запись
+        removed = 0
+        cutoff = cutoff * 1000  # Время удаления в записях - миллисекунды
+        for chat_id in list(self.tombstones):
+            with self.lock:
+                kept = []
+                left = 0
+                freed = 0
+                for msg in self.messages.get(chat_id, []):
+                    deleted = msg.deleted
+                    if not deleted:
+                        kept.append(msg)
+                    elif deleted > cutoff:
+                        kept.append(msg)
+                        left += 1
+                    else:
+                        self.message_reactions.pop(msg.id, None)
+                        freed += footprint(msg)
+                        removed += 1
+                self.messages[chat_id] = kept
+                self.tiers.release(chat_id, freed)
+                if left:
+                    self.tombstones[chat_id] = left
+                else:
+                    self.tombstones.pop(chat_id, None)
+        # seq удаленных, которые уже прочитали все участники, для подсчета не нужны
+        for chat_id in list(self.deleted_seqs):
+            with self.lock:
+                members = self.chat_members.get(chat_id)
+                low = min((self.read_marks.get((chat_id, member), 0) for member in members),
+                          default=0) if members is not None else float('inf')
+                seqs = self.deleted_seqs[chat_id]
+                del seqs[:bisect_right(seqs, low)]
+                if not seqs:
+                    del self.deleted_seqs[chat_id]
+        # Холодная история - тоже по чату за раз: слияние мелких блоков и
+        # перенос блоков из разреженного файла
+        if self.tiers.enabled:
+            with self.lock:
+                sparse = self.tiers.sparse_file()
+            for chat_id in list(self.tiers.blocks):
+                with self.lock:
+                    self.tiers.tidy(chat_id, sparse)
+        with self.lock:
+            self.message_search.compact()
+            # Файлы сегментов, которые опустели и уже не нужны ни одному снимку
+            if self.journal is not None:
+                self.tiers.collect(self.journal.log.last_lsn, self.journal.snapshot_lsn)
+        return removed
+    
+    # Реакции
+    @mutation
+    def toggle_reaction(self, message_id, username, reaction):
+        reactions = self.message_reactions.get(message_id)
+        if reactions is None:
+            reactions = self.message_reactions[message_id] = Reactions()
+        change = reactions.toggle(username, reaction)
+        if not reactions.counts:
+            del self.message_reactions[message_id]
+        return change
+    
+    def get_reactions(self, message_ids, username):
+        result = {}
+        for message_id in message_ids:
+            reactions = self.message_reactions.get(message_id)
+            if reactions is not None:
+                result[message_id] = (dict(reactions.counts), reactions.users.get(username))
+        return result
+    
+    # Лента изменений
+    def record_change(self, chat_id, event, data):
+        return self.changes.record(chat_id, event, data)
+    
+    def changes_since(self, seq, chat_ids, limit):
+        return self.changes.since(seq, chat_ids, limit)
+    
+    # Версии для ETag
+    def get_version(self, kind, name):
+        if kind != 'chats':
+            return self.versions.get((kind, name), 0)
+        # Список чатов: своя версия плюс версии групп пользователя
+        # (у личных чатов версии нет - растут версии их участников)
+        with self.lock:
+            return self.versions.get((kind, name), 0) + sum(
+                self.versions.get(('chat', chat_id), 0) for chat_id in self.user_chats.get(name, ()))
+    
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'chats': len(self.chats),
+            'messages': len(self.message_index) + self.tiers.cold_messages,
+            'deleted_messages': sum(self.tombstones.values()),
+            'reacted_messages': len(self.message_reactions)
+        }
+    
+    def tier_stats(self):
+        with self.lock:
+            stats = self.tiers.stats()
+            stats['size']['hot_messages'] = len(self.message_index)
+            return stats
+    
+    # Внутреннее
+    def _bump(self, kind, names):
+        for name in names:
+            self.versions[(kind, name)] += 1
+    
+    def _bump_chat(self, chat_id):
+        # Личный чат - версии обоих участников, группа - одна версия чата
+        chat = self.chats.get(chat_id)
+        if chat:
+            if chat['type'] == 'private':
+                self._bump('chats', self.chat_members[chat_id])
+            else:
+                self.versions[('chat', chat_id)] += 1
+    
+    def _bump_profile(self, username):
+        # Имя, аватар и статус видны и в списках чатов собеседников
+        self._bump('user', (username,))
+        self._bump('chats', self.contacts(username))
+    
+    def _touch_chat(self, username, chat_id):
+        order = self.chat_activity[username]
+        order[chat_id] = True
+        order.move_to_end(chat_id)
+    
+    def _unread(self, chat_id, username):
+        mark = self.read_marks.get((chat_id, username), 0)
+        unread = self.chat_seq.get(chat_id, 0) - mark
+        deleted = self.deleted_seqs.get(chat_id)
+        if deleted:
+            unread -= len(deleted) - bisect_right(deleted, mark)
+        return max(unread, 0)
+    
+    def _remove_message(self, chat_id, msg, deleted_at):
+        # Удаление без пересчета последнего сообщения - его делает вызывающий
+        # Сообщение остается в списке чата с отметкой времени удаления,
+        # пока его не уберет compact(). Время приходит аргументом мутации, чтобы
+        # воспроизведение журнала дало ту же отметку. В записях журнала старого
+        # формата его нет - такие сообщения считаются удаленными давно
+        msg.deleted = 1 if deleted_at is None else int(deleted_at * 1000)
+        self.tombstones[chat_id] += 1
+        self.message_index.pop(msg.id, None)
+        self.message_search.remove(chat_id, msg.seq)
+        insort(self.deleted_seqs[chat_id], msg.seq)
+    
+    def _remove_cold(self, chat_id, removed):
+        # Холодные сообщения уже убраны из блоков - физически и сразу, вместе с реакциями
+        for msg in removed:
+            self.message_search.remove(chat_id, msg.seq)
+            self.message_reactions.pop(msg.id, None)
+            insort(self.deleted_seqs[chat_id], msg.seq)
+    
+    def _refresh_last_message(self, chat_id):
+        # Идем с конца только по хвосту из удаленных сообщений
+        self.chat_last_message.pop(chat_id, None)
+        for msg in reversed(self.messages.get(chat_id, [])):
+            if not msg.deleted:
+                self.chat_last_message[chat_id] = msg
+                return
+        # В памяти живых сообщений нет - последнее берется из холодной истории
+        for msg in self.tiers.read_back(chat_id, None, 1):
+            self.chat_last_message[chat_id] = msg
+    
+    def _page(self, chat_messages, before, after, limit):
+        # Страница из списка сообщений в памяти
+        page = []
+        
+        if after is not None:
+            pos = bisect_right(chat_messages, after, key=seq_key)
+            while pos < len(chat_messages) and len(page) < limit:
+                msg = chat_messages[pos]
+                if not msg.deleted:
+                    page.append(msg.to_dict())
+                pos += 1
+            return page
+        
+        pos = len(chat_messages) if before is None else bisect_left(chat_messages, before, key=seq_key)
+        while pos > 0 and len(page) < limit:
+            pos -= 1
+            msg = chat_messages[pos]
+            if not msg.deleted:
+                page.append(msg.to_dict())
+        page.reverse()
+        return page
+    
+    def _message_at(self, chat_id, seq):
+        # Неудаленное сообщение чата по seq: из памяти или с диска
+        chat_messages = self.messages.get(chat_id, [])
+        pos = bisect_left(chat_messages, seq, key=seq_key)
+        if pos < len(chat_messages) and chat_messages[pos].seq == seq:
+            msg = chat_messages[pos]
+            return None if msg.deleted else msg
+        return self.tiers.read(chat_id, seq)
+    
+    def _tiered_page(self, chat_id, before, after, limit):
+        # Страница из хвоста в памяти, дочитанная с диска, если курсор уходит
+        # в холодную историю. Промах - любое чтение диска
+        tiers = self.tiers
+        chat_messages = self.messages.get(chat_id, [])
+        missed = False
+        if chat_id in tiers.blocks and before is None and after is None and len(chat_messages) < limit:
+            # Открытие выгруженного чата: последний блок возвращается в память
+            chat_messages = self._page_in(chat_id)
+            missed = True
+        page = self._page(chat_messages, before, after, limit)
+        blocks = tiers.blocks.get(chat_id)
+        if blocks and after is not None and after < blocks[-1][1]:
+            cold = tiers.read_forward(chat_id, after, limit)
+            page = [msg.to_dict() for msg in cold] + page[:limit - len(cold)]
+            missed = True
+        elif blocks and after is None and len(page) < limit and (before is None or before > blocks[0][0]):
+            cold = tiers.read_back(chat_id, before, limit - len(page))
+            page = [msg.to_dict() for msg in reversed(cold)] + page
+            missed = True
+        tiers.access(chat_id, missed)
+        return page
+    
+    def _page_in(self, chat_id):
+        records = self.tiers.pop_block(chat_id)
+        for record in records:
+            self.message_index[record.id] = record
+        # Последнее сообщение чата было копией - теперь это запись в памяти
+        last = self.chat_last_message.get(chat_id)
+        if last is not None and last.id == records[-1].id:
+            self.chat_last_message[chat_id] = records[-1]
+        chat_messages = self.messages[chat_id] = records + self.messages.get(chat_id, [])
+        self.tiers.add_hot(chat_id, sum(map(footprint, records)))
+        if self.tiers.over_budget():
+            self._evict(chat_id)
+        return chat_messages
+    
+    def _keep_hot(self, chat_id, record):
+        # Учет нового сообщения: у чата в памяти остается хвост, а при
+        # превышении бюджета вытесняются давно не тронутые чаты
+        tiers = self.tiers
+        tiers.add_hot(chat_id, footprint(record))
+        if not tiers.budget:
+            return
+        chat_messages = self.messages[chat_id]
+        if len(chat_messages) >= 2 * HOT_TAIL:
+            self._spill(chat_id, len(chat_messages) - HOT_TAIL)
+        if tiers.over_budget():
+            self._evict(chat_id)
+    
+    def _evict(self, keep=None):
+        # Давно не тронутые чаты целиком уходят на диск, пока память не вернется
+        # в бюджет. Ровно столько, сколько нужно, - обычно один чат за отправку
+        tiers = self.tiers
+        while tiers.over_budget():
+            chat_id = tiers.coldest(keep)
+            if chat_id is None:
+                break
+            self._spill(chat_id, len(self.messages.get(chat_id, ())))
+            tiers.events['evictions'] += 1
+    
+    def _spill(self, chat_id, count):
+        # Первые count сообщений чата из памяти в новый блок на диске. Удаленные
+        # не пишутся (их seq остаются в deleted_seqs), и compact() их уже не ждет
+        chat_messages = self.messages.get(chat_id, [])
+        live = []
+        freed = 0
+        deleted = 0
+        for msg in chat_messages[:count]:
+            freed += footprint(msg)
+            if msg.deleted:
+                self.message_reactions.pop(msg.id, None)
+                deleted += 1
+            else:
+                self.message_index.pop(msg.id, None)
+                live.append(msg)
+        self.tiers.write(chat_id, live)
+        if deleted:
+            left = self.tombstones.get(chat_id, 0) - deleted
+            if left > 0:
+                self.tombstones[chat_id] = left
+            else:
+                self.tombstones.pop(chat_id, None)
+        if count < len(chat_messages):
+            self.messages[chat_id] = chat_messages[count:]
+            self.tiers.release(chat_id, freed)
+        else:
+            self.messages.pop(chat_id, None)
+            self.tiers.drop_hot(chat_id)
+    
+    def _load_hot(self):
+        # Учет памяти после снимка: первыми на вытеснение - давно не активные чаты
+        for chat_id in sorted(self.messages, key=lambda chat_id: self.chat_touched.get(chat_id, 0)):
+            if self.messages[chat_id]:
+                self.tiers.add_hot(chat_id, sum(map(footprint, self.messages[chat_id])))
+        if self.tiers.over_budget():
+            self._evict()
+    
+    def _upgrade_messages(self):
+        # Снимки до компактных записей хранили сообщения словарями
+        if not any(isinstance(msg, dict) for chat_messages in self.messages.values() for msg in chat_messages[:1]):
+            return
+        self.message_index = {}
+        for chat_id, chat_messages in self.messages.items():
+            records = []
+            for msg in chat_messages:
+                record = Message.from_dict(chat_id, msg)
+                if 'deleted' in msg:
+                    record.deleted = int(msg['deleted'] * 1000)
+                else:
+                    self.message_index[record.id] = record
+                records.append(record)
+            self.messages[chat_id] = records
+            self._refresh_last_message(chat_id)
+
+    def _upgrade_members(self):
+        # Снимки до групп хранили участников только в самих (личных) чатах
+        if self.chat_members or not self.chats:
+            return
+        self.chat_members = {chat_id: dict.fromkeys(chat['members'], 'member')
+                             for chat_id, chat in self.chats.items()}
+    
+    def _upgrade_search(self):
+        # Снимки до поиска по сообщениям: индекс строится по неудаленным
+        # сообщениям, от старых к новым
+        if len(self.message_search) or not self.message_index:
+            return
+        live = (msg for msg in merge(*self.messages.values(), key=attrgetter('timestamp')) if not msg.deleted)
+        self.message_search.add_many((msg.chat_id, msg.seq, msg.content) for msg in live)
+    
+    def _upgrade_reactions(self):
+        # Снимки до счетчиков хранили только карту {username: эмодзи}
+        if not any(isinstance(reactions, dict) for reactions in self.message_reactions.values()):
+            return
+        self.message_reactions = {message_id: Reactions.from_users(reactions)
+                                  for message_id, reactions in self.message_reactions.items()}
+
+
+def create_storage(kind=None, **options):
+    # Бэкенд выбирается переменной DEEPLINK_STORAGE: memory (по умолчанию) или sqlite
+    kind = kind or os.environ.get('DEEPLINK_STORAGE', 'memory')
+    if kind == 'memory':
+        return MemoryStorage()
+    if kind == 'sqlite':
+        from storage_sqlite import SQLiteStorage
+        return SQLiteStorage(options.get('path') or os.environ.get('DEEPLINK_SQLITE_PATH', 'deeplink.db'),
+                             shared=options.get('shared', False))
+    raise ValueError(f'Неизвестное хранилище: {kind}')
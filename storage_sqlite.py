@@ -0,0 +1,812 @@
+# Хранилище в SQLite (режим WAL).
+#
+# Все записи выполняет один фоновый поток со своим соединением: операции
+# копятся в очереди и применяются пачками, по одной транзакции на пачку.
+# Отправка сообщения не ждет записи, остальные мутации ждут свой результат.
+# Чтение идет через отдельные соединения потоков (WAL не блокирует читателей
+# писателем); перед чтением дожидаемся уже поставленных в очередь записей,
+# чтобы обработчик видел собственные изменения.
+#
+# В обычном режиме seq выдается в памяти процесса. В режиме shared (несколько
+# воркеров на одну базу) seq выдает писатель внутри транзакции по last_seq
+# чата, а отправка ждет записи, чтобы вернуть сообщение уже с seq.
+# Номера ленты изменений (таблица changes) выдаются так же.
+#
+# Поиск по тексту сообщений - таблица FTS5 без своей копии текста
+# (content=''). В нее пишется текст, приведенный к виду из search.py
+# (casefold, ё -> е), а при правке и удалении старый текст вычеркивается
+# командой 'delete' теми же словами. rowid сообщения растет с отправкой,
+# поэтому порядок по rowid - порядок от новых к старым.
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from changefeed import FEED_SIZE, new_epoch
+from search import matches, normalize, query_terms, UserSearchIndex
+from storage import Storage, MEMBER_PAGE_SIZE, PAGE_SIZE
+
+BATCH_SIZE = 1000  # Операций в одной транзакции писателя
+# Размеры для /metrics считаются проходом по таблицам, поэтому не на каждый
+# сбор метрик, а не чаще раза в STATS_TTL секунд. Счетчики в писателе не
+# подходят: в режиме нескольких воркеров базу пишут все процессы
+STATS_TTL = 60.0
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    password TEXT NOT NULL,
+    nickname TEXT NOT NULL,
+    avatar TEXT,
+    bio TEXT,
+    status TEXT,
+    last_seen TEXT,
+    created_at TEXT,
+    privacy TEXT,
+    theme TEXT,
+    settings TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    last_msg_id TEXT,
+    last_seq INTEGER NOT NULL DEFAULT 0,
+    kind TEXT NOT NULL DEFAULT 'private',
+    activity INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS chat_members (
+    chat_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    read_seq INTEGER NOT NULL DEFAULT 0,
+    role TEXT NOT NULL DEFAULT 'member',
+    joined INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, username)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chat_members_user ON chat_members (username);
+CREATE TABLE IF NOT EXISTS private_pairs (
+    user_a TEXT NOT NULL,
+    user_b TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    PRIMARY KEY (user_a, user_b)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    edited INTEGER NOT NULL DEFAULT 0,
+    edited_at TEXT,
+    deleted REAL NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_chat_seq ON messages (chat_id, seq);
+CREATE INDEX IF NOT EXISTS messages_tombstones ON messages (deleted) WHERE deleted > 0;
+CREATE TABLE IF NOT EXISTS deleted_seqs (
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reactions (
+    message_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    reaction TEXT NOT NULL,
+    PRIMARY KEY (message_id, username)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS reaction_counts (
+    message_id TEXT NOT NULL,
+    reaction TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (message_id, reaction)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS versions (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5 (
+    body,
+    content = '',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+'''
+
+USER_FIELDS = ('id', 'username', 'password', 'nickname', 'avatar', 'bio', 'status',
+               'last_seen', 'created_at', 'privacy', 'theme')
+MESSAGE_FIELDS = 'id, chat_id, seq, sender, content, timestamp, edited, edited_at'
+
+# Запросы - постоянные строки: sqlite3 кэширует подготовленные выражения по тексту
+SELECT_USER = f'SELECT {", ".join(USER_FIELDS)} FROM users WHERE username = ?'
+INSERT_USER = f'INSERT INTO users ({", ".join(USER_FIELDS)}, settings) VALUES ({", ".join("?" * (len(USER_FIELDS) + 1))})'
+# Удаленные считаются по частичному индексу messages_tombstones, неудаленные -
+# разностью с общим числом: по таблице сообщений один проход, а не два
+STATS = ('SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM chats), '
+         '(SELECT COUNT(*) FROM messages), (SELECT COUNT(*) FROM messages WHERE deleted > 0), '
+         '(SELECT COUNT(DISTINCT message_id) FROM reactions)')
+SELECT_MESSAGE = f'SELECT {MESSAGE_FIELDS} FROM messages WHERE id = ? AND deleted = 0'
+INSERT_MESSAGE = ('INSERT INTO messages (id, chat_id, seq, sender, content, timestamp, edited) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?)')
+PAGE_LATEST = f'SELECT {MESSAGE_FIELDS} FROM messages WHERE chat_id = ? AND deleted = 0 ORDER BY seq DESC LIMIT ?'
+PAGE_BEFORE = (f'SELECT {MESSAGE_FIELDS} FROM messages WHERE chat_id = ? AND seq < ? AND deleted = 0 '
+               'ORDER BY seq DESC LIMIT ?')
+PAGE_AFTER = (f'SELECT {MESSAGE_FIELDS} FROM messages WHERE chat_id = ? AND seq > ? AND deleted = 0 '
+              'ORDER BY seq LIMIT ?')
+# Непрочитанные - разность seq за вычетом удаленных после отметки (storage.py)
+CHAT_LIST = (f'SELECT c.data, MAX(c.last_seq - cm.read_seq - (SELECT COUNT(*) FROM deleted_seqs d '
+             f'WHERE d.chat_id = cm.chat_id AND d.seq > cm.read_seq), 0), {", ".join("m." + f for f in MESSAGE_FIELDS.split(", "))} '
+             'FROM chat_members cm JOIN chats c ON c.id = cm.chat_id '
+             'LEFT JOIN messages m ON m.id = c.last_msg_id '
+             'WHERE cm.username = ? AND c.activity > 0 ORDER BY c.activity DESC')
+READ_UP_TO = 'UPDATE chat_members SET read_seq = ? WHERE chat_id = ? AND username = ? AND read_seq < ?'
+CONTACTS = ('SELECT DISTINCT other.username FROM chat_members own '
+            "JOIN chats c ON c.id = own.chat_id AND c.kind = 'private' "
+            'JOIN chat_members other ON other.chat_id = own.chat_id '
+            'WHERE own.username = ? AND other.username != ?')
+MEMBER_ROLE = 'SELECT role FROM chat_members WHERE chat_id = ? AND username = ?'
+MEMBER_PAGE = 'SELECT username, role FROM chat_members WHERE chat_id = ? ORDER BY joined, username LIMIT ? OFFSET ?'
+# Сообщения в индекс поиска и из него (до изменения текста или удаления)
+INDEX_MESSAGE = 'INSERT INTO message_search (rowid, body) SELECT rowid, search_text(content) FROM messages WHERE id = ?'
+UNINDEX_MESSAGE = ("INSERT INTO message_search (message_search, rowid, body) "
+                   "SELECT 'delete', rowid, search_text(content) FROM messages WHERE id = ? AND deleted = 0")
+SEARCH_MESSAGES = (f'SELECT s.rowid, {", ".join("m." + f for f in MESSAGE_FIELDS.split(", "))} '
+                   'FROM message_search s JOIN messages m ON m.rowid = s.rowid '
+                   'WHERE message_search MATCH ? AND s.rowid < ? AND m.deleted = 0 '
+                   'AND m.chat_id IN (SELECT chat_id FROM chat_members WHERE username = ?) '
+                   'ORDER BY s.rowid DESC')
+LAST_MESSAGE = 'SELECT id FROM messages WHERE chat_id = ? AND deleted = 0 ORDER BY seq DESC LIMIT 1'
+FEED_HEAD = "SELECT value FROM counters WHERE name = 'feed'"
+# Версии для ETag: ключи user:<имя>, chats:<имя> и chat:<id группы>, см. Storage.get_version
+COUNT_REACTION = ('INSERT INTO reaction_counts VALUES (?, ?, ?) ON CONFLICT (message_id, reaction) '
+                  'DO UPDATE SET count = count + excluded.count RETURNING count')
+BUMP = 'INSERT INTO versions VALUES (?, 1) ON CONFLICT (key) DO UPDATE SET value = value + 1'
+BUMP_MEMBERS = ("INSERT INTO versions SELECT 'chats:' || username, 1 FROM chat_members WHERE chat_id = ? "
+                'ON CONFLICT (key) DO UPDATE SET value = value + 1')
+# Личный чат - версии списков обоих участников, группа - одна версия чата
+BUMP_CHAT = ("INSERT INTO versions SELECT 'chats:' || username, 1 FROM chat_members "
+             "WHERE chat_id = ?1 AND (SELECT kind FROM chats WHERE id = ?1) = 'private' "
+             "UNION ALL SELECT 'chat:' || id, 1 FROM chats WHERE id = ?1 AND kind != 'private' "
+             'ON CONFLICT (key) DO UPDATE SET value = value + 1')
+CHATS_VERSION = ("SELECT IFNULL((SELECT value FROM versions WHERE key = 'chats:' || ?1), 0) + "
+                 "IFNULL((SELECT SUM(v.value) FROM chat_members cm JOIN versions v ON v.key = 'chat:' || cm.chat_id "
+                 'WHERE cm.username = ?1), 0)')
+BUMP_CONTACTS = ("INSERT INTO versions SELECT DISTINCT 'chats:' || other.username, 1 FROM chat_members own "
+                 "JOIN chats c ON c.id = own.chat_id AND c.kind = 'private' "
+                 'JOIN chat_members other ON other.chat_id = own.chat_id '
+                 'WHERE own.username = ? AND other.username != ? '
+                 'ON CONFLICT (key) DO UPDATE SET value = value + 1')
+
+
+def message_from_row(row):
+    msg = {
+        'id': row[0],
+        'chat_id': row[1],
+        'seq': row[2],
+        'sender': row[3],
+        'content': row[4],
+        'timestamp': row[5],
+        'edited': bool(row[6])
+    }
+    if row[7] is not None:
+        msg['edited_at'] = row[7]
+    return msg
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path, batch_size=BATCH_SIZE, shared=False, feed_size=FEED_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.shared = shared
+        self.feed_size = feed_size  # Событий в таблице changes
+        self.batches = 0  # Транзакций писателя
+        self.writes = 0  # Операций писателя
+        self._stats = None  # (время подсчета, размеры) для stats
+        
+        conn = self._connect()
+        search_missing = not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_search'").fetchone()
+        conn.executescript(SCHEMA)
+        # Базы до отметок прочитанного хранили счетчик unread вместо read_seq
+        member_columns = {row[1] for row in conn.execute('PRAGMA table_info(chat_members)')}
+        if 'read_seq' not in member_columns:
+            conn.execute('ALTER TABLE chat_members ADD COLUMN read_seq INTEGER NOT NULL DEFAULT 0')
+        # Базы до групп: только личные чаты, метка активности у каждого участника
+        if 'role' not in member_columns:
+            conn.execute("ALTER TABLE chat_members ADD COLUMN role TEXT NOT NULL DEFAULT 'member'")
+            conn.execute('ALTER TABLE chat_members ADD COLUMN joined INTEGER NOT NULL DEFAULT 0')
+        if 'kind' not in {row[1] for row in conn.execute('PRAGMA table_info(chats)')}:
+            conn.execute("ALTER TABLE chats ADD COLUMN kind TEXT NOT NULL DEFAULT 'private'")
+            conn.execute('ALTER TABLE chats ADD COLUMN activity INTEGER NOT NULL DEFAULT 0')
+            conn.execute('UPDATE chats SET activity = (SELECT MAX(activity) FROM chat_members WHERE chat_id = chats.id)')
+            conn.execute('DROP INDEX IF EXISTS chat_members_activity')
+        conn.execute('CREATE INDEX IF NOT EXISTS chat_members_joined ON chat_members (chat_id, joined)')
+        # Базы до счетчиков реакций хранили только реакции пользователей
+        if not conn.execute('SELECT 1 FROM reaction_counts LIMIT 1').fetchone():
+            conn.execute('INSERT INTO reaction_counts SELECT message_id, reaction, COUNT(*) FROM reactions '
+                         'GROUP BY message_id, reaction')
+        # Базы до поиска по сообщениям: индексируем все неудаленные
+        if search_missing:
+            conn.execute('INSERT INTO message_search (rowid, body) '
+                         'SELECT rowid, search_text(content) FROM messages WHERE deleted = 0')
+        # Индекс поиска пользователей держим в памяти, как и в MemoryStorage
+        self.user_search = UserSearchIndex()
+        self.user_search.add_many(conn.execute('SELECT username, nickname FROM users'))
+        # Эпоха ленты и версий живет вместе с базой: новая база - новая нумерация
+        conn.execute("INSERT OR IGNORE INTO counters VALUES ('epoch', ?)", (new_epoch(),))
+        self.epoch = conn.execute("SELECT value FROM counters WHERE name = 'epoch'").fetchone()[0]
+        row = conn.execute(FEED_HEAD).fetchone()
+        self._feed_seq = row[0] if row else 0  # Последний выданный номер ленты (не в режиме shared)
+        conn.close()
+        
+        self._local = threading.local()
+        self._readers = []
+        self._seq = {}  # chat_id -> последний выданный seq
+        self._seq_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._queued = 0  # Номер последней поставленной операции
+        self._done = 0  # Номер последней записанной операции
+        self._closing = False
+        self._thread = threading.Thread(target=self._writer, name='sqlite-writer', daemon=True)
+        self._thread.start()
+    
+    def _connect(self):
+        # timeout - ожидание блокировки записи, которую держит другой процесс
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                               cached_statements=256, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=OFF')
+        conn.create_function('search_text', 1, normalize, deterministic=True)
+        return conn
+    
+    # Очередь записи
+    def _submit(self, fn, *args, wait=True):
+        item = [fn, args, None, None]
+        with self._cond:
+            if self._closing:
+                raise RuntimeError('Хранилище закрыто')
+            self._queued += 1
+            ticket = self._queued
+            self._queue.append(item)
+            self._cond.notify_all()
+        if not wait:
+            return None
+        self._wait(ticket)
+        if item[3] is not None:
+            raise item[3]
+        return item[2]
+    
+    def _wait(self, ticket):
+        with self._cond:
+            while self._done < ticket:
+                self._cond.wait()
+    
+    def flush(self):
+        # Дожидается всех уже поставленных записей
+        with self._cond:
+            ticket = self._queued
+        if self._done < ticket:
+            self._wait(ticket)
+    
+    def _writer(self):
+        conn = self._connect()
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                batch = []
+                while self._queue and len(batch) < self.batch_size:
+                    batch.append(self._queue.popleft())
+            # Вся пачка - одна транзакция. Если какая-то операция упала,
+            # откатываем пачку и повторяем операции по одной, чтобы ошибка
+            # одной не потеряла остальные
+            try:
+                self._apply(conn, batch)
+            except Exception:
+                for item in batch:
+                    try:
+                        self._apply(conn, [item])
+                    except Exception as e:
+                        item[3] = e
+                        log.exception('SQLite: ошибка операции %s', item[0].__name__)
+            with self._cond:
+                self.batches += 1
+                self.writes += len(batch)
+                self._done += len(batch)
+                self._cond.notify_all()
+        conn.close()
+    
+    def _apply(self, conn, batch):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Идущие подряд отправки и события ленты пишутся одним executemany
+            sends = []
+            changes = []
+            for item in batch:
+                if item[0] == self._insert_message:
+                    sends.append(item[1])
+                    continue
+                if item[0] == self._record_change:
+                    changes.append(item)
+                    continue
+                if sends:
+                    self._insert_messages(conn, sends)
+                    sends = []
+                if changes:
+                    self._record_changes(conn, changes)
+                    changes = []
+                item[2] = item[0](conn, *item[1])
+            if sends:
+                self._insert_messages(conn, sends)
+            if changes:
+                self._record_changes(conn, changes)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    
+    def _reader(self, flush=True):
+        # Свое соединение у каждого потока; записи, поставленные
+        # в очередь до чтения, к этому моменту уже закоммичены
+        if flush:
+            self.flush()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._readers.append(conn)
+        return conn
+    
+    def close(self):
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        for conn in self._readers:
+            conn.close()
+    
+    # Пользователи и настройки
+    def get_user(self, username):
+        row = self._reader().execute(SELECT_USER, (username,)).fetchone()
+        return dict(zip(USER_FIELDS, row)) if row else None
+    
+    def add_user(self, user, settings):
+        self._submit(self._add_user, user, settings)
+        self.user_search.add(user['username'], user['nickname'])
+    
+    def _add_user(self, conn, user, settings):
+        conn.execute(INSERT_USER, [user.get(field) for field in USER_FIELDS] + [json.dumps(settings)])
+        conn.execute(BUMP, (f'user:{user["username"]}',))
+    
+    def update_user(self, username, updates):
+        self._submit(self._update_user, username, updates)
+        if 'nickname' in updates:
+            self.user_search.update(username, updates['nickname'])
+    
+    def _update_user(self, conn, username, updates):
+        fields = [field for field in updates if field in USER_FIELDS and field != 'username']
+        if fields:
+            conn.execute(f'UPDATE users SET {", ".join(f + " = ?" for f in fields)} WHERE username = ?',
+                         [updates[field] for field in fields] + [username])
+            self._bump_profile(conn, username)
+    
+    def set_presence(self, username, status, last_seen):
+        # Не ждем: статус не влияет на ответ обработчика
+        self._submit(self._set_presence, username, status, last_seen, wait=False)
+    
+    def _set_presence(self, conn, username, status, last_seen):
+        if conn.execute('UPDATE users SET status = ?, last_seen = ? WHERE username = ?',
+                        (status, last_seen, username)).rowcount:
+            self._bump_profile(conn, username)
+    
+    def _bump_profile(self, conn, username):
+        # Имя, аватар и статус видны и в списках чатов собеседников
+        conn.execute(BUMP, (f'user:{username}',))
+        conn.execute(BUMP_CONTACTS, (username, username))
+    
+    def search_users(self, query, limit, exclude=None):
+        return self.user_search.search(query, limit=limit, exclude=exclude)
+    
+    def get_settings(self, username):
+        row = self._reader().execute('SELECT settings FROM users WHERE username = ?', (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def update_settings(self, username, settings):
+        self._submit(self._update_settings, username, settings)
+    
+    def _update_settings(self, conn, username, settings):
+        row = conn.execute('SELECT settings FROM users WHERE username = ?', (username,)).fetchone()
+        if row:
+            merged = json.loads(row[0])
+            merged.update(settings)
+            conn.execute('UPDATE users SET settings = ? WHERE username = ?', (json.dumps(merged), username))
+    
+    # Чаты
+    def get_chat(self, chat_id):
+        row = self._reader().execute('SELECT data FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def find_private_chat(self, user1, user2):
+        user_a, user_b = sorted((user1, user2))
+        row = self._reader().execute('SELECT chat_id FROM private_pairs WHERE user_a = ? AND user_b = ?',
+                                     (user_a, user_b)).fetchone()
+        return row[0] if row else None
+    
+    def create_chat(self, chat, welcome_msg=None, roles=None):
+        if welcome_msg and not self.shared:
+            with self._seq_lock:
+                welcome_msg['seq'] = self._seq[chat['id']] = 1
+        return self._submit(self._create_chat, chat, welcome_msg, roles)
+    
+    def _create_chat(self, conn, chat, welcome_msg, roles):
+        chat_id = chat['id']
+        if chat['type'] == 'private':
+            user_a, user_b = sorted(chat['members'])
+            row = conn.execute('SELECT chat_id FROM private_pairs WHERE user_a = ? AND user_b = ?',
+                               (user_a, user_b)).fetchone()
+            if row:
+                return row[0]
+            conn.execute('INSERT INTO private_pairs VALUES (?, ?, ?)', (user_a, user_b, chat_id))
+            roles = dict.fromkeys(chat['members'], 'member')
+        conn.execute('INSERT INTO chats (id, data, kind) VALUES (?, ?, ?)', (chat_id, json.dumps(chat), chat['type']))
+        conn.executemany('INSERT INTO chat_members (chat_id, username, role, joined) VALUES (?, ?, ?, ?)',
+                         [(chat_id, member, role, n) for n, (member, role) in enumerate(roles.items())])
+        conn.execute(BUMP_MEMBERS, (chat_id,))
+        if welcome_msg:
+            self._insert_message(conn, chat_id, welcome_msg)
+            # Приветствие считается прочитанным всеми
+            conn.execute('UPDATE chat_members SET read_seq = ? WHERE chat_id = ?', (welcome_msg['seq'], chat_id))
+        return chat_id
+    
+    def chat_list(self, username):
+        result = []
+        for row in self._reader().execute(CHAT_LIST, (username,)):
+            last_msg = message_from_row(row[2:]) if row[2] is not None else None
+            result.append((json.loads(row[0]), last_msg, row[1]))
+        return result
+    
+    def user_chat_ids(self, username):
+        rows = self._reader().execute('SELECT chat_id FROM chat_members WHERE username = ?', (username,))
+        return {row[0] for row in rows}
+    
+    def contacts(self, username):
+        rows = self._reader().execute(CONTACTS, (username, username))
+        return {row[0] for row in rows}
+    
+    # Участники
+    def member_role(self, chat_id, username):
+        # Проверяется на каждой отправке. Состав и роли меняются только
+        # синхронными записями, поэтому очередь сообщений ждать не нужно
+        row = self._reader(flush=False).execute(MEMBER_ROLE, (chat_id, username)).fetchone()
+        return row[0] if row else None
+    
+    def member_count(self, chat_id):
+        return self._reader().execute('SELECT COUNT(*) FROM chat_members WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+    
+    def member_page(self, chat_id, offset=0, limit=MEMBER_PAGE_SIZE):
+        conn = self._reader()
+        conn.execute('BEGIN')
+        try:
+            rows = conn.execute(MEMBER_PAGE, (chat_id, limit, offset)).fetchall()
+            total = conn.execute('SELECT COUNT(*) FROM chat_members WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+        finally:
+            conn.execute('COMMIT')
+        return rows, total
+    
+    def add_members(self, chat_id, roles):
+        return self._submit(self._add_members, chat_id, roles)
+    
+    def _add_members(self, conn, chat_id, roles):
+        row = conn.execute('SELECT last_seq, (SELECT IFNULL(MAX(joined), 0) FROM chat_members WHERE chat_id = ?1) '
+                           'FROM chats WHERE id = ?1', (chat_id,)).fetchone()
+        if not row:
+            return []
+        seq, joined = row
+        added = []
+        for username, role in roles.items():
+            joined += 1
+            # История видна, но непрочитанной новому участнику не считается
+            if conn.execute('INSERT OR IGNORE INTO chat_members (chat_id, username, read_seq, role, joined) '
+                            'VALUES (?, ?, ?, ?, ?)', (chat_id, username, seq, role, joined)).rowcount:
+                added.append(username)
+        conn.executemany(BUMP, [(f'chats:{username}',) for username in added])
+        return added
+    
+    def remove_member(self, chat_id, username):
+        return self._submit(self._remove_member, chat_id, username)
+    
+    def _remove_member(self, conn, chat_id, username):
+        if not conn.execute('DELETE FROM chat_members WHERE chat_id = ? AND username = ?',
+                            (chat_id, username)).rowcount:
+            return False
+        # Версия чата выпадает из суммы в get_version - своя растет на большее,
+        # чтобы версия списка не вернулась к уже выданному значению
+        conn.execute("INSERT INTO versions VALUES ('chats:' || ?1, 1 + IFNULL((SELECT value FROM versions "
+                     "WHERE key = 'chat:' || ?2), 0)) ON CONFLICT (key) DO UPDATE SET value = value + excluded.value",
+                     (username, chat_id))
+        return True
+    
+    def set_member_role(self, chat_id, username, role):
+        return self._submit(self._set_member_role, chat_id, username, role)
+    
+    def _set_member_role(self, conn, chat_id, username, role):
+        return conn.execute('UPDATE chat_members SET role = ? WHERE chat_id = ? AND username = ?',
+                            (role, chat_id, username)).rowcount > 0
+    
+    # Сообщения
+    def store_message(self, chat_id, message):
+        if self.shared:
+            # seq выдаст писатель; ждем, пока сообщение не запишется вместе с пачкой
+            self._submit(self._insert_message, chat_id, message)
+            return
+        # Порядок в очереди совпадает с порядком seq: оба под одной блокировкой.
+        # Обработчик отправки не ждет записи - сообщения уходят пачкой
+        with self._seq_lock:
+            if chat_id not in self._seq:
+                # Сообщения чата пишет только store_message, и он же заполняет
+                # self._seq, поэтому в очереди их быть не может - ждать не нужно.
+                # Берем из чата, а не MAX(seq): хвост мог быть удален и убран compact()
+                row = self._reader(flush=False).execute('SELECT last_seq FROM chats WHERE id = ?',
+                                                        (chat_id,)).fetchone()
+                self._seq[chat_id] = row[0] if row else 0
+            self._seq[chat_id] += 1
+            message['seq'] = self._seq[chat_id]
+            self._submit(self._insert_message, chat_id, message, wait=False)
+    
+    def _insert_message(self, conn, chat_id, message):
+        self._insert_messages(conn, [(chat_id, message)])
+    
+    def _insert_messages(self, conn, sends):
+        # Сводки чатов обновляются один раз на чат за пачку:
+        # последнее сообщение, метка активности и отметки прочитанного отправителей.
+        # Метка активности - общий счетчик в базе, чтобы порядок чатов был
+        # единым для всех процессов
+        row = conn.execute("SELECT value FROM counters WHERE name = 'activity'").fetchone()
+        activity = row[0] if row else 0
+        seqs = {}
+        rows = []
+        last = {}
+        marks = {}
+        for chat_id, message in sends:
+            if 'seq' not in message:
+                if chat_id not in seqs:
+                    row = conn.execute('SELECT last_seq FROM chats WHERE id = ?', (chat_id,)).fetchone()
+                    seqs[chat_id] = row[0] if row else 0
+                seqs[chat_id] += 1
+                message['seq'] = seqs[chat_id]
+            rows.append((message['id'], chat_id, message['seq'], message['sender'], message['content'],
+                         message['timestamp'], bool(message.get('edited', False))))
+            activity += 1
+            last[chat_id] = (message['id'], activity, message['seq'])
+            marks[(chat_id, message['sender'])] = message['seq']
+        conn.executemany(INSERT_MESSAGE, rows)
+        conn.executemany(INDEX_MESSAGE, [row[:1] for row in rows])
+        conn.executemany(READ_UP_TO, [(seq, chat_id, sender, seq) for (chat_id, sender), seq in marks.items()])
+        conn.executemany('UPDATE chats SET last_msg_id = ?, activity = ?, last_seq = ? WHERE id = ?',
+                         [(*summary, chat_id) for chat_id, summary in last.items()])
+        conn.executemany(BUMP_CHAT, [(chat_id,) for chat_id in last])
+        conn.execute("INSERT OR REPLACE INTO counters VALUES ('activity', ?)", (activity,))
+    
+    def find_message(self, message_id):
+        row = self._reader().execute(SELECT_MESSAGE, (message_id,)).fetchone()
+        if not row:
+            return None, None
+        return row[1], message_from_row(row)
+    
+    def search_messages(self, username, query, before=None, limit=PAGE_SIZE):
+        terms = query_terms(query)
+        if not terms:
+            return [], None
+        # FTS5 ищет по любому продолжению основы, а формы слова - только
+        # основа плюс окончание (search.py): лишнее отсеивается здесь.
+        # Строки идут по rowid без сортировки, поэтому читаем, пока не наберем limit
+        match = ' '.join(f'"{term}"*' if prefix else f'"{term}"' for term, prefix in terms)
+        rows = self._reader().execute(SEARCH_MESSAGES, (match, 2 ** 63 - 1 if before is None else before, username))
+        found = []
+        cursor = None
+        for row in rows:
+            if matches(row[5], terms):
+                found.append(message_from_row(row[1:]))
+                if len(found) == limit:
+                    cursor = row[0]
+                    break
+        rows.close()
+        return found, cursor
+    
+    def message_page(self, chat_id, before=None, after=None, limit=PAGE_SIZE):
+        conn = self._reader()
+        if after is not None:
+            rows = conn.execute(PAGE_AFTER, (chat_id, after, limit)).fetchall()
+        else:
+            if before is None:
+                rows = conn.execute(PAGE_LATEST, (chat_id, limit)).fetchall()
+            else:
+                rows = conn.execute(PAGE_BEFORE, (chat_id, before, limit)).fetchall()
+            rows.reverse()
+        return [message_from_row(row) for row in rows]
+    
+    def edit_message(self, message_id, content, edited_at):
+        self._submit(self._edit_message, message_id, content, edited_at)
+    
+    def _edit_message(self, conn, message_id, content, edited_at):
+        conn.execute(UNINDEX_MESSAGE, (message_id,))
+        row = conn.execute('UPDATE messages SET content = ?, edited = 1, edited_at = ? WHERE id = ? AND deleted = 0 '
+                           'RETURNING chat_id', (content, edited_at, message_id)).fetchone()
+        if row:
+            conn.execute(INDEX_MESSAGE, (message_id,))
+            conn.execute(BUMP_CHAT, (row[0],))
+    
+    def delete_message(self, message_id, deleted_at):
+        self._submit(self._delete_message, message_id, deleted_at)
+    
+    def _delete_message(self, conn, message_id, deleted_at):
+        row = conn.execute('SELECT chat_id, seq FROM messages WHERE id = ? AND deleted = 0',
+                           (message_id,)).fetchone()
+        if not row:
+            return
+        chat_id, seq = row
+        conn.execute(UNINDEX_MESSAGE, (message_id,))
+        conn.execute('UPDATE messages SET deleted = ? WHERE id = ?', (deleted_at, message_id))
+        conn.execute('INSERT INTO deleted_seqs VALUES (?, ?)', (chat_id, seq))
+        self._refresh_last_message(conn, chat_id)
+        conn.execute(BUMP_CHAT, (chat_id,))
+    
+    def clear_chat(self, chat_id, username, deleted_at):
+        self._submit(self._clear_chat, chat_id, username, deleted_at)
+    
+    def _clear_chat(self, conn, chat_id, username, deleted_at):
+        conn.execute("INSERT INTO message_search (message_search, rowid, body) "
+                     "SELECT 'delete', rowid, search_text(content) FROM messages "
+                     'WHERE chat_id = ? AND sender != ? AND deleted = 0', (chat_id, username))
+        conn.execute('INSERT INTO deleted_seqs SELECT chat_id, seq FROM messages '
+                     'WHERE chat_id = ? AND sender != ? AND deleted = 0', (chat_id, username))
+        conn.execute('UPDATE messages SET deleted = ? WHERE chat_id = ? AND sender != ? AND deleted = 0',
+                     (deleted_at, chat_id, username))
+        self._refresh_last_message(conn, chat_id)
+        conn.execute(BUMP_CHAT, (chat_id,))
+    
+    def compact(self, cutoff):
+        return self._submit(self._compact, cutoff)
+    
+    def _compact(self, conn, cutoff):
+        conn.execute('DELETE FROM reactions WHERE message_id IN '
+                     '(SELECT id FROM messages WHERE deleted > 0 AND deleted <= ?)', (cutoff,))
+        conn.execute('DELETE FROM reaction_counts WHERE message_id IN '
+                     '(SELECT id FROM messages WHERE deleted > 0 AND deleted <= ?)', (cutoff,))
+        conn.execute('DELETE FROM deleted_seqs WHERE seq <= '
+                     '(SELECT MIN(read_seq) FROM chat_members m WHERE m.chat_id = deleted_seqs.chat_id)')
+        return conn.execute('DELETE FROM messages WHERE deleted > 0 AND deleted <= ?', (cutoff,)).rowcount
+    
+    def read_up_to(self, chat_id, username, seq):
+        return self._submit(self._read_up_to, chat_id, username, seq)
+    
+    def _read_up_to(self, conn, chat_id, username, seq):
+        row = conn.execute('SELECT last_seq FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        seq = min(seq, row[0]) if row else 0
+        if conn.execute(READ_UP_TO, (seq, chat_id, username, seq)).rowcount:
+            conn.execute(BUMP, (f'chats:{username}',))
+            return seq
+        return None
+    
+    def _refresh_last_message(self, conn, chat_id):
+        row = conn.execute(LAST_MESSAGE, (chat_id,)).fetchone()
+        conn.execute('UPDATE chats SET last_msg_id = ? WHERE id = ?', (row[0] if row else None, chat_id))
+    
+    # Реакции
+    def toggle_reaction(self, message_id, username, reaction):
+        return self._submit(self._toggle_reaction, message_id, username, reaction)
+    
+    def _toggle_reaction(self, conn, message_id, username, reaction):
+        row = conn.execute('DELETE FROM reactions WHERE message_id = ? AND username = ? RETURNING reaction',
+                           (message_id, username)).fetchone()
+        if row:
+            reaction, delta = row[0], -1
+        else:
+            conn.execute('INSERT INTO reactions VALUES (?, ?, ?)', (message_id, username, reaction))
+            delta = 1
+        count, = conn.execute(COUNT_REACTION, (message_id, reaction, delta)).fetchone()
+        if not count:
+            conn.execute('DELETE FROM reaction_counts WHERE message_id = ? AND reaction = ?', (message_id, reaction))
+        return reaction, delta, count
+    
+    def get_reactions(self, message_ids, username):
+        if not message_ids:
+            return {}
+        counts = {}
+        mine = {}
+        # Один запрос - один согласованный срез счетчиков и своей реакции
+        rows = self._reader().execute(
+            f'SELECT c.message_id, c.reaction, c.count, r.reaction FROM reaction_counts c '
+            f'LEFT JOIN reactions r ON r.message_id = c.message_id AND r.username = ? '
+            f'WHERE c.message_id IN ({", ".join("?" * len(message_ids))})', [username, *message_ids])
+        for message_id, reaction, count, own in rows:
+            counts.setdefault(message_id, {})[reaction] = count
+            mine[message_id] = own
+        return {message_id: (message_counts, mine[message_id]) for message_id, message_counts in counts.items()}
+
+    # Лента изменений
+    def record_change(self, chat_id, event, data):
+        if self.shared:
+            # Номер выдаст писатель по счетчику в базе, общему для воркеров
+            return self._submit(self._record_change, None, chat_id, event, data)
+        with self._seq_lock:
+            self._feed_seq += 1
+            seq = self._feed_seq
+            self._submit(self._record_change, seq, chat_id, event, data, wait=False)
+        return seq
+    
+    def _record_change(self, conn, seq, chat_id, event, data):
+        item = [self._record_change, (seq, chat_id, event, data), None, None]
+        self._record_changes(conn, [item])
+        return item[2]
+    
+    def _record_changes(self, conn, items):
+        # Буфер кольцевой: все, что старше feed_size событий, удаляется
+        row = conn.execute(FEED_HEAD).fetchone()
+        head = row[0] if row else 0
+        rows = []
+        for item in items:
+            seq, chat_id, event, data = item[1]
+            if seq is None:
+                seq = head + 1
+            head = max(head, seq)
+            item[2] = seq
+            rows.append((seq, chat_id, event, json.dumps(data)))
+        conn.executemany('INSERT INTO changes VALUES (?, ?, ?, ?)', rows)
+        conn.execute("INSERT OR REPLACE INTO counters VALUES ('feed', ?)", (head,))
+        conn.execute('DELETE FROM changes WHERE seq <= ?', (head - self.feed_size,))
+    
+    def changes_since(self, seq, chat_ids, limit):
+        conn = self._reader()
+        chat_ids = list(chat_ids)
+        # Счетчик и события читаем в одной транзакции: писатель мог бы
+        # вытеснить события между двумя запросами
+        conn.execute('BEGIN')
+        try:
+            row = conn.execute(FEED_HEAD).fetchone()
+            head = row[0] if row else 0
+            if seq is None or seq > head or seq < head - self.feed_size:
+                return head, None
+            rows = conn.execute(
+                f'SELECT seq, chat_id, event, data FROM changes WHERE seq > ? AND seq <= ? '
+                f'AND chat_id IN ({", ".join("?" * len(chat_ids))}) ORDER BY seq LIMIT ?',
+                [seq, head] + chat_ids + [limit]).fetchall()
+        finally:
+            conn.execute('COMMIT')
+        events = [(row[0], row[1], row[2], json.loads(row[3])) for row in rows]
+        if len(events) == limit:
+            return events[-1][0], events
+        return head, events
+    
+    # Версии для ETag
+    def get_version(self, kind, name):
+        if kind == 'chats':
+            # Своя версия плюс версии групп пользователя
+            return self._reader().execute(CHATS_VERSION, (name,)).fetchone()[0]
+        row = self._reader().execute('SELECT value FROM versions WHERE key = ?', (f'{kind}:{name}',)).fetchone()
+        return row[0] if row else 0
+    
+    def stats(self):
+        now = time.monotonic()
+        cached = self._stats
+        if cached is None or now - cached[0] >= STATS_TTL:
+            users, chats, messages, deleted, reacted = self._reader(flush=False).execute(STATS).fetchone()
+            cached = self._stats = (now, {'users': users, 'chats': chats, 'messages': messages - deleted,
+                                          'deleted_messages': deleted, 'reacted_messages': reacted})
+        return dict(cached[1])
@@ -0,0 +1,104 @@
+# Переписка для проверок хранения: сообщения, правки, удаления, реакции
+# и отметки прочитанного в нескольких чатах, и снимок всего, что из этого
+# видят клиенты через REST.
+from client import Client, get, post
+
+USERS = ('ann', 'ben', 'cat')
+PAGE = 7  # Маленькие страницы: курсоры истории проверяются на многих границах
+# Поля, которые различаются между двумя прогонами одной переписки
+VOLATILE = ('id', 'chat_id', 'timestamp', 'created_at', 'edited_at', 'time')
+
+
+def populate(port, messages=40, padding=0):
+    # Возвращает id чатов: два личных и группа из всех трех
+    for username in USERS:
+        post(port, '/api/register', {'username': username, 'password': 'password123'})
+    chats = {
+        post(port, '/api/chat/create', {'user1': 'ann', 'user2': 'ben'})['chat_id']: ('ann', 'ben'),
+        post(port, '/api/chat/create', {'user1': 'ann', 'user2': 'cat'})['chat_id']: ('ann', 'cat'),
+        post(port, '/api/group/create', {'creator': 'ann', 'name': 'трое',
+                                         'members': ['ben', 'cat']})['chat_id']: USERS
+    }
+    clients = {username: Client(port) for username in USERS}
+    try:
+        for n in range(messages):
+            for chat_id, members in chats.items():
+                sender = members[n % len(members)]
+                clients[sender].call('send_message', {'chat_id': chat_id, 'sender': sender,
+                                                      'content': f'{n} {"x" * padding}'})
+        for chat_id, members in chats.items():
+            sent = history(port, chat_id)
+            for n, msg in enumerate(sent):
+                if msg['sender'] == 'system':
+                    continue
+                if n % 7 == 1:
+                    clients[msg['sender']].call('edit_message', {'message_id': msg['id'], 'chat_id': chat_id,
+                                                                 'username': msg['sender'],
+                                                                 'content': f'{msg["content"]} (правка)'})
+                if n % 3 == 0:
+                    for username in members[:n % len(members) + 1]:
+                        post(port, '/api/message/react', {'message_id': msg['id'], 'username': username,
+                                                          'reaction': '👍' if n % 2 else '🔥'})
+                if n % 5 == 0:
+                    post(port, '/api/message/delete', {'message_id': msg['id'], 'username': msg['sender']})
+            # Хвост от первого участника: отправка отмечает прочитанным только
+            # у отправителя, второй читает половину хвоста, третий - ничего
+            sender = members[0]
+            for n in range(6):
+                clients[sender].call('send_message', {'chat_id': chat_id, 'sender': sender, 'content': f'хвост {n}'})
+            tail = history(port, chat_id)[-6:]
+            clients[members[1]].call('read_up_to', {'chat_id': chat_id, 'username': members[1],
+                                                    'seq': tail[2]['seq']})
+        # Реакция, поставленная и снятая
+        msg = history(port, next(iter(chats)))[-1]
+        for _ in range(2):
+            post(port, '/api/message/react', {'message_id': msg['id'], 'username': 'ben', 'reaction': '😂'})
+        # Очистка: в чате ann и cat остаются сообщения cat, затем переписка продолжается
+        cleared = list(chats)[1]
+        post(port, f'/api/chat/{cleared}/clear', {'username': 'cat'})
+        for n in range(3):
+            clients['ann'].call('send_message', {'chat_id': cleared, 'sender': 'ann', 'content': f'после очистки {n}'})
+    finally:
+        for client in clients.values():
+            client.close()
+    return list(chats)
+
+
+def history(port, chat_id):
+    # Вся история чата страницами от новых к старым по курсору before
+    messages = []
+    path = f'/api/chat/{chat_id}/messages?limit={PAGE}'
+    while True:
+        page = get(port, path)
+        if not page:
+            return messages
+        messages[:0] = page
+        path = f'/api/chat/{chat_id}/messages?limit={PAGE}&before={page[0]["seq"]}'
+
+
+def state(port, chat_ids):
+    # Все, что видят клиенты: страницы истории в обе стороны, списки чатов
+    # с непрочитанным и участники групп
+    result = {'chats': {username: get(port, f'/api/chats?username={username}') for username in USERS + ('alice',)},
+              'history': []}
+    for chat_id in chat_ids:
+        pages = []
+        after = 0
+        while True:
+            page = get(port, f'/api/chat/{chat_id}/messages?limit={PAGE}&after={after}')
+            if not page:
+                break
+            pages.append(page)
+            after = page[-1]['seq']
+        result['history'].append({'before': history(port, chat_id), 'after': pages,
+                                  'members': get(port, f'/api/chat/{chat_id}/members')})
+    return result
+
+
+def anonymous(value):
+    # Состояние без id и времени - для сравнения разных серверов
+    if isinstance(value, dict):
+        return {key: anonymous(item) for key, item in value.items() if key not in VOLATILE}
+    if isinstance(value, list):
+        return [anonymous(item) for item in value]
+    return value
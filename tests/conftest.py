@@ -0,0 +1,60 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, 'bench'))  # client.py; остальные имена там совпадают с корнем
+
+from client import wait_ready  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Servers:
+    # Воркеры (workers.py) в отдельных процессах: вызов запускает один
+    # с хранилищем в памяти и возвращает его порт, окружение сервера
+    # дополняется аргументами
+    def __init__(self, directory):
+        self.directory = directory
+        self.processes = {}  # порт -> процесс
+    
+    def __call__(self, **overrides):
+        port = free_port()
+        env = dict(os.environ, DEEPLINK_DATA_DIR='', DEEPLINK_PORT=str(port))
+        env.update(overrides)
+        process = subprocess.Popen([sys.executable, 'workers.py', '--workers', '1', '--host', '127.0.0.1',
+                                    '--bus', str(self.directory / f'bus-{port}.sock')], cwd=ROOT, env=env,
+                                   start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.processes[port] = process
+        wait_ready(port)
+        return port
+    
+    def stop(self, port, sig=signal.SIGTERM):
+        # SIGKILL - падение: ни atexit, ни сброса буферов
+        process = self.processes.pop(port)
+        os.killpg(process.pid, sig)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+    def close(self):
+        for port in list(self.processes):
+            self.stop(port)
+
+
+@pytest.fixture
+def server(tmp_path):
+    servers = Servers(tmp_path)
+    yield servers
+    servers.close()
@@ -0,0 +1,29 @@
+from urllib.error import HTTPError
+
+import pytest
+
+from client import get, post
+
+
+@pytest.fixture
+def port(server):
+    port = server(DEEPLINK_RATE_LIMIT_SCALE='0')
+    for username in ('ann', 'ben'):
+        post(port, '/api/register', {'username': username, 'password': 'password123'})
+    return port
+
+
+def test_group_name_reaches_members_as_is(port):
+    name = '<img src=x onerror=alert(1)>'
+    created = post(port, '/api/group/create', {'creator': 'ann', 'name': f'  {name} ', 'members': ['ben']})
+    assert created['success']
+    # Экранирует клиент при выводе; сервер хранит название как есть, без пробелов по краям
+    chats = get(port, '/api/chats?username=ben')
+    assert [chat['name'] for chat in chats if chat['id'] == created['chat_id']] == [name]
+
+
+@pytest.mark.parametrize('name', ['   ', 'x' * 65, 42, ['group']])
+def test_invalid_group_name_is_rejected(port, name):
+    with pytest.raises(HTTPError) as error:
+        post(port, '/api/group/create', {'creator': 'ann', 'name': name, 'members': ['ben']})
+    assert error.value.code == 400
@@ -0,0 +1,30 @@
+# Журнал и снимки хранилища в памяти: после падения сервер поднимает из
+# каталога данных ровно то состояние, которое видели клиенты.
+import signal
+
+import pytest
+
+from chat_state import populate, state
+
+
+@pytest.mark.parametrize('snapshot_every', ['0', '50'])
+def test_state_survives_crash(server, tmp_path, snapshot_every):
+    # 0 - только журнал; 50 - несколько снимков (fork) и хвост журнала после них
+    env = {'DEEPLINK_DATA_DIR': str(tmp_path / 'data'), 'DEEPLINK_SYNC_COMMIT': '1',
+           'DEEPLINK_SNAPSHOT_EVERY': snapshot_every, 'DEEPLINK_RATE_LIMIT_SCALE': '0'}
+    port = server(**env)
+    chat_ids = populate(port)
+    before = state(port, chat_ids)
+    # С DEEPLINK_SYNC_COMMIT=1 каждый ответ дан после fsync, поэтому падение
+    # сразу после последнего запроса ничего не теряет
+    server.stop(port, signal.SIGKILL)
+    if snapshot_every != '0':
+        assert list((tmp_path / 'data').glob('snapshot-*.pkl'))
+    
+    port = server(**env)
+    assert state(port, chat_ids) == before
+    # И после второго перезапуска, когда поверх восстановленного дописано еще
+    chat_ids += populate(port, messages=5)
+    before = state(port, chat_ids)
+    server.stop(port, signal.SIGKILL)
+    assert state(server(**env), chat_ids) == before
@@ -0,0 +1,35 @@
+from urllib.error import HTTPError
+
+import pytest
+
+from client import post
+
+BURST = 5  # Всплеск api_chat_clear и api_register в srver.RATE_LIMITS
+
+
+def statuses(port, path, payloads):
+    codes = []
+    for payload in payloads:
+        try:
+            post(port, path, payload)
+            codes.append(200)
+        except HTTPError as error:
+            codes.append(error.code)
+            if error.code == 429:
+                assert int(error.headers['Retry-After']) >= 1
+    return codes
+
+
+@pytest.mark.parametrize('field', ['username', None])
+def test_rest_limit_holds_across_usernames(server, field):
+    # Новое имя в каждом запросе не дает новой корзины: адрес тот же
+    port = server()
+    payloads = [{field: f'user{n}'} if field else {} for n in range(BURST + 1)]
+    codes = statuses(port, '/api/chat/missing/clear', payloads)
+    assert codes == [200] * BURST + [429]
+
+
+def test_registration_is_limited_by_address(server):
+    port = server()
+    payloads = [{'username': f'user{n}', 'password': 'password123'} for n in range(BURST + 1)]
+    assert statuses(port, '/api/register', payloads)[-1] == 429
@@ -0,0 +1,30 @@
+from urllib.error import HTTPError
+
+import pytest
+
+from client import get, post
+
+
+@pytest.fixture
+def message(server):
+    port = server(DEEPLINK_RATE_LIMIT_SCALE='0')
+    for username in ('ann', 'ben'):
+        post(port, '/api/register', {'username': username, 'password': 'password123'})
+    chat_id = post(port, '/api/chat/create', {'user1': 'ann', 'user2': 'ben'})['chat_id']
+    return port, get(port, f'/api/chat/{chat_id}/messages')[-1]['id']
+
+
+def test_toggle_reaction(message):
+    port, message_id = message
+    change = post(port, '/api/message/react', {'message_id': message_id, 'username': 'ann', 'reaction': '👍'})
+    assert (change['reaction'], change['delta'], change['count']) == ('👍', 1, 1)
+    change = post(port, '/api/message/react', {'message_id': message_id, 'username': 'ann', 'reaction': '👍'})
+    assert (change['delta'], change['count']) == (-1, 0)
+
+
+@pytest.mark.parametrize('reaction', [None, '', 42, ['👍'], {'emoji': '👍'}, '👍' * 100])
+def test_invalid_reaction_is_rejected(message, reaction):
+    port, message_id = message
+    with pytest.raises(HTTPError) as error:
+        post(port, '/api/message/react', {'message_id': message_id, 'username': 'ann', 'reaction': reaction})
+    assert error.value.code == 400
@@ -0,0 +1,64 @@
+# Холодная история под маленьким бюджетом памяти: вытеснение в сегменты,
+# чтение с диска, подкачка, восстановление после падения и удаление
+# опустевших файлов сегментов.
+import signal
+import time
+import urllib.request
+
+from chat_state import anonymous, populate, state
+
+PADDING = 200  # Сообщения по ~250 байт: переписка в несколько раз больше бюджета
+
+
+def tier_events(port):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+        text = response.read().decode('utf-8')
+    prefix = 'deeplink_message_tier_events_total{event="'
+    return {line[len(prefix):].split('"')[0]: float(line.rpartition(' ')[2])
+            for line in text.splitlines() if line.startswith(prefix)}
+
+
+def test_spilled_history_survives_restart_and_collection(server, tmp_path):
+    # Та же переписка целиком в памяти - образец
+    memory = server(DEEPLINK_RATE_LIMIT_SCALE='0')
+    expected = anonymous(state(memory, populate(memory, padding=PADDING)))
+    server.stop(memory)
+    
+    segments = tmp_path / 'data' / 'segments'
+    env = {'DEEPLINK_DATA_DIR': str(tmp_path / 'data'), 'DEEPLINK_HOT_MESSAGES_MB': '0.02',
+           'DEEPLINK_SYNC_COMMIT': '1', 'DEEPLINK_SNAPSHOT_EVERY': '50', 'DEEPLINK_COMPACT_INTERVAL': '0.2',
+           'DEEPLINK_TOMBSTONE_GRACE': '0', 'DEEPLINK_RATE_LIMIT_SCALE': '0'}
+    port = server(**env)
+    chat_ids = populate(port, padding=PADDING)
+    before = state(port, chat_ids)
+    events = tier_events(port)
+    assert events['evictions'] and events['spilled'] and events['cold_reads'] and events['page_ins']
+    assert anonymous(before) == expected
+    
+    first_run = set(segments.glob('seg-*.dat'))
+    assert first_run
+    server.stop(port, signal.SIGKILL)
+    
+    # Новый запуск пишет в новый файл, уборка переносит туда живые блоки из
+    # старого. Без нового снимка старый файл нужен последнему снимку и
+    # остается: падение восстанавливается по снимку и журналу
+    port = server(**dict(env, DEEPLINK_SNAPSHOT_EVERY='0'))
+    assert state(port, chat_ids) == before
+    chat_ids += populate(port, messages=10, padding=PADDING)
+    time.sleep(1)
+    assert first_run <= set(segments.glob('seg-*.dat'))
+    before = state(port, chat_ids)
+    server.stop(port, signal.SIGKILL)
+    port = server(**env)
+    assert state(port, chat_ids) == before
+    
+    # Со снимками опустевший старый файл удаляется
+    chat_ids += populate(port, messages=10, padding=PADDING)
+    deadline = time.monotonic() + 20
+    while first_run & set(segments.glob('seg-*.dat')):
+        assert time.monotonic() < deadline, 'файл сегментов прошлого запуска не удален'
+        time.sleep(0.2)
+    before = state(port, chat_ids)
+    server.stop(port, signal.SIGKILL)
+    port = server(**env)
+    assert state(port, chat_ids) == before
@@ -0,0 +1,121 @@
+# Несколько воркеров: клиенты подключены к разным процессам, события
+# и присутствие должны доходить до каждого через шину.
+#
+# Каждый воркер слушает свой порт, чтобы клиентов можно было разложить
+# по процессам явно (в workers.py порт общий и распределяет ядро).
+import os
+import signal
+import time
+
+import pytest
+
+from bus import Broker
+from client import Client, post, wait_ready
+from workers import listen, spawn
+
+WORKERS = 3
+
+
+@pytest.fixture(scope='module')
+def ports(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('workers')
+    environ = dict(os.environ)
+    os.environ.update({
+        'DEEPLINK_STORAGE': 'sqlite',
+        'DEEPLINK_SQLITE_PATH': str(workdir / 'deeplink.db'),
+        'DEEPLINK_DATA_DIR': '',
+        'DEEPLINK_RATE_LIMIT_SCALE': '0'
+    })
+    broker = Broker(str(workdir / 'bus.sock')).start()
+    socks = [listen('127.0.0.1', 0) for _ in range(WORKERS)]
+    ports = [sock.getsockname()[1] for sock in socks]
+    pids = [spawn(i, broker.path, sock, '127.0.0.1', port) for i, (sock, port) in enumerate(zip(socks, ports))]
+    os.environ.clear()
+    os.environ.update(environ)
+    try:
+        for port in ports:
+            wait_ready(port)
+        yield ports
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        for sock in socks:
+            sock.close()
+        broker.close()
+
+
+def register(ports, *usernames):
+    for i, username in enumerate(usernames):
+        assert post(ports[i % WORKERS], '/api/register', {'username': username, 'password': 'password123'})['success']
+
+
+def group(ports, tag):
+    # Группа из трех участников, по одному клиенту на каждом воркере
+    members = [f'{tag}{i}' for i in range(WORKERS)]
+    register(ports, *members)
+    chat_id = post(ports[0], '/api/group/create', {'creator': members[0], 'name': tag,
+                                                   'members': members[1:]})['chat_id']
+    clients = [Client(port) for port in ports]
+    for client, username in zip(clients, members):
+        client.emit('user_online', {'username': username})
+        client.call('join_chat', {'chat_id': chat_id})
+    return chat_id, members, clients
+
+
+def test_message_reaches_every_worker(ports):
+    chat_id, members, clients = group(ports, 'msg')
+    try:
+        for sender, client in zip(members, clients):
+            client.call('send_message', {'chat_id': chat_id, 'sender': sender, 'content': f'от {sender}'})
+            for reader in clients:
+                reader.wait('new_message', lambda data: data['content'] == f'от {sender}')
+    finally:
+        for client in clients:
+            client.close()
+
+
+def test_reaction_and_delete_reach_every_worker(ports):
+    chat_id, members, clients = group(ports, 'react')
+    try:
+        clients[0].call('send_message', {'chat_id': chat_id, 'sender': members[0], 'content': 'привет'})
+        _, message = clients[1].wait('new_message', lambda data: data['sender'] == members[0])
+        
+        # REST-запросы к воркеру, где автора сообщения нет
+        assert post(ports[2], '/api/message/react', {'message_id': message['id'], 'username': members[2],
+                                                     'reaction': '👍'})['success']
+        for client in clients:
+            client.wait('message_reaction', lambda data: data['message_id'] == message['id'])
+        assert post(ports[2], '/api/message/delete', {'message_id': message['id'], 'username': members[0]})['success']
+        for client in clients:
+            client.wait('message_deleted', lambda data: data['message_id'] == message['id'])
+    finally:
+        for client in clients:
+            client.close()
+
+
+def test_presence_crosses_workers(ports):
+    register(ports, 'ann', 'ben', 'cat', 'dan')
+    post(ports[2], '/api/chat/create', {'user1': 'ann', 'user2': 'ben'})
+    
+    # ann - воркер 0, ben - воркер 1, cat (подписан на статус dan) - воркер 2
+    ann, ben, cat = Client(ports[0]), Client(ports[1]), Client(ports[2])
+    try:
+        ann.emit('user_online', {'username': 'ann'})
+        cat.emit('user_online', {'username': 'cat'})
+        cat.call('subscribe_presence', {'usernames': ['dan']})
+        time.sleep(0.5)  # Статус ann доходит до воркера ben через шину
+        ben.emit('user_online', {'username': 'ben'})
+        ann.wait('user_online', lambda data: data['username'] == 'ben')
+        
+        dan = Client(ports[0])
+        dan.emit('user_online', {'username': 'dan'})
+        cat.wait('user_online', lambda data: data['username'] == 'dan')
+        dan.close()
+        cat.wait('user_offline', lambda data: data['username'] == 'dan')
+        ben.close()
+        ann.wait('user_offline', lambda data: data['username'] == 'ben')
+    finally:
+        for client in (ann, ben, cat):
+            client.close()
@@ -0,0 +1,488 @@
+# Уровни хранения сообщений MemoryStorage: горячие чаты в памяти, холодная
+# история в сегментах на диске.
+#
+# Память под сообщения ограничена бюджетом (DEEPLINK_HOT_MESSAGES_MB). Чаты,
+# у которых есть сообщения в памяти, учитываются в порядке последнего
+# обращения (LRU): отправка, страница истории. Когда сумма превышает бюджет,
+# давно не тронутые чаты целиком уходят на диск. У активного чата в памяти
+# остается хвост из последних HOT_TAIL сообщений - история старше тоже
+# уходит на диск, пачками, когда хвост вырастает вдвое.
+#
+# На диске сообщения лежат блоками в файлах segments/seg-N.dat, которые только
+# дописываются. Блок - сообщения одного чата подряд по seq: число записей,
+# таблица seq, таблица концов записей и сами записи (без chat_id, время -
+# целые мс). Удаленные сообщения на диск не пишутся: на страницах истории их
+# и так нет. Файл читается через mmap при первом обращении, страница истории
+# декодирует только свои записи. Открытие выгруженного чата возвращает его
+# последний блок в память (подкачка). Список чатов берет только последнее
+# сообщение чата, которое всегда остается в памяти, и диск не трогает.
+#
+# Блоки не меняются: правка или удаление холодного сообщения переписывает блок
+# в новый, старый становится мусором. Редкий чат вытесняется по нескольку
+# сообщений за раз; его мелкие блоки подряд сливает в один периодическая
+# уборка (collect), а не отправка. Файл без живых блоков удаляется, когда его
+# уже не видит ни один снимок (persistence.py): снимок хранит ссылки на блоки,
+# а не сами сообщения, поэтому перед снимком сегмент сбрасывается на диск.
+#
+# find_message ищет холодные сообщения по таблице id -> (чат, seq): открытая
+# адресация на двух массивах, 16 байт на ячейку вместо записи с текстом.
+import glob
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from hashlib import blake2b
+from operator import itemgetter
+
+from messages import Message
+
+HOT_TAIL = 500  # Сообщений в памяти у активного чата - десять страниц истории
+SMALL_BLOCK = 100  # Блоки меньше этого, идущие подряд, сливаются при уборке
+MERGE_RUN = 8  # ...когда их набралось столько или вместе они уже не мелкие
+ID_SHARDS = 256  # Таблица id разбита по старшим битам отпечатка: рост - по частям, без долгой паузы
+SEGMENT_SIZE = 64 * 1024 * 1024  # После этого размера блоки пишутся в новый файл
+# Байт на сообщение в памяти без текста: запись, строка id, место в списке чата и в message_index
+MESSAGE_OVERHEAD = 220
+EVENTS = ('hits', 'misses', 'page_ins', 'evictions', 'spilled', 'cold_reads')
+
+COUNT = struct.Struct('<I')
+RECORD = struct.Struct('<IqqHHI')  # seq, время, время правки, длины id, отправителя и текста
+
+# Ссылка на блок: (первый seq, последний seq, номер файла, смещение, длина, записей)
+first_seq = itemgetter(0)
+last_seq = itemgetter(1)
+
+
+def footprint(record):
+    return MESSAGE_OVERHEAD + sys.getsizeof(record.content)
+
+
+def fingerprint(message_id):
+    # 64-битный отпечаток id; 0 - пустая ячейка таблицы
+    return int.from_bytes(blake2b(message_id.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+def encode_block(records):
+    seqs = array('I')
+    ends = array('I')
+    parts = []
+    end = 0
+    for record in records:
+        message_id = record.id.encode('utf-8')
+        sender = record.sender.encode('utf-8')
+        content = record.content.encode('utf-8')
+        parts += (RECORD.pack(record.seq, record.timestamp, record.edited_at, len(message_id), len(sender),
+                              len(content)), message_id, sender, content)
+        end += RECORD.size + len(message_id) + len(sender) + len(content)
+        seqs.append(record.seq)
+        ends.append(end)
+    return b''.join([COUNT.pack(len(records)), seqs.tobytes(), ends.tobytes()] + parts)
+
+
+def decode_record(chat_id, data, pos):
+    seq, timestamp, edited_at, id_length, sender_length, content_length = RECORD.unpack_from(data, pos)
+    pos += RECORD.size
+    message_id = str(data[pos:pos + id_length], 'utf-8')
+    pos += id_length
+    sender = str(data[pos:pos + sender_length], 'utf-8')
+    pos += sender_length
+    content = str(data[pos:pos + content_length], 'utf-8')
+    return Message(chat_id, seq, message_id, sys.intern(sender), content, timestamp, edited_at)
+
+
+class IdTable:
+    # id сообщения -> номер чата << 32 | seq. Линейное пробирование, ключ -
+    # отпечаток id. Отпечатки могут совпасть, поэтому поиск отдает всех
+    # кандидатов, а найденная запись сверяется по id
+    def __init__(self, capacity=64):
+        self.keys = array('Q', bytes(8 * capacity))
+        self.values = array('Q', bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.size = 0
+    
+    def add(self, key, value):
+        if (self.size + 1) * 3 > len(self.keys) * 2:
+            self._grow()
+        keys = self.keys
+        slot = key & self.mask
+        while keys[slot]:
+            slot = (slot + 1) & self.mask
+        keys[slot] = key
+        self.values[slot] = value
+        self.size += 1
+    
+    def candidates(self, key):
+        keys = self.keys
+        slot = key & self.mask
+        while keys[slot]:
+            if keys[slot] == key:
+                yield self.values[slot]
+            slot = (slot + 1) & self.mask
+    
+    def remove(self, key, value):
+        keys, values, mask = self.keys, self.values, self.mask
+        slot = key & mask
+        while keys[slot]:
+            if keys[slot] == key and values[slot] == value:
+                break
+            slot = (slot + 1) & mask
+        else:
+            return
+        # Сдвиг назад вместо пометки: цепочки не растут от удалений
+        hole = slot
+        while True:
+            slot = (slot + 1) & mask
+            key = keys[slot]
+            if not key:
+                break
+            if (slot - key) & mask >= (slot - hole) & mask:
+                keys[hole] = key
+                values[hole] = values[slot]
+                hole = slot
+        keys[hole] = 0
+        values[hole] = 0
+        self.size -= 1
+    
+    def _grow(self):
+        keys, values = self.keys, self.values
+        self.__init__(len(keys) * 2)
+        for key, value in zip(keys, values):
+            if key:
+                self.add(key, value)
+
+
+class MessageTiers:
+    def __init__(self):
+        self.blocks = {}  # chat_id -> ссылки на блоки по возрастанию seq
+        self.files = {}  # номер файла -> байт в живых блоках
+        self.ids = [IdTable() for _ in range(ID_SHARDS)]
+        self.chat_numbers = {}  # chat_id -> номер для таблицы id
+        self.chat_ids = []
+        self.cold_messages = 0
+        # Дальше - только на время работы процесса, в снимок не входит
+        self.directory = None  # Каталог сегментов; None - уровни выключены
+        self.budget = 0  # Байт под сообщения в памяти; 0 - не вытеснять
+        self.hot = OrderedDict()  # chat_id -> байт в памяти, давно не тронутые первыми
+        self.hot_bytes = 0
+        self.events = dict.fromkeys(EVENTS, 0)
+        self.dead = {}  # номер опустевшего файла -> lsn журнала, когда это замечено
+        self._file = None
+        self._number = 0
+        self._size = 0
+        self._maps = {}
+    
+    def __getstate__(self):
+        return {name: getattr(self, name)
+                for name in ('blocks', 'files', 'ids', 'chat_numbers', 'chat_ids', 'cold_messages')}
+    
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+    
+    @property
+    def enabled(self):
+        return self.directory is not None
+    
+    def open(self, directory, budget):
+        # Файлы, о которых не знает состояние, дописаны после снимка - мусор.
+        # Новый запуск пишет в новый файл
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.budget = budget
+        for path in glob.glob(os.path.join(directory, 'seg-*.dat')):
+            number = os.path.basename(path)[4:-4]
+            if not number.isdigit() or int(number) not in self.files:
+                os.remove(path)
+        self._number = max(self.files, default=0)
+    
+    def close(self):
+        for data in self._maps.values():
+            data.close()
+        self._maps = {}
+        if self._file:
+            self._file.close()
+            self._file = None
+    
+    def sync(self):
+        # Блоки, на которые сошлется снимок, должны быть на диске раньше него
+        if self._file:
+            os.fsync(self._file.fileno())
+    
+    # Память
+    def add_hot(self, chat_id, size):
+        self.hot[chat_id] = self.hot.get(chat_id, 0) + size
+        self.hot.move_to_end(chat_id)
+        self.hot_bytes += size
+    
+    def resize(self, chat_id, delta):
+        if chat_id in self.hot:
+            self.hot[chat_id] += delta
+            self.hot_bytes += delta
+    
+    def release(self, chat_id, size):
+        if chat_id in self.hot:
+            size = min(size, self.hot[chat_id])
+            self.hot[chat_id] -= size
+            self.hot_bytes -= size
+    
+    def drop_hot(self, chat_id):
+        self.hot_bytes -= self.hot.pop(chat_id, 0)
+    
+    def access(self, chat_id, missed):
+        self.events['misses' if missed else 'hits'] += 1
+        if chat_id in self.hot:
+            self.hot.move_to_end(chat_id)
+    
+    def over_budget(self):
+        return self.budget and self.hot_bytes > self.budget
+    
+    def coldest(self, keep=None):
+        for chat_id in self.hot:
+            if chat_id != keep:
+                return chat_id
+        return None
+    
+    # Диск
+    def write(self, chat_id, records):
+        # Новый блок в конец холодной истории чата; записи идут по seq и все старше хвоста в памяти
+        if not records:
+            return
+        number = self._chat_number(chat_id) << 32
+        for record in records:
+            key = fingerprint(record.id)
+            self.ids[key >> 56].add(key, number | record.seq)
+        self.cold_messages += len(records)
+        self.events['spilled'] += len(records)
+        self.blocks.setdefault(chat_id, []).append(self._store(records))
+    
+    def pop_block(self, chat_id):
+        # Подкачка: записи последнего блока для возврата в память
+        blocks = self.blocks[chat_id]
+        records = self._records(chat_id, blocks[-1])
+        self._forget(chat_id, records)
+        self._replace(chat_id, len(blocks) - 1, [])
+        self.events['page_ins'] += 1
+        return records
+    
+    def find(self, message_id):
+        if not self.cold_messages:
+            return None
+        key = fingerprint(message_id)
+        for value in self.ids[key >> 56].candidates(key):
+            record = self.read(self.chat_ids[value >> 32], value & 0xFFFFFFFF)
+            if record is not None and record.id == message_id:
+                return record
+        return None
+    
+    def read(self, chat_id, seq):
+        blocks = self.blocks.get(chat_id)
+        if not blocks:
+            return None
+        index = bisect_left(blocks, seq, key=last_seq)
+        if index == len(blocks) or blocks[index][0] > seq:
+            return None
+        table = self._table(blocks[index])
+        pos = bisect_left(table[1], seq)
+        if pos == len(table[1]) or table[1][pos] != seq:
+            return None
+        self.events['cold_reads'] += 1
+        return self._decode(chat_id, table, pos)
+    
+    def read_back(self, chat_id, before, limit):
+        # До limit записей с seq < before (None - с конца), от новых к старым
+        blocks = self.blocks.get(chat_id, ())
+        index = len(blocks) if before is None else bisect_left(blocks, before, key=first_seq)
+        found = []
+        while index > 0 and len(found) < limit:
+            index -= 1
+            table = self._table(blocks[index])
+            pos = len(table[1]) if before is None else bisect_left(table[1], before)
+            while pos > 0 and len(found) < limit:
+                pos -= 1
+                found.append(self._decode(chat_id, table, pos))
+        self.events['cold_reads'] += len(found)
+        return found
+    
+    def read_forward(self, chat_id, after, limit):
+        # До limit записей с seq > after, от старых к новым
+        blocks = self.blocks.get(chat_id, ())
+        index = bisect_right(blocks, after, key=last_seq)
+        found = []
+        while index < len(blocks) and len(found) < limit:
+            table = self._table(blocks[index])
+            pos = bisect_right(table[1], after)
+            while pos < len(table[1]) and len(found) < limit:
+                found.append(self._decode(chat_id, table, pos))
+                pos += 1
+            index += 1
+        self.events['cold_reads'] += len(found)
+        return found
+    
+    def replace(self, chat_id, seq, record):
+        # Переписывает блок с сообщением seq: запись заменяется новой, None - убирается
+        blocks = self.blocks[chat_id]
+        index = bisect_left(blocks, seq, key=last_seq)
+        records = self._records(chat_id, blocks[index])
+        pos = bisect_left(records, seq, key=lambda msg: msg.seq)
+        if record is None:
+            self._forget(chat_id, [records.pop(pos)])
+        else:
+            records[pos] = record
+        self._replace(chat_id, index, records)
+    
+    def remove_where(self, chat_id, predicate):
+        # Убирает из холодной истории чата сообщения, для которых predicate истинен
+        removed = []
+        blocks = self.blocks.get(chat_id, [])
+        for index in range(len(blocks) - 1, -1, -1):
+            kept = []
+            dropped = 0
+            for record in self._records(chat_id, blocks[index]):
+                if predicate(record):
+                    removed.append(record)
+                    dropped += 1
+                else:
+                    kept.append(record)
+            if dropped:
+                self._replace(chat_id, index, kept)
+        self._forget(chat_id, removed)
+        return removed
+    
+    def sparse_file(self):
+        # Файл, где живых блоков меньше четверти (самый разреженный), - его
+        # блоки tidy() перепишет в текущий файл, и он целиком станет мусором
+        sparse = [(live / os.path.getsize(self._path(number)), number) for number, live in self.files.items()
+                  if live and number != self._number]
+        share, number = min(sparse, default=(1, None))
+        return number if share < 0.25 else None
+    
+    def tidy(self, chat_id, sparse=None):
+        # Уборка холодной истории одного чата: серии мелких блоков подряд
+        # сливаются в блоки размером до хвоста, блоки из файла sparse переписываются.
+        # Короткая серия ждет следующих блоков, чтобы не переписывать одно и то же
+        blocks = self.blocks.get(chat_id)
+        if not blocks:
+            return
+        index = len(blocks) - 1
+        while index > 0:
+            start = index
+            total = blocks[index][5]
+            while (start > 0 and blocks[start][5] < SMALL_BLOCK and blocks[start - 1][5] < SMALL_BLOCK
+                   and total < HOT_TAIL):
+                start -= 1
+                total += blocks[start][5]
+            if index - start + 1 >= MERGE_RUN or (start < index and total >= SMALL_BLOCK):
+                records = []
+                for block in blocks[start:index + 1]:
+                    records.extend(self._records(chat_id, block))
+                for block in blocks[start + 1:index + 1]:
+                    self.files[block[2]] -= block[4]
+                del blocks[start + 1:index + 1]
+                self._replace(chat_id, start, records)
+            index = start - 1
+        for index, block in enumerate(blocks):
+            if block[2] == sparse:
+                self._replace(chat_id, index, self._records(chat_id, block))
+    
+    def collect(self, last_lsn, snapshot_lsn):
+        # Удаляет файлы без живых блоков, если уже есть снимок новее момента,
+        # когда они опустели. Возвращает число удаленных файлов
+        removed = 0
+        for number, live in list(self.files.items()):
+            if live or number == self._number:
+                continue
+            if snapshot_lsn > self.dead.setdefault(number, last_lsn):
+                data = self._maps.pop(number, None)
+                if data is not None:
+                    data.close()
+                os.remove(self._path(number))
+                del self.files[number]
+                del self.dead[number]
+                removed += 1
+        return removed
+    
+    def stats(self):
+        return {
+            'events': dict(self.events),
+            'size': {
+                'budget_bytes': self.budget,
+                'hot_bytes': self.hot_bytes,
+                'hot_chats': len(self.hot),
+                'cold_chats': len(self.blocks),
+                'cold_messages': self.cold_messages,
+                'cold_bytes': sum(self.files.values()),
+                'segment_files': len(self.files),
+                'id_table_bytes': sum(len(table.keys) for table in self.ids) * 16
+            }
+        }
+    
+    # Внутреннее
+    def _path(self, number):
+        return os.path.join(self.directory, f'seg-{number:08d}.dat')
+    
+    def _chat_number(self, chat_id):
+        number = self.chat_numbers.get(chat_id)
+        if number is None:
+            number = self.chat_numbers[chat_id] = len(self.chat_ids)
+            self.chat_ids.append(chat_id)
+        return number
+    
+    def _store(self, records):
+        data = encode_block(records)
+        if self._file is None or self._size >= SEGMENT_SIZE:
+            if self._file:
+                self._file.close()
+            self._number += 1
+            self._file = open(self._path(self._number), 'ab', buffering=0)
+            self._size = 0
+            self.files[self._number] = 0
+        offset = self._size
+        self._file.write(data)
+        self._size += len(data)
+        self.files[self._number] += len(data)
+        return (records[0].seq, records[-1].seq, self._number, offset, len(data), len(records))
+    
+    def _replace(self, chat_id, index, records):
+        blocks = self.blocks[chat_id]
+        self.files[blocks[index][2]] -= blocks[index][4]
+        if records:
+            blocks[index] = self._store(records)
+        else:
+            del blocks[index]
+            if not blocks:
+                del self.blocks[chat_id]
+    
+    def _forget(self, chat_id, records):
+        number = self.chat_numbers[chat_id] << 32
+        for record in records:
+            key = fingerprint(record.id)
+            self.ids[key >> 56].remove(key, number | record.seq)
+        self.cold_messages -= len(records)
+    
+    def _table(self, block):
+        # (данные файла, seq записей, концы записей, начало записей)
+        _, _, number, offset, length, count = block
+        data = self._maps.get(number)
+        if data is None or len(data) < offset + length:
+            # Текущий файл растет - отображение пересоздается под новый размер
+            if data is not None:
+                data.close()
+            with open(self._path(number), 'rb') as f:
+                data = self._maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = offset + COUNT.size
+        seqs = array('I')
+        seqs.frombytes(data[start:start + 4 * count])
+        ends = array('I')
+        ends.frombytes(data[start + 4 * count:start + 8 * count])
+        return data, seqs, ends, start + 8 * count
+    
+    def _decode(self, chat_id, table, pos):
+        data, _, ends, start = table
+        return decode_record(chat_id, data, start + (ends[pos - 1] if pos else 0))
+    
+    def _records(self, chat_id, block):
+        table = self._table(block)
+        return [self._decode(chat_id, table, pos) for pos in range(len(table[1]))]
@@ -0,0 +1,87 @@
+# Индикатор набора: слияние событий и истечение по TTL.
+#
+# Клиент шлет typing на каждое нажатие клавиши. В комнату уходит только смена
+# состояния (начал/перестал печатать) и не чаще раза в TYPING_INTERVAL -
+# подтверждение, что пользователь все еще печатает. Если "перестал" так и не
+# пришел (закрыли вкладку), состояние истекает через TYPING_TTL после
+# последнего нажатия. Истечения разбираются кучей по сроку, поэтому память
+# ограничена числом пользователей, которые печатают прямо сейчас.
+import heapq
+import threading
+import time
+
+TYPING_INTERVAL = 1.0  # Не чаще одного события "печатает" на (чат, пользователь)
+TYPING_TTL = 5.0  # Через сколько секунд без нажатий набор считается законченным
+
+
+class TypingEngine:
+    def __init__(self, interval=TYPING_INTERVAL, ttl=TYPING_TTL):
+        self.interval = interval
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._state = {}  # (chat_id, username) -> [время последней рассылки, срок истечения]
+        self._heap = []  # (срок истечения, chat_id, username); срок мог с тех пор продлиться
+        self.received = 0
+        self.emitted = 0
+        self.suppressed = 0
+        self.expired = 0
+    
+    def __len__(self):
+        return len(self._state)
+    
+    def update(self, chat_id, username, is_typing, now=None):
+        # True, если событие нужно разослать в комнату чата
+        now = time.monotonic() if now is None else now
+        key = (chat_id, username)
+        with self._lock:
+            self.received += 1
+            entry = self._state.get(key)
+            if not is_typing:
+                if entry is None:
+                    self.suppressed += 1
+                    return False
+                del self._state[key]
+                self.emitted += 1
+                return True
+            
+            if entry is not None:
+                # Срок продлеваем без новой записи в куче - sweep перенесет старую
+                entry[1] = now + self.ttl
+                if now - entry[0] < self.interval:
+                    self.suppressed += 1
+                    return False
+                entry[0] = now
+            else:
+                self._state[key] = [now, now + self.ttl]
+                heapq.heappush(self._heap, (now + self.ttl, chat_id, username))
+            self.emitted += 1
+            return True
+    
+    def sweep(self, now=None):
+        # [(chat_id, username)] с истекшим набором; о них нужно разослать "перестал"
+        now = time.monotonic() if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, chat_id, username = heapq.heappop(self._heap)
+                key = (chat_id, username)
+                entry = self._state.get(key)
+                if entry is None:
+                    continue  # Уже закончил сам
+                if entry[1] > now:
+                    heapq.heappush(self._heap, (entry[1], chat_id, username))
+                    continue
+                del self._state[key]
+                due.append(key)
+            self.expired += len(due)
+            self.emitted += len(due)
+        return due
+    
+    def stats(self):
+        return {
+            'active': len(self._state),
+            'received': self.received,
+            'emitted': self.emitted,
+            'suppressed': self.suppressed,
+            'expired': self.expired
+        }
@@ -0,0 +1,178 @@
+# Боевой запуск: несколько рабочих процессов без отладчика и перезагрузки.
+#
+#   DEEPLINK_STORAGE=sqlite python workers.py --workers 4 --port 10000
+#
+# Мастер открывает слушающий сокет и брокер шины, затем порождает воркеров.
+# Все воркеры принимают соединения с общего сокета (балансирует ядро),
+# состояние хранят в общей базе SQLite, а события комнат Socket.IO
+# и присутствие передают друг другу через шину (bus.py). Один воркер может
+# работать и с хранилищем в памяти, тогда шина не нужна.
+#
+# Модель воркера: threading - поток на соединение (сервер Werkzeug с
+# threaded=True). Это единственный поддерживаемый и проверенный режим.
+#
+# eventlet и gevent (зеленые потоки, стандартная библиотека патчится до
+# импорта сервера) - экспериментальные и не тестируются: пакеты не входят
+# в зависимости. Часть работы в них блокирует весь цикл воркера, а не один
+# запрос: ожидание потока записи SQLite, fsync журнала, чтение сегментов
+# истории через mmap и os.fork при снимке состояния.
+#
+# Соединение Socket.IO должно жить в одном воркере целиком, поэтому клиент
+# подключается сразу по WebSocket, без long-polling.
+#
+# Параметры передаются воркерам через окружение (см. srver.py):
+# DEEPLINK_WORKERS, DEEPLINK_HOST, DEEPLINK_PORT, DEEPLINK_ASYNC_MODE,
+# DEEPLINK_MAX_CONNECTIONS, DEEPLINK_PING_INTERVAL, DEEPLINK_PING_TIMEOUT.
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from bus import Broker
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('workers')
+
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+HTTP_CONCURRENCY = 256  # Одновременных HTTP-запросов сверх сокетов (eventlet/gevent)
+
+
+def listen(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+def patch(async_mode):
+    if async_mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif async_mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+
+def serve(app, sock, host, port, async_mode, max_connections):
+    # Поддерживается только threading; eventlet и gevent - см. заголовок
+    if async_mode == 'eventlet':
+        import eventlet.wsgi
+        from eventlet.greenio import GreenSocket
+        eventlet.wsgi.server(GreenSocket(sock), app, max_size=max_connections + HTTP_CONCURRENCY, log_output=False)
+    elif async_mode == 'gevent':
+        from gevent import socket as gevent_socket
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        listener = gevent_socket.socket(fileno=sock.detach())
+        WSGIServer(listener, app, spawn=Pool(max_connections + HTTP_CONCURRENCY), log=None).serve_forever()
+    else:
+        from werkzeug.serving import make_server
+        make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+
+def run_worker(worker_id, bus_path, sock, host, port):
+    # Выполняется в дочернем процессе: модуль сервера импортируется уже
+    # после fork, со своими потоками, соединениями с базой и шиной
+    os.environ['DEEPLINK_BUS'] = bus_path
+    os.environ['DEEPLINK_WORKER'] = str(worker_id)
+    async_mode = os.environ.get('DEEPLINK_ASYNC_MODE', 'threading')
+    if async_mode != 'threading':
+        log.warning('Режим %s экспериментальный и не тестируется, поддерживается только threading', async_mode)
+    patch(async_mode)
+    import srver
+    
+    if srver.DATA_DIR:
+        srver.open_persistence(srver.DATA_DIR, sync_commit=srver.SYNC_COMMIT, snapshot_every=srver.SNAPSHOT_EVERY,
+                               hot_bytes=int(srver.HOT_MESSAGES_MB * 2 ** 20))
+    if worker_id == 0:
+        srver.seed_test_data()
+    log.info('Воркер %d (pid %d, %s) принимает соединения на %s:%d', worker_id, os.getpid(), async_mode, host, port)
+    serve(srver.app, sock, host, port, async_mode, srver.MAX_CONNECTIONS)
+
+
+def spawn(worker_id, bus_path, sock, host, port):
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            run_worker(worker_id, bus_path, sock, host, port)
+            code = 0
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    env = os.environ.get
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=int(env('DEEPLINK_WORKERS', '0')) or os.cpu_count())
+    parser.add_argument('--host', default=env('DEEPLINK_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(env('DEEPLINK_PORT', '10000')))
+    parser.add_argument('--async-mode', choices=ASYNC_MODES, default=env('DEEPLINK_ASYNC_MODE', 'threading'),
+                        help='threading; eventlet и gevent экспериментальные')
+    parser.add_argument('--max-connections', type=int, default=int(env('DEEPLINK_MAX_CONNECTIONS', '10000')),
+                        help='сокетов Socket.IO на воркер, сверх лимита соединение отклоняется')
+    parser.add_argument('--ping-interval', type=float, default=float(env('DEEPLINK_PING_INTERVAL', '25')))
+    parser.add_argument('--ping-timeout', type=float, default=float(env('DEEPLINK_PING_TIMEOUT', '20')))
+    parser.add_argument('--bus', default=os.path.join(tempfile.gettempdir(), f'deeplink-bus-{os.getpid()}.sock'))
+    parser.add_argument('--access-log', action='store_true', default=env('DEEPLINK_ACCESS_LOG') == '1')
+    args = parser.parse_args()
+    
+    if args.workers > 1 and env('DEEPLINK_STORAGE', 'memory') != 'sqlite':
+        sys.exit('Для нескольких воркеров нужно общее хранилище: DEEPLINK_STORAGE=sqlite')
+    if not args.access_log:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    
+    os.environ.update({
+        'DEEPLINK_ASYNC_MODE': args.async_mode,
+        'DEEPLINK_MAX_CONNECTIONS': str(args.max_connections),
+        'DEEPLINK_PING_INTERVAL': str(args.ping_interval),
+        'DEEPLINK_PING_TIMEOUT': str(args.ping_timeout)
+    })
+    
+    # Одному воркеру шина не нужна
+    broker = Broker(args.bus).start() if args.workers > 1 else None
+    bus_path = broker.path if broker else ''
+    sock = listen(args.host, args.port)
+    workers = {spawn(i, bus_path, sock, args.host, args.port): i for i in range(args.workers)}
+    log.info('Запущено воркеров: %d (%s)', len(workers), args.async_mode)
+    
+    stopping = False
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    # Упавший воркер перезапускается с тем же номером
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_id = workers.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+        log.warning('Воркер %d (pid %d) завершился со статусом %d, перезапуск', worker_id, pid, status)
+        time.sleep(1)
+        workers[spawn(worker_id, bus_path, sock, args.host, args.port)] = worker_id
+    
+    if broker:
+        broker.close()
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()